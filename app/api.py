@@ -1,15 +1,22 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.config.database import engine, async_engine, warm_up_pool, warm_up_async_pool
+from app.config.redis import redis_connection
+from app.config.schema import create_api_tables
+from app.etag import API_VERSION
+from app.upload_cache import close_upload_changes, open_upload_changes
+from app.ingest import reflect_tables
+from app.jobs import fail_abandoned_jobs, parse_queue, start_job_heartbeat, stop_job_heartbeat
 from app.routes.pride import pride_router
 from app.routes.pdbdev import pdbdev_router
 from app.routes.xiview import xiview_data_router
-from app.routes.parse import parser_router
+from app.routes.parse import parser_router, TableNamesEnum, db_table_name
 from fastapi.middleware.gzip import GZipMiddleware
 
 app = FastAPI(title="xi-mzidentml-converter ws",
               description="This is an API to crosslinking archive",
-              version="0.0.1",
+              version=API_VERSION,
                 contact={
                   "name": "PRIDE Team",
                   "url": "https://www.ebi.ac.uk/pride/",
@@ -38,6 +45,29 @@ app.add_middleware(
 # Tier 4 Network level compression, no need to worry at Tier 7(HTTPS) level
 # app.add_middleware(GZipMiddleware, minimum_size=1000)
 
+
+@app.on_event("startup")
+async def startup():
+    create_api_tables(engine)
+    reflect_tables([db_table_name(table) for table in TableNamesEnum])
+    warm_up_pool()
+    await warm_up_async_pool()
+    await fail_abandoned_jobs()
+    start_job_heartbeat()
+    await redis_connection.open()
+    if redis_connection.client is not None:
+        await open_upload_changes(redis_connection.config)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    stop_job_heartbeat()
+    parse_queue.shutdown()
+    await close_upload_changes()
+    await redis_connection.close()
+    await async_engine.dispose()
+
+
 app.include_router(pride_router, prefix="/pride/ws/archive/crosslinking")
 app.include_router(pdbdev_router, prefix="/pride/ws/archive/crosslinking/pdbdev")
 app.include_router(xiview_data_router, prefix="/pride/ws/archive/crosslinking/data")
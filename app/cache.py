@@ -0,0 +1,179 @@
+import functools
+import hashlib
+import inspect
+import logging
+
+import anyio.from_thread
+import msgpack
+import orjson
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+
+from app.config.redis import get_redis, redis_connection
+from app.etag import etag_matches, not_modified
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "cache:"
+GENERATION_PREFIX = "cache-generation:"
+# tag generations outlive the responses cached under them, whatever their ttl
+GENERATION_TTL = 7 * 24 * 60 * 60
+# bigger responses aren't cached, storing them would cost more than loading them again
+MAX_CACHED_SIZE = 4 * 1024 * 1024
+# response headers kept with a cached response
+CACHED_HEADERS = ("vary", "etag")
+# tags shared by the cached endpoints
+STATISTICS_TAG = "statistics"
+
+
+def project_tag(project_id):
+    return f"project:{project_id}"
+
+
+class CacheStats:
+    """
+    Hit and miss counters per cached endpoint. errors count the Redis calls that failed,
+    bypassed the requests answered without the cache because Redis was unavailable.
+    """
+    def __init__(self):
+        self.counters = {}
+
+    def record(self, name, outcome):
+        counters = self.counters.setdefault(name, {"hits": 0, "misses": 0, "errors": 0, "bypassed": 0})
+        counters[outcome] += 1
+
+    def as_dict(self):
+        return {name: dict(counters) for name, counters in self.counters.items()}
+
+
+cache_stats = CacheStats()
+
+
+def cache_key(name, kwargs, request=None, vary=(), generations=()):
+    """
+    Key of a cached response: the endpoint name and a hash of its simple parameters,
+    of the request headers listed in vary and of the current generations of its tags.
+    """
+    params = {key: value for key, value in kwargs.items()
+              if value is None or isinstance(value, (str, int, float, bool))}
+    if request is not None:
+        params.update({f"header:{header}": request.headers.get(header) for header in vary})
+    if generations:
+        params["generations"] = [int(generation or 0) for generation in generations]
+    digest = hashlib.sha1(orjson.dumps(params, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    return f"{KEY_PREFIX}{name}:{digest}"
+
+
+def encode_response(result, max_size=MAX_CACHED_SIZE):
+    """
+    Cacheable form of an endpoint result, None if it shouldn't be cached, e.g. a Cache-Control: no-store response.
+    """
+    if isinstance(result, Response):
+        if result.status_code != 200 or not hasattr(result, "body") or len(result.body) > max_size:
+            return None
+        if "no-store" in result.headers.get("cache-control", ""):
+            return None
+        headers = {name: result.headers[name] for name in CACHED_HEADERS if name in result.headers}
+        return msgpack.packb({"body": result.body, "media_type": result.media_type, "headers": headers})
+    if result is None or isinstance(result, tuple):
+        return None
+    return msgpack.packb({"body": orjson.dumps(jsonable_encoder(result)), "media_type": "application/json",
+                          "headers": {}})
+
+
+def decode_response(value, request=None):
+    """
+    Response from its cached form, a 304 if it has an ETag that the request's If-None-Match lists.
+    """
+    cached = msgpack.unpackb(value)
+    etag = cached["headers"].get("etag")
+    if etag and request is not None and etag_matches(request, etag):
+        return not_modified(etag, cached["headers"].get("vary"))
+    return Response(cached["body"], media_type=cached["media_type"], headers=cached["headers"])
+
+
+def cached(ttl, tags=(), vary=(), max_size=MAX_CACHED_SIZE):
+    """
+    Cache the responses of an endpoint in Redis.
+    The key comes from the endpoint's str/int/float/bool parameters and the request headers in vary
+    (the endpoint then needs a Request parameter). tags are formatted with the parameters,
+    e.g. "project:{project_id}", and the key includes each tag's generation, so invalidate_cache(tag),
+    which moves the tag to its next generation, leaves every response cached under it unreachable.
+    A response computed from data read before an invalidation is stored under the old generation.
+    Only successful responses up to max_size bytes are cached, and if Redis is unavailable
+    the endpoint is simply called.
+
+    :param ttl: seconds a response stays cached
+    :param tags: tags of the cached responses
+    :param vary: request headers the response depends on
+    :param max_size: largest response to cache, in bytes
+    """
+    def decorator(func):
+        name = f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+        is_async = inspect.iscoroutinefunction(func)
+
+        @functools.wraps(func)
+        async def wrapper(**kwargs):
+            request = next((value for value in kwargs.values() if isinstance(value, Request)), None)
+            generation_keys = [GENERATION_PREFIX + tag.format(**kwargs) for tag in tags]
+            client = get_redis()
+            value = None
+            if client is None:
+                cache_stats.record(name, "bypassed")
+            else:
+                try:
+                    generations = await client.mget(generation_keys) if generation_keys else ()
+                    key = cache_key(name, kwargs, request, vary, generations)
+                    value = await client.get(key)
+                    redis_connection.record_success()
+                except Exception as error:
+                    redis_connection.record_failure(error)
+                    cache_stats.record(name, "errors")
+                    client = None
+            if value is not None:
+                cache_stats.record(name, "hits")
+                return decode_response(value, request)
+            if client is not None:
+                cache_stats.record(name, "misses")
+
+            result = await func(**kwargs) if is_async else await run_in_threadpool(func, **kwargs)
+
+            encoded = encode_response(result, max_size)
+            if client is not None and encoded is not None and len(encoded) <= max_size:
+                try:
+                    await client.set(key, encoded, ex=ttl)
+                except Exception as error:
+                    redis_connection.record_failure(error)
+                    cache_stats.record(name, "errors")
+            return result
+        return wrapper
+    return decorator
+
+
+async def invalidate_cache(*tags):
+    """
+    Drop every response cached under any of the tags by moving the tags to their next generation,
+    the old responses expire with their ttl. Failures are logged, not raised,
+    so a write never fails because of the cache.
+    This is tried even while Redis is being skipped, a missed invalidation would leave stale responses behind.
+    """
+    client = redis_connection.client
+    if client is None:
+        return
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            for tag in tags:
+                pipe.incr(GENERATION_PREFIX + tag)
+                pipe.expire(GENERATION_PREFIX + tag, GENERATION_TTL)
+            await pipe.execute()
+        logger.info(f"Invalidated cache for {', '.join(tags)}")
+    except Exception as error:
+        logger.error(f"Invalidating cache for {', '.join(tags)} failed: {error}")
+
+
+def invalidate_cache_from_thread(*tags):
+    """
+    invalidate_cache for the sync endpoints, which FastAPI runs in a worker thread.
+    """
+    anyio.from_thread.run(invalidate_cache, *tags)
@@ -0,0 +1,97 @@
+import datetime
+from decimal import Decimal
+
+import msgpack
+import numpy as np
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def media_range_qualities(accept_header):
+    """
+    Map each media range of an Accept header to its q value, 1 if it has none.
+    Ranges with an unparseable q value are ignored.
+    """
+    qualities = {}
+    for media_range in accept_header.split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = None
+        if media_type and quality is not None:
+            qualities[media_type.lower()] = quality
+    return qualities
+
+
+def accepts_msgpack(accept_header):
+    """
+    True if the Accept header asks for the MessagePack encoding: a MessagePack media type with q > 0
+    that JSON isn't preferred to.
+    """
+    if not accept_header:
+        return False
+    qualities = media_range_qualities(accept_header)
+    msgpack_quality = max(qualities.get(media_type, 0) for media_type in MSGPACK_MEDIA_TYPES)
+    return msgpack_quality > 0 and msgpack_quality >= qualities.get("application/json", 0)
+
+
+def typed_array(values):
+    """
+    Pack a column into a little-endian typed array if every value is a bool, an int or a number,
+    otherwise return None. Missing values become NaN in float columns, int and bool columns with missing
+    values stay lists so ids aren't turned into floats.
+    """
+    if not values:
+        return None
+    if all(isinstance(v, bool) for v in values):
+        return {"dtype": "|u1", "data": np.asarray(values, dtype="|u1").tobytes()}
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        array = np.asarray(values, dtype="<i8")
+        if array.min() >= np.iinfo(np.int32).min and array.max() <= np.iinfo(np.int32).max:
+            return {"dtype": "<i4", "data": array.astype("<i4").tobytes()}
+        return {"dtype": "<i8", "data": array.tobytes()}
+    if all(v is None or (isinstance(v, (int, float, Decimal)) and not isinstance(v, bool)) for v in values) \
+            and any(isinstance(v, (float, Decimal)) for v in values):
+        array = np.asarray([np.nan if v is None else float(v) for v in values], dtype="<f8")
+        return {"dtype": "<f8", "data": array.tobytes()}
+    return None
+
+
+def to_columns(rows):
+    """
+    Turn a list of dict rows into a column batch: {"length": n, "columns": {name: column}}.
+    Numeric columns are typed arrays ({"dtype": ..., "data": bytes}), the rest are plain lists.
+    """
+    columns = {}
+    if rows:
+        for name in rows[0].keys():
+            values = [row[name] for row in rows]
+            packed = typed_array(values)
+            columns[name] = packed if packed is not None else values
+    return {"length": len(rows), "columns": columns}
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    raise TypeError(f"Cannot serialize object of type {type(obj)}")
+
+
+def encode_data_object(data_object):
+    """
+    MessagePack encoding of a get_data_object result, with matches, peptides and proteins as column batches.
+    """
+    return msgpack.packb({
+        "project": data_object["project"],
+        "meta": data_object["meta"],
+        "matches": to_columns(data_object["matches"]),
+        "peptides": to_columns(data_object["peptides"]),
+        "proteins": to_columns(data_object["proteins"]),
+    }, default=_default)
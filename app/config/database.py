@@ -1,11 +1,119 @@
-from sqlalchemy import create_engine
+import threading
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
-from db_config_parser import get_conn_str
+from db_config_parser import get_conn_str, get_pool_config
 
 conn_str = get_conn_str()
+# psycopg (3) has a native asyncio driver, used for the async read path
+async_conn_str = conn_str.replace("postgresql://", "postgresql+psycopg://", 1)
+pool_config = get_pool_config()
+
+
+class PoolStats:
+    """
+    Counters for the shared connection pool, used to spot pool saturation.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.saturated_checkouts = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def watch(self, pool):
+        event.listen(pool, "connect", self._on_connect)
+        event.listen(pool, "checkout", self._on_checkout)
+        event.listen(pool, "checkin", self._on_checkin)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            if self.in_use >= self.max_size:
+                self.saturated_checkouts += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+            self.in_use = max(self.in_use - 1, 0)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "saturated_checkouts": self.saturated_checkouts,
+                "timeouts": self.timeouts,
+            }
+
 
-# Create a sqlite engine instance
-engine = create_engine(conn_str)
+def split_pool_size(size):
+    """
+    Share of the sync and of the async engine in a number of connections, at least one each.
+    """
+    async_size = max((size + 1) // 2, 1)
+    return max(size - async_size, 1), async_size
+
+
+def pool_options(min_size, max_size):
+    # pool_size connections are kept open, anything above that up to max_size is closed again on return
+    return {
+        "pool_size": min_size,
+        "max_overflow": max(max_size - min_size, 0),
+        "pool_recycle": pool_config["recycle"],
+        "pool_timeout": pool_config["timeout"],
+        "pool_pre_ping": True,
+    }
+
+
+# The sync engine (sessions, writes) and the async engine (xiVIEW and PDB-Dev reads) split the [pool] budget,
+# so a worker holds at most max_size connections in all, the async engine getting the larger half.
+sync_min_size, async_min_size = split_pool_size(pool_config["min_size"])
+sync_max_size, async_max_size = split_pool_size(pool_config["max_size"])
+engine = create_engine(conn_str, **pool_options(sync_min_size, sync_max_size))
+async_engine = create_async_engine(async_conn_str, **pool_options(async_min_size, async_max_size))
+
+pool_stats = PoolStats(sync_max_size)
+pool_stats.watch(engine.pool)
+async_pool_stats = PoolStats(async_max_size)
+async_pool_stats.watch(async_engine.sync_engine.pool)
 
 # Create SessionLocal class from sessionmaker factory
 SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+
+
+def warm_up_pool():
+    """
+    Open the sync engine's share of min_size connections up front so the first requests don't pay the connect cost.
+    """
+    connections = [engine.raw_connection() for _ in range(sync_min_size)]
+    for connection in connections:
+        connection.close()
+
+
+async def warm_up_async_pool():
+    """
+    Open the async engine's share of min_size connections up front.
+    """
+    connections = [await async_engine.connect() for _ in range(async_min_size)]
+    for connection in connections:
+        await connection.close()
@@ -0,0 +1,96 @@
+import logging
+import time
+
+import redis.asyncio as redis
+
+from db_config_parser import get_redis_pool_config
+
+logger = logging.getLogger(__name__)
+
+# a slow command, e.g. on a big value, times out without Redis being down
+TIMEOUTS_BEFORE_SKIPPING = 3
+
+
+class RedisConnection:
+    """
+    Application-lifetime Redis client on a shared connection pool, opened at startup and closed at shutdown.
+    Connections are health checked when idle for health_check_interval seconds.
+    After a failure Redis is skipped for retry_after seconds, so while it is down callers fall back
+    to the database straight away instead of each waiting for a connect timeout.
+    Timeouts only count as a failure after TIMEOUTS_BEFORE_SKIPPING in a row.
+    """
+    def __init__(self):
+        self.client = None
+        self.config = None
+        self._unavailable_until = 0.0
+        self._timeouts = 0
+
+    async def open(self):
+        try:
+            self.config = get_redis_pool_config()
+            pool = redis.ConnectionPool(host=self.config["host"],
+                                        port=self.config["port"],
+                                        password=self.config["password"],
+                                        max_connections=self.config["max_connections"],
+                                        socket_timeout=self.config["socket_timeout"],
+                                        socket_connect_timeout=self.config["connect_timeout"],
+                                        health_check_interval=self.config["health_check_interval"])
+            self.client = redis.Redis(connection_pool=pool)
+        except Exception as error:
+            logger.error(f"Redis is not configured, caching is disabled: {error}")
+            return
+        if not await self.ping():
+            logger.warning("Redis is not reachable at startup, caching is skipped until it is")
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def get(self):
+        """
+        The client, or None if Redis isn't configured or failed within the last retry_after seconds.
+        """
+        if self.client is None or time.monotonic() < self._unavailable_until:
+            return None
+        return self.client
+
+    def record_success(self):
+        self._timeouts = 0
+
+    def record_failure(self, error):
+        if isinstance(error, (redis.TimeoutError, TimeoutError)):
+            self._timeouts += 1
+            if self._timeouts < TIMEOUTS_BEFORE_SKIPPING:
+                logger.warning(f"Redis timed out: {error}")
+                return
+        self._timeouts = 0
+        if time.monotonic() >= self._unavailable_until:
+            logger.warning(f"Redis failed, skipping it for {self.config['retry_after']}s: {error}")
+        self._unavailable_until = time.monotonic() + self.config["retry_after"]
+
+    async def ping(self):
+        """
+        Health check, True if Redis answered.
+        """
+        if self.client is None:
+            return False
+        try:
+            await self.client.ping()
+            self._unavailable_until = 0.0
+            self._timeouts = 0
+            return True
+        except Exception as error:
+            self.record_failure(error)
+            return False
+
+
+redis_connection = RedisConnection()
+
+
+def get_redis():
+    """
+    The shared Redis client, None if Redis is unavailable. Used by the cache rather than as an endpoint dependency,
+    so endpoints keep working when Redis is down.
+    """
+    return redis_connection.get()
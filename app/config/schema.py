@@ -0,0 +1,182 @@
+import logging
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Tables owned by this API rather than by the converter's models.
+# latestupload: the most recent upload per (project, identification file), so readers don't need a correlated
+# max(upload_time) subquery. Kept current by a trigger on upload, see LATEST_UPLOAD_TRIGGER, which covers uploads
+# written straight to the database by process_dataset.py as well as the write/delete endpoints.
+# residuepair/residuepairbuild: precomputed residue pairs for the PDB-Dev endpoints, see pdbdev.py.
+# metadatarefresh: the upload set each project's metadata was last computed from, see update_metadata.
+# apijob: background jobs and their progress, see app/jobs.py.
+# stagedupload: uploads written to the staging tables and not published yet, see app/ingest.py.
+# The search indexes are on the projectdetails/projectsubdetails tables of the converter, see SEARCH_INDEXES.
+API_TABLES = [
+    """CREATE TABLE IF NOT EXISTS latestupload (
+        project_id TEXT NOT NULL,
+        identification_file_name TEXT,
+        identification_file_name_clean TEXT,
+        upload_id INTEGER NOT NULL,
+        upload_time TIMESTAMP
+    )""",
+    """CREATE UNIQUE INDEX IF NOT EXISTS latestupload_project_file_idx
+        ON latestupload (project_id, COALESCE(identification_file_name, ''))""",
+    """CREATE INDEX IF NOT EXISTS latestupload_file_clean_idx
+        ON latestupload (project_id, identification_file_name_clean)""",
+    """CREATE TABLE IF NOT EXISTS residuepair (
+        upload_id INTEGER NOT NULL,
+        prot1 TEXT NOT NULL,
+        prot1_acc TEXT,
+        pos1 INTEGER NOT NULL,
+        prot2 TEXT NOT NULL,
+        prot2_acc TEXT,
+        pos2 INTEGER NOT NULL,
+        passing BOOLEAN NOT NULL,
+        match_ids INTEGER[] NOT NULL
+    )""",
+    # pair keys of an upload in page order, see get_residue_pairs_page
+    """CREATE INDEX IF NOT EXISTS residuepair_upload_page_idx
+        ON residuepair (upload_id, prot1, pos1, prot2, pos2, (coalesce(prot1_acc, '')), (coalesce(prot2_acc, '')))""",
+    """CREATE TABLE IF NOT EXISTS residuepairbuild (
+        upload_id INTEGER PRIMARY KEY,
+        built_at TIMESTAMP NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS metadatarefresh (
+        project_id TEXT PRIMARY KEY,
+        upload_signature TEXT,
+        refreshed_at TIMESTAMP NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS apijob (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        params JSONB,
+        progress JSONB,
+        result JSONB,
+        error TEXT,
+        created_at TIMESTAMP NOT NULL,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        owner TEXT,
+        heartbeat_at TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS stagedupload (
+        upload_id INTEGER PRIMARY KEY,
+        staged_at TIMESTAMP NOT NULL
+    )""",
+]
+
+# Recompute the latestupload rows of the projects of a changed upload, as refresh_latest_uploads does.
+# The trigger is deferred to the commit, so an upload written staged is already in stagedupload when it runs.
+LATEST_UPLOAD_TRIGGER = [
+    """CREATE OR REPLACE FUNCTION refresh_latestupload() RETURNS trigger AS $$
+    DECLARE
+        changed_project TEXT;
+        changed_projects TEXT[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            changed_projects := ARRAY[NEW.project_id];
+        ELSIF TG_OP = 'DELETE' THEN
+            changed_projects := ARRAY[OLD.project_id];
+        ELSE
+            changed_projects := ARRAY[OLD.project_id, NEW.project_id];
+        END IF;
+        FOREACH changed_project IN ARRAY changed_projects LOOP
+            PERFORM pg_advisory_xact_lock(hashtext('latestupload'), hashtext(changed_project));
+            DELETE FROM latestupload WHERE project_id = changed_project;
+            INSERT INTO latestupload (project_id, identification_file_name, identification_file_name_clean,
+                                      upload_id, upload_time)
+                SELECT DISTINCT ON (identification_file_name)
+                    project_id, identification_file_name, identification_file_name_clean, id, upload_time
+                FROM upload
+                WHERE project_id = changed_project
+                    AND id NOT IN (SELECT upload_id FROM stagedupload)
+                ORDER BY identification_file_name, upload_time DESC, id DESC;
+        END LOOP;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    # replaced in one transaction, so workers starting together don't leave upload without it
+    """DROP TRIGGER IF EXISTS upload_latestupload_trigger ON upload;
+    CREATE CONSTRAINT TRIGGER upload_latestupload_trigger
+        AFTER INSERT OR DELETE OR UPDATE OF project_id, identification_file_name, identification_file_name_clean,
+        upload_time ON upload
+        DEFERRABLE INITIALLY DEFERRED
+        FOR EACH ROW EXECUTE FUNCTION refresh_latestupload()""",
+]
+
+# fill latestupload for the projects that have no rows yet, e.g. uploads written before the trigger existed
+BACKFILL_SQL = [
+    """INSERT INTO latestupload (project_id, identification_file_name, identification_file_name_clean,
+                                 upload_id, upload_time)
+        SELECT DISTINCT ON (project_id, identification_file_name)
+            project_id, identification_file_name, identification_file_name_clean, id, upload_time
+        FROM upload u
+        WHERE NOT EXISTS (SELECT 1 FROM latestupload l WHERE l.project_id = u.project_id)
+            AND NOT EXISTS (SELECT 1 FROM stagedupload s WHERE s.upload_id = u.id)
+        ORDER BY project_id, identification_file_name, upload_time DESC, id DESC
+        ON CONFLICT DO NOTHING""",
+]
+
+
+# Indexes on the converter's tables, which may be big and in use. CREATE INDEX CONCURRENTLY doesn't block writes
+# but can't run in a transaction or in several workers at once, so these are created once, out of band, with
+#   python -m app.config.schema
+SEARCH_INDEXES = [
+    # trigram indexes behind the LIKE '%query%' project and protein search, and its word_similarity ranking
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS projectdetails_search_idx ON projectdetails
+        USING gin (project_id gin_trgm_ops, title gin_trgm_ops, description gin_trgm_ops, organism gin_trgm_ops)""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS projectsubdetails_search_idx ON projectsubdetails
+        USING gin (protein_accession gin_trgm_ops, protein_name gin_trgm_ops, gene_name gin_trgm_ops)""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS projectsubdetails_accession_idx
+        ON projectsubdetails (protein_accession)""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS projectsubdetails_project_detail_idx
+        ON projectsubdetails (project_detail_id)""",
+]
+
+
+def create_api_tables(engine):
+    """
+    Create the API's own tables and indexes if they don't exist yet and backfill them.
+    Several workers may start at the same time, and the database user may not be allowed to
+    create extensions, so each statement runs on its own and failures are logged rather than raised.
+    """
+    for statement in API_TABLES + LATEST_UPLOAD_TRIGGER + BACKFILL_SQL:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(statement))
+        except Exception as error:
+            logger.error(f"Could not run schema statement: {error}")
+
+
+def create_search_indexes(engine):
+    """
+    Create the extension and indexes of SEARCH_INDEXES, stopping at the first failure.
+    A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind, drop it before running this again.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for statement in SEARCH_INDEXES:
+            logger.info(f"Running {statement.split(' ON ')[0]}")
+            conn.execute(text(statement))
+
+
+def trigram_available(engine):
+    """
+    True if the pg_trgm extension is installed, False if it isn't and None if that couldn't be checked.
+    """
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")).scalar()
+    except Exception as error:
+        logger.error(f"Could not check for the pg_trgm extension: {error}")
+        return None
+
+
+if __name__ == "__main__":
+    from app.config.database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    create_search_indexes(engine)
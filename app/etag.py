@@ -0,0 +1,55 @@
+import hashlib
+
+from fastapi import Response, status
+
+# part of every ETag, so a release that changes the response format invalidates the clients' copies
+API_VERSION = "0.0.1"
+
+
+def uploads_etag(uploads, builds, *variant):
+    """
+    Strong ETag of a response computed from the given uploads: changes when an upload is added, replaced,
+    deleted or its data is completed again, or with the API version. variant tells apart the representations
+    of the same data.
+    An upload becomes the latest one of its file before its data is loaded, and its residue pairs are built
+    once the data is complete, so the build time marks the data complete. A response with an unbuilt upload
+    may still change without the uploads changing and gets no ETag.
+
+    :param uploads: list of dicts with id and upload_time, as returned by get_most_recent_uploads
+    :param builds: dict of upload id to built_at, as returned by get_residue_pair_builds
+    :param variant: anything else the response depends on, e.g. its encoding or page
+    :return: the ETag, None if an upload hasn't been built or the uploads couldn't be read (None)
+    """
+    if uploads is None:
+        return None
+    uploads = sorted(uploads, key=lambda u: u["id"])
+    if any(upload["id"] not in builds for upload in uploads):
+        return None
+    parts = [API_VERSION]
+    parts += [f"{upload['id']}@{upload['upload_time']}@{builds[upload['id']]}" for upload in uploads]
+    parts += [str(part) for part in variant]
+    return '"' + hashlib.sha1("|".join(parts).encode()).hexdigest() + '"'
+
+
+def etag_matches(request, etag):
+    """
+    True if the request's If-None-Match header lists the ETag, the client's copy is then still current.
+    """
+    if etag is None:
+        return False
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def not_modified(etag, vary=None):
+    """
+    304 for a request whose copy is current, vary as on the 200 so shared caches keep the variants apart.
+    """
+    headers = {"ETag": etag}
+    if vary:
+        headers["Vary"] = vary
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
@@ -0,0 +1,156 @@
+import csv
+import logging
+
+from psycopg2 import sql
+from sqlalchemy import MetaData, Table, select, text
+
+from app.config.database import engine
+
+logger = logging.getLogger(__name__)
+
+# tables are reflected once, at startup or on first use, rather than on every write
+meta = MetaData()
+
+# request bodies bigger than this are spooled to disk before being copied
+COPY_SPOOL_SIZE = 64 * 1024 * 1024
+
+# Tables that can be loaded through staging tables, in the order they are published.
+# A staging table is an unlogged copy of the table without indexes or constraints,
+# rows are moved to the real table with one INSERT ... SELECT when the upload is published.
+STAGED_TABLES = [
+    "spectrumidentificationprotocol",
+    "enzyme",
+    "searchmodification",
+    "analysiscollectionspectrumidentification",
+    "dbsequence",
+    "modifiedpeptide",
+    "peptideevidence",
+    "spectrum",
+    "spectrumidentification",
+]
+STAGING_PREFIX = "staging_"
+
+
+def get_table(table_name):
+    """
+    The reflected table, reflecting it if this is the first time it is asked for.
+    """
+    if table_name not in meta.tables:
+        Table(table_name, meta, autoload_with=engine)
+    return meta.tables[table_name]
+
+
+def reflect_tables(table_names):
+    """
+    Reflect the tables written by the parser endpoints that exist. Failures are logged,
+    a table is then reflected on first use.
+    """
+    try:
+        meta.reflect(bind=engine, only=lambda table_name, _: table_name in table_names)
+    except Exception as error:
+        logger.error(f"Could not reflect tables: {error}")
+
+
+def copy_csv(connection, table_name, file):
+    """
+    Load a CSV file into a table with COPY.
+    The first line of the file names the columns, which must be columns of the table.
+    bytea values are written in the hex format, e.g. \\x0000f03f.
+
+    :param connection: psycopg2 connection, committed on success and rolled back on failure
+    :param table_name: table to load
+    :param file: binary file object positioned at the header line
+    :return: number of rows loaded
+    """
+    table = get_table(table_name)
+    start = file.tell()
+    columns = next(csv.reader([file.readline().decode()]), [])
+    unknown = [column for column in columns if column not in table.columns]
+    if not columns or unknown:
+        raise ValueError(f"Unknown columns for table {table_name}: {unknown}")
+    file.seek(start)
+
+    statement = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, HEADER true)").format(
+        sql.Identifier(table.name), sql.SQL(", ").join(sql.Identifier(column) for column in columns))
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(statement.as_string(cursor), file)
+            row_count = cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    return row_count
+
+
+def get_staging_table(table_name):
+    """
+    The staging table of a table, creating it if it doesn't exist yet.
+    """
+    staging_name = STAGING_PREFIX + table_name
+    if staging_name not in meta.tables:
+        quote = engine.dialect.identifier_preparer.quote
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE UNLOGGED TABLE IF NOT EXISTS {quote(staging_name)} "
+                              f"(LIKE {quote(table_name)} INCLUDING DEFAULTS)"))
+            # rows are published and deleted by upload
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {quote(staging_name + '_upload_idx')} "
+                              f"ON {quote(staging_name)} (upload_id)"))
+    return get_table(staging_name)
+
+
+def staging_exists(session, table_name):
+    """
+    :return: whether the staging table of a table has been created
+    """
+    return session.execute(text("SELECT to_regclass(:name) IS NOT NULL"),
+                           {"name": STAGING_PREFIX + table_name}).scalar()
+
+
+def mark_staged(session, upload_id):
+    """
+    Record that an upload is written staged, which keeps it out of latestupload until it is published.
+    """
+    session.execute(text("INSERT INTO stagedupload (upload_id, staged_at) VALUES (:upload_id, now())"),
+                    {"upload_id": upload_id})
+
+
+def publish_staged_rows(session, upload_id):
+    """
+    Move the staged rows of an upload into the real tables and unmark it as staged, the caller commits.
+
+    :param session: database session
+    :param upload_id: upload id
+    :return: number of rows published per table
+    """
+    counts = {}
+    for table_name in STAGED_TABLES:
+        if not staging_exists(session, table_name):
+            continue
+        table = get_table(table_name)
+        staging_table = get_table(STAGING_PREFIX + table_name)
+        columns = [column.name for column in table.columns if column.name in staging_table.columns]
+        staged_rows = select(*(staging_table.c[column] for column in columns)) \
+            .where(staging_table.c.upload_id == upload_id)
+        result = session.execute(table.insert().from_select(columns, staged_rows))
+        session.execute(staging_table.delete().where(staging_table.c.upload_id == upload_id))
+        counts[table_name] = result.rowcount
+    session.execute(text("DELETE FROM stagedupload WHERE upload_id = :upload_id"), {"upload_id": upload_id})
+    return counts
+
+
+def delete_staged_rows(session, upload_ids):
+    """
+    Delete the staged rows of uploads that are never going to be published and unmark them as staged,
+    the caller commits.
+
+    :param session: database session
+    :param upload_ids: upload ids
+    """
+    for table_name in STAGED_TABLES:
+        if not staging_exists(session, table_name):
+            continue
+        staging_table = get_table(STAGING_PREFIX + table_name)
+        session.execute(staging_table.delete().where(staging_table.c.upload_id.in_(upload_ids)))
+    session.execute(text("DELETE FROM stagedupload WHERE upload_id = ANY(:upload_ids)"),
+                    {"upload_ids": list(upload_ids)})
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import orjson
+from sqlalchemy import text
+
+from app.config.database import async_engine
+from db_config_parser import get_jobs_config
+
+logger = logging.getLogger(__name__)
+
+# Jobs are kept in the apijob table (see app/config/schema.py) rather than in memory,
+# so their status can be polled from any worker and survives a restart.
+# A job runs in the worker that created it, which marks it as alive every HEARTBEAT_INTERVAL seconds.
+# Unfinished jobs without a heartbeat for ABANDONED_AFTER seconds were lost with their worker.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+HEARTBEAT_INTERVAL = 60
+ABANDONED_AFTER = 5 * 60
+
+
+async def create_job(kind, params=None, progress=None):
+    """
+    Register a new queued job, run by this worker.
+
+    :param kind: type of job, e.g. update-metadata
+    :param params: parameters of the job, shown with its status
+    :param progress: initial progress
+    :return: job id
+    """
+    job_id = uuid.uuid4().hex
+    async with async_engine.begin() as conn:
+        await conn.execute(text("""INSERT INTO apijob (id, kind, status, params, progress, created_at,
+                                                       owner, heartbeat_at)
+                                   VALUES (:id, :kind, 'queued', CAST(:params AS jsonb), CAST(:progress AS jsonb),
+                                           now(), :owner, now())"""),
+                           {"id": job_id, "kind": kind, "params": orjson.dumps(params or {}).decode(),
+                            "progress": orjson.dumps(progress).decode() if progress is not None else None,
+                            "owner": WORKER_ID})
+    return job_id
+
+
+async def update_job(job_id, status=None, progress=None, result=None, error=None):
+    """
+    Update the fields of a job that are given. Moving to running or to a final status sets the timestamps.
+    """
+    values = {"id": job_id}
+    assignments = []
+    if status is not None:
+        values["status"] = status
+        assignments.append("status = :status")
+        if status == "running":
+            assignments.append("started_at = now()")
+        elif status in ("completed", "failed"):
+            assignments.append("finished_at = now()")
+    if progress is not None:
+        values["progress"] = orjson.dumps(progress).decode()
+        assignments.append("progress = CAST(:progress AS jsonb)")
+    if result is not None:
+        values["result"] = orjson.dumps(result).decode()
+        assignments.append("result = CAST(:result AS jsonb)")
+    if error is not None:
+        values["error"] = str(error)
+        assignments.append("error = :error")
+    if not assignments:
+        return
+    try:
+        async with async_engine.begin() as conn:
+            await conn.execute(text(f"UPDATE apijob SET {', '.join(assignments)} WHERE id = :id"), values)
+    except Exception as e:
+        # a failed status update shouldn't kill the job itself
+        logger.error(f"Could not update job {job_id}: {e}")
+
+
+async def get_job(job_id):
+    """
+    :param job_id: job id
+    :return: the job as a dictionary, or None if there is no such job
+    """
+    async with async_engine.connect() as conn:
+        result = await conn.execute(text("""SELECT id, kind, status, params, progress, result, error,
+                                                   created_at, started_at, finished_at
+                                            FROM apijob WHERE id = :id"""), {"id": job_id})
+        row = result.mappings().first()
+    return dict(row) if row is not None else None
+
+
+async def fail_abandoned_jobs():
+    """
+    Mark the queued and running jobs whose worker stopped, e.g. in a restart, as failed. Called at startup.
+    Failures are logged, not raised.
+    """
+    try:
+        async with async_engine.begin() as conn:
+            result = await conn.execute(text("""UPDATE apijob
+                SET status = 'failed', finished_at = now(), error = 'The worker running the job stopped'
+                WHERE status IN ('queued', 'running')
+                AND (heartbeat_at IS NULL OR heartbeat_at < now() - make_interval(secs => :abandoned_after))
+                RETURNING id"""), {"abandoned_after": ABANDONED_AFTER})
+            abandoned = [row[0] for row in result]
+        if abandoned:
+            logger.warning(f"Marked abandoned jobs as failed: {abandoned}")
+    except Exception as e:
+        logger.error(f"Could not check for abandoned jobs: {e}")
+
+
+async def heartbeat_jobs():
+    """
+    Mark the unfinished jobs of this worker as alive until cancelled.
+    """
+    while True:
+        try:
+            async with async_engine.begin() as conn:
+                await conn.execute(text("""UPDATE apijob SET heartbeat_at = now()
+                                           WHERE owner = :owner AND status IN ('queued', 'running')"""),
+                                   {"owner": WORKER_ID})
+        except Exception as e:
+            logger.error(f"Could not update the job heartbeat: {e}")
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+_heartbeat_task = None
+
+
+def start_job_heartbeat():
+    global _heartbeat_task
+    _heartbeat_task = asyncio.create_task(heartbeat_jobs())
+
+
+def stop_job_heartbeat():
+    if _heartbeat_task is not None:
+        _heartbeat_task.cancel()
+
+
+def _lower_priority():
+    # parse workers yield the CPU to the API workers serving reads
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+
+
+class ProcessJobQueue:
+    """
+    Runs job functions in a process pool, at most max_workers at a time and at most max_queued waiting for a worker.
+    Workers are spawned rather than forked so they don't inherit the API's pooled database connections.
+    A job first reserves its place with reserve(), in the same step as the check, then run() gives it back.
+    """
+    def __init__(self, max_workers, max_queued):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.pending = 0
+        self._executor = None
+        self._slots = None
+
+    def full(self):
+        return self.pending >= self.max_workers + self.max_queued
+
+    def reserve(self):
+        """
+        Take a place in the queue, False if it is full. Call release() if the job doesn't get to run().
+        """
+        if self.full():
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        self.pending -= 1
+
+    async def run(self, job_id, fn, *args):
+        """
+        Wait for a free worker, mark the job as running and return the result of fn(*args) from the pool.
+        The job must have reserved its place, which is released when it finishes.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_lower_priority)
+            self._slots = asyncio.Semaphore(self.max_workers)
+        try:
+            async with self._slots:
+                await update_job(job_id, status="running", progress={"stage": "running"})
+                return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+jobs_config = get_jobs_config()
+parse_queue = ProcessJobQueue(jobs_config["parse_workers"], jobs_config["parse_queue_size"])
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RetryableResponse(Exception):
+    pass
+
+
+class RateLimiter:
+    """
+    Spaces out request starts so that at most rate requests are started per second.
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next_start - now
+            self._next_start = max(now, self._next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class HostLimits:
+    """
+    The semaphore and rate limiter of each external host, shared by every fetcher using the same HostLimits
+    so the configured limits hold however many fetchers run at the same time.
+    """
+    def __init__(self):
+        self._limits = {}
+
+    def get(self, host, config):
+        if host not in self._limits:
+            self._limits[host] = (asyncio.Semaphore(config["concurrency"]), RateLimiter(config["rate_limit"]))
+        return self._limits[host]
+
+
+# limits of this process, used by default
+host_limits = HostLimits()
+
+
+class MetadataFetcher:
+    """
+    Concurrent GET-JSON client for the external metadata APIs.
+    One connection-reusing client, at most `concurrency` requests in flight and `rate_limit` requests per second
+    to each host across all fetchers of the process, and `retries` retries with exponential backoff
+    on connection errors, 429 and 5xx responses.
+    Use as an async context manager. Settings come from get_external_api_config().
+
+    :param transport: httpx transport, e.g. an httpx.MockTransport standing in for the external APIs in tests
+    :param limits: HostLimits to share, host_limits by default
+    """
+    def __init__(self, config, transport=None, limits=None):
+        self.config = config
+        self._transport = transport
+        self._limits = limits if limits is not None else host_limits
+        self.client = None
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(timeout=self.config["timeout"],
+                                        limits=httpx.Limits(max_connections=self.config["concurrency"]),
+                                        transport=self._transport)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.client.aclose()
+
+    async def get_json(self, url, params=None):
+        """
+        GET url and return the decoded JSON, or None for a 404.
+        Raises the last error once the retries are used up.
+        """
+        semaphore, rate_limiter = self._limits.get(httpx.URL(url).host, self.config)
+        for attempt in range(self.config["retries"] + 1):
+            try:
+                # the slot is only held for the request, not during the backoff, so a failing host isn't starved
+                async with semaphore:
+                    await rate_limiter.wait()
+                    response = await self.client.get(url, params=params)
+                if response.status_code == 404:
+                    return None
+                if response.status_code in RETRY_STATUS_CODES:
+                    raise RetryableResponse(f"{url} returned {response.status_code}")
+                response.raise_for_status()
+                return response.json()
+            except (httpx.TransportError, RetryableResponse) as error:
+                if attempt == self.config["retries"]:
+                    raise
+                delay = self.config["backoff"] * 2 ** attempt
+                logger.warning(f"{error}, retrying in {delay}s")
+                await asyncio.sleep(delay)
@@ -1,32 +1,40 @@
 import base64
 import configparser
+import time
 import traceback
 from enum import Enum
+from tempfile import SpooledTemporaryFile
 from typing import Annotated, Union
 
-from parser.api_writer import APIWriter
 from typing_extensions import Doc
 
-from fastapi import APIRouter, Depends, Query, Body
+import orjson
+from fastapi import APIRouter, Depends, Query, Body, Request, status
 from fastapi import HTTPException, Security
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from models.upload import Upload
 
-from app.routes.pride import invalidate_cache
-from app.routes.shared import get_api_key
-from db_config_parser import get_conn_str
+from app.cache import STATISTICS_TAG, invalidate_cache, invalidate_cache_from_thread, project_tag
+from app.config.database import engine, SessionLocal
+from app.ingest import COPY_SPOOL_SIZE, STAGED_TABLES, copy_csv, get_staging_table, get_table, \
+    mark_staged, publish_staged_rows
+from app.routes.pdbdev import build_residue_pairs
+from app.routes.shared import get_api_key, get_db_connection, refresh_latest_uploads
+from app.spectra import FrameReader
+from app.upload_cache import publish_upload_change, publish_upload_change_from_thread
 from index import get_session
-from sqlalchemy import Table, MetaData, create_engine
 import logging.config
 
 logger = logging.getLogger(__name__)
-writer = APIWriter(get_conn_str())
-engine = create_engine(get_conn_str())
-meta = MetaData()
 
 parser_router = APIRouter()
+SPECTRUM_BATCH_SIZE = 500
+BUNDLE_BATCH_SIZE = 1000
+# write_mzid_info parameters that are named differently in the upload table
+BUNDLE_UPLOAD_COLUMNS = {"audits": "audit_collection", "samples": "analysis_sample_collection"}
 config = configparser.ConfigParser()
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
@@ -47,10 +55,22 @@ class TableNamesEnum(str, Enum):
     projectsubdetail = "projectsubdetail"
 
 
+# database table of the TableNamesEnum members that aren't named after theirs
+TABLE_NAMES = {TableNamesEnum.analysiscollection: "analysiscollectionspectrumidentification"}
+
+
+def db_table_name(table):
+    """
+    The name of a TableNamesEnum member's database table.
+    """
+    return TABLE_NAMES.get(table, table.name)
+
+
 @parser_router.post("/write_data", tags=["Parser"], response_model=None)
 async def write_data(
         table: TableNamesEnum = Body(..., description="table name", embeded=True),
         data=Body(..., description="table data", embeded=True),
+        staged: bool = Query(default=False, description="write to the staging table, see /publish"),
         api_key: str = Security(get_api_key),
         session: Session = Depends(get_session)) -> None:
     """
@@ -60,40 +80,316 @@ async def write_data(
         :param api_key:
         :param table: (str) Table name
         :param data: (list dict) data to insert.
+        :param staged: write to the table's staging table
         """
+    check_stageable(table, staged)
     try:
-        if table == TableNamesEnum.spectrum:
-            print("spectrum table")
-            i = 0
-            for spectra in data:
-                spectra["mz"] = base64.b64decode(spectra["mz"])
-                spectra["intensity"] = base64.b64decode(spectra["intensity"])
-                data[i] = spectra
-                i += 1
-
-        table = Table(table.name, meta, autoload_with=engine)
-        with engine.connect() as conn:
-            statement = table.insert().values(data)
-            result = conn.execute(statement)
-            conn.commit()
-            conn.close()
-        # invalidate_cache()
-        logger.info("Invalidated Cache")
+        await run_in_threadpool(insert_rows, table, staged, data)
+        if not staged and data:
+            project_id = await run_in_threadpool(get_upload_project, session, data[0]["upload_id"])
+            await invalidate_cache(project_tag(project_id))
         return None
 
     except Exception as e:
-        print(f"Caught an exception: {e}")
-        traceback.print_exc()
+        logger.error(f"Writing {table.name} failed: {e}")
+        logger.debug(traceback.format_exc())
     finally:
         session.close()
     return None
 
 
+def insert_rows(table, staged, data):
+    """
+    Insert the rows of write_data and commit.
+    """
+    if table == TableNamesEnum.spectrum:
+        decode_spectrum_buffers(data)
+    target = get_write_table(table, staged)
+    with engine.connect() as conn:
+        # executemany rather than one statement with every row inlined as bind parameters
+        conn.execute(target.insert(), data)
+        conn.commit()
+
+
+@parser_router.post("/copy_data", tags=["Parser"])
+async def copy_data(request: Request,
+                    table: TableNamesEnum = Query(..., description="table name"),
+                    staged: bool = Query(default=False, description="write to the staging table, see /publish"),
+                    api_key: str = Security(get_api_key)):
+    """
+    Bulk insert CSV data into a table using COPY.
+    The request body is CSV with a header line of column names, bytea values are hex encoded (\\x...).
+    The body is spooled to a temporary file as it arrives and then copied in one go.
+
+    :param request: request with the CSV body
+    :param table: (str) Table name
+    :param staged: write to the table's staging table
+    :param api_key:
+    :return: table name and number of rows inserted
+    """
+    check_stageable(table, staged)
+    with SpooledTemporaryFile(max_size=COPY_SPOOL_SIZE) as spool:
+        async for chunk in request.stream():
+            spool.write(chunk)
+        spool.seek(0)
+        connection = await run_in_threadpool(get_db_connection)
+        try:
+            target = await run_in_threadpool(get_write_table, table, staged)
+            row_count = await run_in_threadpool(copy_csv, connection, target.name, spool)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        except Exception as e:
+            logger.error(f"COPY into {table.name} failed: {e}")
+            raise HTTPException(status_code=500, detail="Internal Server Error")
+        finally:
+            # returning it to the pool resets it, a round trip to the database
+            await run_in_threadpool(connection.close)
+    # the upload's cached responses are invalidated by write_other_info or publish
+    return {"table": table.name, "rows": row_count}
+
+
+@parser_router.post("/write_spectra", tags=["Parser"])
+async def write_spectra(request: Request,
+                        staged: bool = Query(default=False, description="write to the staging table, see /publish"),
+                        api_key: str = Security(get_api_key)):
+    """
+    Insert spectra sent as a stream of binary frames, the format returned by /data/get_peaklists.
+    Each frame is a little-endian uint32 header length, a JSON header with the spectrum's columns
+    (id, spectra_data_ref, upload_id, ...) plus mz_length and intensity_length, and then the raw float64
+    mz and intensity buffers, which are stored as they are.
+    Spectra are inserted in batches, all in one transaction.
+
+    :param request: request with the frames as body
+    :param staged: write to the staging table of spectrum
+    :param api_key:
+    :return: number of spectra inserted
+    """
+    spectrum = await run_in_threadpool(get_write_table, TableNamesEnum.spectrum, staged)
+    reader = FrameReader()
+    batch = []
+    row_count = 0
+    try:
+        # connecting can wait for the pool, so it happens in the threadpool like every statement
+        conn = await run_in_threadpool(engine.connect)
+        try:
+            async for chunk in request.stream():
+                for header, mz, intensity in reader.feed(chunk):
+                    batch.append(spectrum_row(spectrum, header, mz, intensity))
+                if len(batch) >= SPECTRUM_BATCH_SIZE:
+                    await run_in_threadpool(conn.execute, spectrum.insert(), batch)
+                    row_count += len(batch)
+                    batch = []
+            reader.close()
+            if batch:
+                await run_in_threadpool(conn.execute, spectrum.insert(), batch)
+                row_count += len(batch)
+            await run_in_threadpool(conn.commit)
+        finally:
+            # closing rolls back an uncommitted transaction
+            await run_in_threadpool(conn.close)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        logger.error(f"Writing spectra failed: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    # the upload's cached responses are invalidated by write_other_info or publish
+    return {"rows": row_count}
+
+
+def spectrum_row(spectrum, header, mz, intensity):
+    """
+    Spectrum row from a frame, raises ValueError if the header has columns the spectrum table doesn't.
+    """
+    row = {column: value for column, value in header.items()
+           if column not in ("mz_length", "intensity_length")}
+    unknown = [column for column in row if column not in spectrum.columns]
+    if unknown:
+        raise ValueError(f"Unknown columns for table spectrum: {unknown}")
+    row["mz"] = mz
+    row["intensity"] = intensity
+    return row
+
+
+@parser_router.post("/write_upload_bundle", tags=["Parser"])
+async def write_upload_bundle(request: Request, api_key: str = Security(get_api_key)):
+    """
+    Write a whole upload from one streamed NDJSON bundle, in a single transaction.
+    Every line is a JSON object with a section:
+    {"section": "upload", "data": {...}} - first line, the fields of write_new_upload
+    {"section": "<table name>", "rows": [...]} - rows of a table as for write_data, without upload_id
+    {"section": "mzid_info", "data": {...}} - the fields of write_mzid_info
+    {"section": "other_info", "data": {...}} - the fields of write_other_info
+    Rows are inserted in batches as the bundle arrives, then latest uploads and residue pairs are updated.
+
+    :param request: request with the bundle as body
+    :param api_key:
+    :return: upload id, and row count and seconds spent inserting per table
+    """
+    tables = {}
+    batch = []
+    batch_table = None
+    upload_id = None
+    project_id = None
+    upload_info = {}
+    start = time.monotonic()
+
+    def insert_batch(session, table_name, rows):
+        table_start = time.monotonic()
+        session.execute(get_table(table_name).insert(), rows)
+        table_stats = tables.setdefault(table_name, {"rows": 0, "seconds": 0.0})
+        table_stats["rows"] += len(rows)
+        table_stats["seconds"] += time.monotonic() - table_start
+
+    try:
+        with SessionLocal() as session:
+            async for line in ndjson_lines(request):
+                section = line.get("section")
+                if upload_id is None:
+                    if section != "upload":
+                        raise ValueError("The bundle has to start with the upload section")
+                    project_id = line["data"]["project_id"]
+                    upload_id = await run_in_threadpool(add_upload, session, line["data"])
+                elif section in ("mzid_info", "other_info"):
+                    upload_info.update(bundle_upload_info(get_table(TableNamesEnum.upload.name), line["data"]))
+                elif section in TableNamesEnum.__members__ and section != TableNamesEnum.upload.name:
+                    table_name = db_table_name(TableNamesEnum[section])
+                    if table_name != batch_table and batch:
+                        await run_in_threadpool(insert_batch, session, batch_table, batch)
+                        batch = []
+                    batch_table = table_name
+                    rows = line["rows"]
+                    if section == TableNamesEnum.spectrum.name:
+                        decode_spectrum_buffers(rows)
+                    for row in rows:
+                        row["upload_id"] = upload_id
+                    batch.extend(rows)
+                    if len(batch) >= BUNDLE_BATCH_SIZE:
+                        await run_in_threadpool(insert_batch, session, batch_table, batch)
+                        batch = []
+                else:
+                    raise ValueError(f"Unknown bundle section: {section}")
+            if upload_id is None:
+                raise ValueError("Empty bundle")
+            if batch:
+                await run_in_threadpool(insert_batch, session, batch_table, batch)
+            await run_in_threadpool(finish_upload, session, upload_id, project_id, upload_info)
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid bundle: {e}")
+    except Exception as e:
+        logger.error(f"Writing upload bundle failed: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    for table_stats in tables.values():
+        table_stats["seconds"] = round(table_stats["seconds"], 3)
+    await publish_upload_change(project_id)
+    await invalidate_cache(project_tag(project_id), STATISTICS_TAG)
+    return {"upload_id": upload_id, "tables": tables, "seconds": round(time.monotonic() - start, 3)}
+
+
+async def ndjson_lines(request):
+    """
+    Decode the request body line by line as it arrives, skipping blank lines.
+    """
+    buffer = bytearray()
+    async for chunk in request.stream():
+        # only the new chunk is searched, the rest of the buffer has no line end
+        searched = len(buffer)
+        start = 0
+        buffer += chunk
+        end = buffer.find(b"\n", searched)
+        while end != -1:
+            line = buffer[start:end]
+            if line.strip():
+                yield orjson.loads(line)
+            start = end + 1
+            end = buffer.find(b"\n", start)
+        del buffer[:start]
+    if buffer.strip():
+        yield orjson.loads(buffer)
+
+
+def bundle_upload_info(upload, data):
+    """
+    The upload columns to set from the data of a mzid_info or other_info section,
+    raises ValueError if it has fields the upload table doesn't.
+    """
+    upload_info = {BUNDLE_UPLOAD_COLUMNS.get(key, key): value for key, value in data.items()}
+    unknown = [column for column in upload_info if column not in upload.columns or column == "id"]
+    if unknown:
+        raise ValueError(f"Unknown columns for table upload: {unknown}")
+    return upload_info
+
+
+def add_upload(session, data):
+    """
+    Add an Upload row as write_new_upload does, without committing.
+    :return: the new upload id
+    """
+    new_upload = Upload(
+        identification_file_name=data['identification_file_name'],
+        identification_file_name_clean=data['identification_file_name_clean'],
+        project_id=data['project_id']
+    )
+    session.add(new_upload)
+    session.flush()
+    return new_upload.id
+
+
+def finish_upload(session, upload_id, project_id, upload_info):
+    """
+    Store the mzid and other info of a bundle's upload, make it the latest upload, build its residue pairs and commit.
+    """
+    if upload_info:
+        upload = get_table(TableNamesEnum.upload.name)
+        session.execute(upload.update().where(upload.c.id == upload_id).values(**upload_info))
+    refresh_latest_uploads(session, project_id)
+    build_residue_pairs(session, [upload_id])
+    session.commit()
+
+
+def get_upload_project(session, upload_id):
+    """
+    :return: project id of an upload
+    """
+    return session.query(Upload.project_id).filter(Upload.id == upload_id).scalar()
+
+
+def check_stageable(table, staged):
+    """
+    Raise a 400 if staged writes were asked for a table that has no staging table.
+    """
+    if staged and db_table_name(table) not in STAGED_TABLES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Table {table.name} can't be written staged")
+
+
+def get_write_table(table, staged):
+    """
+    The reflected table to insert into, its staging table for staged writes.
+    """
+    if staged:
+        return get_staging_table(db_table_name(table))
+    return get_table(db_table_name(table))
+
+
+def decode_spectrum_buffers(rows):
+    """
+    Decode the base64 mz and intensity of spectrum rows in place.
+    """
+    for spectra in rows:
+        spectra["mz"] = base64.b64decode(spectra["mz"])
+        spectra["intensity"] = base64.b64decode(spectra["intensity"])
+
+
 @parser_router.post("/write_new_upload", tags=["Parser"])
 def write_new_upload(
         data: dict = Body(..., description="table data", embeded=True),
+        staged: bool = Query(default=False, description="keep the upload hidden until /publish"),
         api_key: str = Security(get_api_key),
         session: Session = Depends(get_session)):
+    """
+    Add an Upload row and return its id.
+    A staged upload doesn't become the latest upload of its file until it is published.
+    """
     try:
         print("called write_new_upload!!!")
         new_upload = Upload(
@@ -102,8 +398,16 @@ def write_new_upload(
             project_id=data['project_id']
         )
         session.add(new_upload)
+        session.flush()
+        if staged:
+            mark_staged(session, new_upload.id)
+        else:
+            refresh_latest_uploads(session, new_upload.project_id)
         session.commit()
         session.close()
+        if not staged:
+            publish_upload_change_from_thread(new_upload.project_id)
+            invalidate_cache_from_thread(project_tag(new_upload.project_id), STATISTICS_TAG)
         return new_upload.id
     except Exception as e:
         print(f"Error: {e}")
@@ -133,7 +437,7 @@ def write_mzid_info(analysis_software_list=Body(..., embeded=True),
     :param bib:
     :return:
     """
-    upload = Table(TableNamesEnum.upload.name, meta, autoload_with=engine, quote=False)
+    upload = get_table(TableNamesEnum.upload.name)
     stmt = upload.update().where(upload.c.id == str(upload_id)).values(
         analysis_software_list=analysis_software_list,
         spectra_formats=spectra_formats,
@@ -151,6 +455,7 @@ def write_mzid_info(analysis_software_list=Body(..., embeded=True),
 def write_other_info(contains_crosslinks=Body(..., description="contains_crosslinks", embeded=True),
                      upload_warnings=Body(..., description="upload_warnings", embeded=True),
                      upload_id: int = None,
+                     staged: bool = Query(default=False, description="the upload is published later"),
                      api_key: str = Security(get_api_key),
                      session: Session = Depends(get_session)):
     """
@@ -161,10 +466,11 @@ def write_other_info(contains_crosslinks=Body(..., description="contains_crossli
     :param api_key:
     :param contains_crosslinks:
     :param upload_warnings:
+    :param staged: the upload was written staged, its residue pairs are built by /publish
     :return:
     """
 
-    upload = Table(TableNamesEnum.upload.name, meta, autoload_with=engine, quote=False)
+    upload = get_table(TableNamesEnum.upload.name)
     with engine.connect() as conn:
         stmt = upload.update().where(upload.c.id == str(upload_id)).values(
             contains_crosslinks=contains_crosslinks,
@@ -172,3 +478,40 @@ def write_other_info(contains_crosslinks=Body(..., description="contains_crossli
         )
         conn.execute(stmt)
         conn.commit()
+
+    # this is the last call of an upload, so its data is complete and the residue pairs can be built
+    if not staged:
+        build_residue_pairs(session, [upload_id])
+        session.commit()
+        invalidate_cache_from_thread(project_tag(get_upload_project(session, upload_id)))
+
+
+@parser_router.post("/publish/{upload_id}", tags=["Parser"])
+def publish(upload_id: int,
+            api_key: str = Security(get_api_key),
+            session: Session = Depends(get_session)):
+    """
+    Publish an upload written staged: move its rows from the staging tables into the real tables,
+    make it the latest upload of its file and build its residue pairs, all in one transaction,
+    so readers see either none or all of the upload.
+
+    :param upload_id:
+    :param api_key:
+    :param session:
+    :return: number of rows published per table
+    """
+    project_id = session.query(Upload.project_id).filter(Upload.id == upload_id).scalar()
+    if project_id is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+    try:
+        counts = publish_staged_rows(session, upload_id)
+        refresh_latest_uploads(session, project_id)
+        build_residue_pairs(session, [upload_id])
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Publishing upload {upload_id} failed: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    publish_upload_change_from_thread(project_id)
+    invalidate_cache_from_thread(project_tag(project_id), STATISTICS_TAG)
+    return {"upload_id": upload_id, "tables": counts}
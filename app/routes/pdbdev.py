@@ -1,12 +1,14 @@
+import asyncio
+import base64
 import json
 import math
+from collections import OrderedDict
 from math import ceil
 
-import psycopg2
-from fastapi import APIRouter, Depends, Path, Response, Query
+import psycopg
+from fastapi import APIRouter, Depends, HTTPException, Path, Request, Response, Query, Security, status
 import orjson
 from fastapi import APIRouter, Depends
-from psycopg2.extras import RealDictCursor
 import logging
 from sqlalchemy import text
 from sqlalchemy.orm import Session
@@ -15,12 +17,18 @@ from typing import List
 from enum import Enum
 from typing import Annotated
 
-from app.routes.shared import get_db_connection, get_most_recent_upload_ids
+from app.config.database import async_engine
+from app.etag import etag_matches, not_modified, uploads_etag
+from app.singleflight import single_flight
+from app.routes.shared import get_api_key, get_db_cursor, get_most_recent_upload_ids, get_most_recent_uploads
 
 pdbdev_router = APIRouter()
 
 app_logger = logging.getLogger(__name__)
 
+# seconds a client is asked to wait while the residue pairs of a project are built
+RESIDUE_PAIR_RETRY_AFTER = 30
+
 
 @pdbdev_router.get("/projects/{protein_id}", response_model=List[str], tags=["PDB-Dev"])
 async def get_projects_by_protein(protein_id: str, session: Session = Depends(get_session)):
@@ -41,42 +49,45 @@ async def get_projects_by_protein(protein_id: str, session: Session = Depends(ge
 
 
 @pdbdev_router.get('/projects/{project_id}/sequences', tags=["PDB-Dev"])
-async def sequences(project_id):
+async def sequences(project_id, request: Request, response: Response):
     """
     Get all sequences belonging to a project.
+    Supports conditional requests with ETag / If-None-Match once the data of the uploads is complete.
 
     :param project_id: identifier of a project,
         for ProteomeXchange projects this is the PXD****** accession
     :return: JSON object with all dbref id, mzIdentML file it came from and sequences
     """
 
-    most_recent_upload_ids = await get_most_recent_upload_ids(project_id)
+    most_recent_uploads = await get_most_recent_uploads(project_id)
+    most_recent_upload_ids = [upload["id"] for upload in most_recent_uploads or []]
+    builds = await get_residue_pair_builds(most_recent_upload_ids)
+    etag = uploads_etag(most_recent_uploads, builds, project_id, "sequences")
+    if etag_matches(request, etag):
+        return not_modified(etag)
 
-    conn = None
     mzid_rows = []
     try:
-        # connect to the PostgreSQL server and create a cursor
-        conn = await get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-
-        sql = """SELECT dbseq.id, u.identification_file_name  as file, dbseq.sequence, dbseq.accession
-                    FROM upload AS u
-                    JOIN dbsequence AS dbseq ON u.id = dbseq.upload_id
-                    INNER JOIN peptideevidence pe ON dbseq.id = pe.dbsequence_ref AND dbseq.upload_id = pe.upload_id
-                 WHERE u.id = ANY (%s)
-                 AND pe.is_decoy = false
-                 GROUP by dbseq.id, dbseq.sequence, dbseq.accession, u.identification_file_name;"""
-        cur.execute(sql, [most_recent_upload_ids])
-        mzid_rows = cur.fetchall()
-
-        print("finished")
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
-            print('Database connection closed.')
-        return {"data": mzid_rows}
+        # borrow a pooled connection and create a cursor
+        async with get_db_cursor() as cur:
+            sql = """SELECT dbseq.id, u.identification_file_name  as file, dbseq.sequence, dbseq.accession
+                        FROM upload AS u
+                        JOIN dbsequence AS dbseq ON u.id = dbseq.upload_id
+                        INNER JOIN peptideevidence pe ON dbseq.id = pe.dbsequence_ref AND dbseq.upload_id = pe.upload_id
+                     WHERE u.id = ANY (%s)
+                     AND pe.is_decoy = false
+                     GROUP by dbseq.id, dbseq.sequence, dbseq.accession, u.identification_file_name;"""
+            await cur.execute(sql, [most_recent_upload_ids])
+            mzid_rows = await cur.fetchall()
+    except (Exception, psycopg.DatabaseError) as error:
+        app_logger.error(error)
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    # only set on success, an error response must not be cached under the ETag
+    if etag is not None:
+        response.headers["ETag"] = etag
+    else:
+        response.headers["Cache-Control"] = "no-store"
+    return {"data": mzid_rows}
 
 
 class Threshold(str, Enum):
@@ -93,7 +104,8 @@ class Threshold(str, Enum):
 
 @pdbdev_router.get('/projects/{project_id}/residue-pairs/based-on-reported-psm-level/{passing_threshold}',
                    tags=["PDB-Dev"])
-async def get_psm_level_residue_pairs(project_id: Annotated[str, Path(...,
+async def get_psm_level_residue_pairs(request: Request,
+                                      project_id: Annotated[str, Path(...,
                                                                       title="Project ID",
                                                                       pattern="^PXD\d{6}$",
                                                                       example="PXD019437")],
@@ -112,6 +124,8 @@ async def get_psm_level_residue_pairs(project_id: Annotated[str, Path(...,
                                                                                    })],
                                       page: int = Query(1, description="Page number"),
                                       page_size: int = Query(10, gt=5, lt=10000, description="Number of items per page"),
+                                      cursor: str | None = Query(None, description="next_cursor of the previous page, "
+                                                                                   "takes precedence over page"),
                                       ):
     """
     Get all residue pairs (based on PSM level data) belonging to a project.
@@ -123,124 +137,328 @@ async def get_psm_level_residue_pairs(project_id: Annotated[str, Path(...,
     :param passing_threshold: valid values: passing, all
         if 'passing' return residue pairs that passed the threshold
         if 'all' return all residue pairs
-    :return:
+    :param page: page number, deep pages are cheaper to reach with cursor
+    :param page_size: number of residue pairs per page
+    :param cursor: opaque position returned as next_cursor, the page starts after it
+    :return: the page, with an ETag for conditional requests (If-None-Match),
+        503 with Retry-After while the residue pairs of the project are being built
     """
     if not Threshold.is_valid_enum(passing_threshold):
         return f"Invalid value for passing_threshold: {passing_threshold}. " \
                f"Valid values are: passing, all", 400
+    after = decode_residue_pair_cursor(cursor) if cursor else None
+
+    most_recent_uploads = await get_most_recent_uploads(project_id)
+    most_recent_upload_ids = [upload["id"] for upload in most_recent_uploads or []]
+    builds = await get_residue_pair_builds(most_recent_upload_ids)
+    unbuilt = [upload_id for upload_id in most_recent_upload_ids if upload_id not in builds]
+    if unbuilt:
+        # e.g. data loaded before the residuepair table existed, built in the background rather than in this request
+        start_residue_pair_build(unbuilt)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="The residue pairs of this project are being built, try again later",
+                            headers={"Retry-After": str(RESIDUE_PAIR_RETRY_AFTER)})
+
+    etag = uploads_etag(most_recent_uploads, builds, project_id, "residue-pairs",
+                        passing_threshold, page, page_size, cursor)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    # the build times version the data, a rebuilt upload gets new keys and a new ETag
+    build_version = tuple(builds[upload_id] for upload_id in most_recent_upload_ids)
+    # identical concurrent requests share one query and serialisation
+    key = ("residue_pairs", tuple(most_recent_upload_ids), build_version, passing_threshold, page, page_size, cursor)
+    body = await single_flight.do(key, get_residue_pairs_page, most_recent_upload_ids, build_version,
+                                  passing_threshold, page, page_size, after)
+    return Response(body, media_type='application/json', headers={"ETag": etag})
+
+
+async def get_residue_pairs_page(most_recent_upload_ids, build_version, passing_threshold, page, page_size, after):
+    """
+    One page of residue pairs of the given uploads as JSON, see get_psm_level_residue_pairs.
 
-    most_recent_upload_ids = await get_most_recent_upload_ids(project_id)
-    response = {}
-    conn = None
+    :param build_version: built_at of each upload, part of the key of the cached total
+    :param after: decoded cursor, the page starts after it
+    :raises HTTPException: 500 if the page can't be read, rather than an empty page that would get the ETag
+    """
     data = {}
     try:
-        # connect to the PostgreSQL server and create a cursor
-        conn = await get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-
-        sql_values = {
-            "upload_ids": tuple(upload_id[0] for upload_id in most_recent_upload_ids),
-            "limit": page_size,
-            "offset": (page - 1) * page_size
-        }
-
-        if passing_threshold.lower() == Threshold.passing:
-            sql = """SELECT array_agg(si.id) as match_ids, array_agg(u.identification_file_name) as files, 
-            pe1.dbsequence_ref as prot1, dbs1.accession as prot1_acc, (pe1.pep_start + mp1.link_site1 - 1) as pos1,
-            pe2.dbsequence_ref as prot2, dbs2.accession as prot2_acc, (pe2.pep_start + mp2.link_site1 - 1) as pos2
-            FROM spectrumidentification si INNER JOIN
-            modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id INNER JOIN
-            peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id INNER JOIN
-            dbsequence dbs1 ON pe1.dbsequence_ref = dbs1.id AND pe1.upload_id = dbs1.upload_id INNER JOIN
-            modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id INNER JOIN
-            peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id INNER JOIN
-            dbsequence dbs2 ON pe2.dbsequence_ref = dbs2.id AND pe2.upload_id = dbs2.upload_id INNER JOIN
-            upload u on u.id = si.upload_id
-            WHERE u.id IN %(upload_ids)s AND mp1.link_site1 > 0 AND mp2.link_site1 > 0 AND pe1.is_decoy = false AND pe2.is_decoy = false
-            AND si.pass_threshold = true
-            GROUP BY pe1.dbsequence_ref , dbs1.accession, (pe1.pep_start + mp1.link_site1 - 1), pe2.dbsequence_ref, dbs2.accession , (pe2.pep_start + mp2.link_site1 - 1)
-            ORDER BY pe1.dbsequence_ref , (pe1.pep_start + mp1.link_site1 - 1), pe2.dbsequence_ref, (pe2.pep_start + mp2.link_site1 - 1)
-            LIMIT %(limit)s OFFSET %(offset)s;"""
-        else:
-            sql = """SELECT array_agg(si.id) as match_ids, array_agg(u.identification_file_name) as files,
-            pe1.dbsequence_ref as prot1, dbs1.accession as prot1_acc, (pe1.pep_start + mp1.link_site1 - 1) as pos1,
-            pe2.dbsequence_ref as prot2, dbs2.accession as prot2_acc, (pe2.pep_start + mp2.link_site1 - 1) as pos2
-            FROM spectrumidentification si INNER JOIN
-            modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id INNER JOIN
-            peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id INNER JOIN
-            dbsequence dbs1 ON pe1.dbsequence_ref = dbs1.id AND pe1.upload_id = dbs1.upload_id INNER JOIN
-            modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id INNER JOIN
-            peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id INNER JOIN
-            dbsequence dbs2 ON pe2.dbsequence_ref = dbs2.id AND pe2.upload_id = dbs2.upload_id INNER JOIN
-            upload u on u.id = si.upload_id
-            WHERE u.id IN %(upload_ids)s AND mp1.link_site1 > 0 AND mp2.link_site1 > 0 AND pe1.is_decoy = false AND pe2.is_decoy = false
-            GROUP BY pe1.dbsequence_ref , dbs1.accession, (pe1.pep_start + mp1.link_site1 - 1), pe2.dbsequence_ref, dbs2.accession , (pe2.pep_start + mp2.link_site1 - 1)
-            ORDER BY pe1.dbsequence_ref , (pe1.pep_start + mp1.link_site1 - 1), pe2.dbsequence_ref, (pe2.pep_start + mp2.link_site1 - 1)
-            LIMIT %(limit)s OFFSET %(offset)s;"""
-
-        if passing_threshold.lower() == Threshold.passing:
-            count_sql = """SELECT count(*) FROM (SELECT array_agg(si.id) as match_ids, array_agg(u.identification_file_name) as files, 
-            pe1.dbsequence_ref as prot1, dbs1.accession as prot1_acc, (pe1.pep_start + mp1.link_site1 - 1) as pos1,
-            pe2.dbsequence_ref as prot2, dbs2.accession as prot2_acc, (pe2.pep_start + mp2.link_site1 - 1) as pos2
-            FROM spectrumidentification si INNER JOIN
-            modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id INNER JOIN
-            peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id INNER JOIN
-            dbsequence dbs1 ON pe1.dbsequence_ref = dbs1.id AND pe1.upload_id = dbs1.upload_id INNER JOIN
-            modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id INNER JOIN
-            peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id INNER JOIN
-            dbsequence dbs2 ON pe2.dbsequence_ref = dbs2.id AND pe2.upload_id = dbs2.upload_id INNER JOIN
-            upload u on u.id = si.upload_id
-            WHERE u.id IN %(upload_ids)s AND mp1.link_site1 > 0 AND mp2.link_site1 > 0 AND pe1.is_decoy = false AND pe2.is_decoy = false
-            AND si.pass_threshold = true
-            GROUP BY pe1.dbsequence_ref , dbs1.accession, (pe1.pep_start + mp1.link_site1 - 1), pe2.dbsequence_ref, dbs2.accession , (pe2.pep_start + mp2.link_site1 - 1)
+        # borrow a pooled connection and create a cursor
+        async with get_db_cursor() as cur:
+            passing_only = passing_threshold.lower() == Threshold.passing
+            sql_values = {
+                "upload_ids": most_recent_upload_ids,
+                "passing_only": passing_only,
+                "limit": page_size,
+                "offset": 0 if after else (page - 1) * page_size,
+            }
+
+            # keyset pagination: the (ordered, unique) pair key of the last row of the previous page.
+            # The page's pair keys are read per upload from residuepair_upload_page_idx, in key order and stopping
+            # after offset + limit keys, so a page reached by cursor costs the same however deep it is.
+            # An upload has a passing and a non-passing row for a key with both kinds of matches,
+            # so the keys are made distinct per upload before the limit.
+            # Only the pairs of the page are then unnested and grouped.
+            keyset_condition = ""
+            if after:
+                sql_values.update(zip(("after_prot1", "after_pos1", "after_prot2", "after_pos2",
+                                       "after_prot1_acc", "after_prot2_acc"), after))
+                keyset_condition = """AND (rp.prot1, rp.pos1, rp.prot2, rp.pos2,
+                coalesce(rp.prot1_acc, ''), coalesce(rp.prot2_acc, '')) >
+                (%(after_prot1)s, %(after_pos1)s, %(after_prot2)s, %(after_pos2)s,
+                %(after_prot1_acc)s, %(after_prot2_acc)s)"""
+            sql_values["per_upload_limit"] = sql_values["offset"] + sql_values["limit"]
+
+            sql = f"""WITH page AS (
+                SELECT DISTINCT k.prot1, k.pos1, k.prot2, k.pos2, k.prot1_acc, k.prot2_acc
+                FROM unnest(CAST(%(upload_ids)s AS integer[])) AS u(upload_id) CROSS JOIN LATERAL (
+                    SELECT DISTINCT rp.prot1, rp.pos1, rp.prot2, rp.pos2,
+                    coalesce(rp.prot1_acc, '') AS prot1_acc, coalesce(rp.prot2_acc, '') AS prot2_acc
+                    FROM residuepair rp
+                    WHERE rp.upload_id = u.upload_id AND (rp.passing OR NOT %(passing_only)s)
+                    {keyset_condition}
+                    ORDER BY rp.prot1, rp.pos1, rp.prot2, rp.pos2, prot1_acc, prot2_acc
+                    LIMIT %(per_upload_limit)s
+                ) AS k
+                ORDER BY k.prot1, k.pos1, k.prot2, k.pos2, k.prot1_acc, k.prot2_acc
+                LIMIT %(limit)s OFFSET %(offset)s
+            )
+            SELECT array_agg(m.match_id) as match_ids, array_agg(u.identification_file_name) as files,
+            rp.prot1, rp.prot1_acc, rp.pos1, rp.prot2, rp.prot2_acc, rp.pos2
+            FROM page INNER JOIN
+            residuepair rp ON rp.upload_id = ANY(%(upload_ids)s) AND (rp.passing OR NOT %(passing_only)s)
+            AND rp.prot1 = page.prot1 AND rp.pos1 = page.pos1 AND rp.prot2 = page.prot2 AND rp.pos2 = page.pos2
+            AND coalesce(rp.prot1_acc, '') = page.prot1_acc AND coalesce(rp.prot2_acc, '') = page.prot2_acc
+            INNER JOIN upload u ON u.id = rp.upload_id CROSS JOIN LATERAL
+            unnest(rp.match_ids) AS m(match_id)
+            GROUP BY rp.prot1, rp.prot1_acc, rp.pos1, rp.prot2, rp.prot2_acc, rp.pos2
+            ORDER BY rp.prot1, rp.pos1, rp.prot2, rp.pos2, coalesce(rp.prot1_acc, ''), coalesce(rp.prot2_acc, '');"""
+
+            count_sql = """SELECT count(*) FROM (SELECT DISTINCT rp.prot1, rp.prot1_acc, rp.pos1,
+            rp.prot2, rp.prot2_acc, rp.pos2
+            FROM residuepair rp
+            WHERE rp.upload_id = ANY(%(upload_ids)s) AND (rp.passing OR NOT %(passing_only)s)
             ) as count;"""
-        else:
-            count_sql = """SELECT count(*) FROM (SELECT array_agg(si.id) as match_ids, array_agg(u.identification_file_name) as files,
-            pe1.dbsequence_ref as prot1, dbs1.accession as prot1_acc, (pe1.pep_start + mp1.link_site1 - 1) as pos1,
-            pe2.dbsequence_ref as prot2, dbs2.accession as prot2_acc, (pe2.pep_start + mp2.link_site1 - 1) as pos2
+
+            await cur.execute(sql, sql_values)
+            mzid_rows = await cur.fetchall()
+            data["data"] = mzid_rows
+
+            # The total only changes with the upload set and their builds, so it is counted once per version of them
+            count_key = (tuple(sorted(zip(most_recent_upload_ids, build_version))), passing_only)
+            total_elements = residue_pair_counts.get(count_key)
+            if total_elements is None:
+                await cur.execute(count_sql, sql_values)
+                total_elements = (await cur.fetchone())["count"]
+                residue_pair_counts.put(count_key, total_elements)
+
+            # Calculate the total pages based on the page size and total elements
+            total_pages = math.ceil(total_elements / page_size)
+
+            response = {
+                "data": data["data"],
+                "page": {
+                    "page_no": page,
+                    "page_size": page_size,
+                    "total_elements": total_elements,
+                    "total_pages": total_pages,
+                    "next_cursor": encode_residue_pair_cursor(mzid_rows[-1]) if len(mzid_rows) == page_size else None
+                }
+            }
+    except (Exception, psycopg.DatabaseError) as error:
+        app_logger.error(error)
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    return orjson.dumps(response)
+
+
+@pdbdev_router.post('/projects/{project_id}/residue-pairs/rebuild', tags=["Admin"])
+async def rebuild_residue_pairs(project_id: str, api_key: str = Security(get_api_key)):
+    """
+    Rebuild the precomputed residue pairs of the most recent uploads of a project.
+
+    :param project_id: identifier of a project,
+        for ProteomeXchange projects this is the PXD****** accession
+    :param api_key: API KEY
+    :return: upload ids that were rebuilt
+    """
+    most_recent_upload_ids = await get_most_recent_upload_ids(project_id)
+    await ensure_residue_pairs(most_recent_upload_ids, rebuild=True)
+    return {"upload_ids": most_recent_upload_ids}
+
+
+# residuepair holds, per upload, every crosslinked residue pair with the ids of the matches supporting it,
+# so the residue pair endpoint doesn't have to join the identification tables on every page request.
+# residuepairbuild records which uploads have been built.
+RESIDUE_PAIR_BUILD_STATEMENTS = [
+    # serialise builds of the same upload, two concurrent builds would otherwise insert its pairs twice.
+    # The locks are taken in upload id order so builds of overlapping upload sets can't deadlock.
+    text("""SELECT pg_advisory_xact_lock(hashtext('residuepair'), upload_id)
+            FROM (SELECT DISTINCT unnest(CAST(:upload_ids AS integer[])) AS upload_id ORDER BY upload_id) AS ids"""),
+    text("DELETE FROM residuepair WHERE upload_id = ANY(:upload_ids)"),
+    text("""INSERT INTO residuepair (upload_id, prot1, prot1_acc, pos1, prot2, prot2_acc, pos2, passing, match_ids)
+            SELECT si.upload_id,
+            pe1.dbsequence_ref, dbs1.accession, (pe1.pep_start + mp1.link_site1 - 1),
+            pe2.dbsequence_ref, dbs2.accession, (pe2.pep_start + mp2.link_site1 - 1),
+            coalesce(si.pass_threshold, false), array_agg(si.id)
             FROM spectrumidentification si INNER JOIN
             modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id INNER JOIN
             peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id INNER JOIN
             dbsequence dbs1 ON pe1.dbsequence_ref = dbs1.id AND pe1.upload_id = dbs1.upload_id INNER JOIN
             modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id INNER JOIN
             peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id INNER JOIN
-            dbsequence dbs2 ON pe2.dbsequence_ref = dbs2.id AND pe2.upload_id = dbs2.upload_id INNER JOIN
-            upload u on u.id = si.upload_id
-            WHERE u.id IN %(upload_ids)s AND mp1.link_site1 > 0 AND mp2.link_site1 > 0 AND pe1.is_decoy = false AND pe2.is_decoy = false
-            GROUP BY pe1.dbsequence_ref , dbs1.accession, (pe1.pep_start + mp1.link_site1 - 1), pe2.dbsequence_ref, dbs2.accession , (pe2.pep_start + mp2.link_site1 - 1)
-            ) as count;"""
+            dbsequence dbs2 ON pe2.dbsequence_ref = dbs2.id AND pe2.upload_id = dbs2.upload_id
+            WHERE si.upload_id = ANY(:upload_ids) AND mp1.link_site1 > 0 AND mp2.link_site1 > 0
+            AND pe1.is_decoy = false AND pe2.is_decoy = false
+            GROUP BY si.upload_id, pe1.dbsequence_ref, dbs1.accession, (pe1.pep_start + mp1.link_site1 - 1),
+            pe2.dbsequence_ref, dbs2.accession, (pe2.pep_start + mp2.link_site1 - 1),
+            coalesce(si.pass_threshold, false)"""),
+    text("""INSERT INTO residuepairbuild (upload_id, built_at)
+            SELECT unnest(CAST(:upload_ids AS integer[])), now()
+            ON CONFLICT (upload_id) DO UPDATE SET built_at = now()"""),
+]
+
+
+class CountCache:
+    """
+    Small LRU map of residue pair totals keyed by (upload ids, their built_at, passing only).
+    A rebuild changes built_at, so totals are never stale in any worker and are simply left to age out.
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._counts = OrderedDict()
 
-        cur.execute(sql, sql_values)
-        mzid_rows = cur.fetchall()
-        data["data"] = mzid_rows
+    def get(self, key):
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+        return count
 
-        # Perform a COUNT query to get the total number of elements
-        cur.execute(count_sql, sql_values)
-        total_elements = cur.fetchone()["count"]
+    def put(self, key, count):
+        self._counts[key] = count
+        self._counts.move_to_end(key)
+        while len(self._counts) > self.max_size:
+            self._counts.popitem(last=False)
 
-        # Calculate the total pages based on the page size and total elements
-        total_pages = math.ceil(total_elements / page_size)
+    def clear(self):
+        self._counts.clear()
 
-        response = {
-            "data": data["data"],
-            "page": {
-                "page_no": page,
-                "page_size": page_size,
-                "total_elements": total_elements,
-                "total_pages": total_pages
-            }
-        }
 
-        print("finished")
-        # close the communication with the PostgreSQL
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
+residue_pair_counts = CountCache()
+
+
+def encode_residue_pair_cursor(row):
+    """
+    Opaque cursor pointing after the given residue pair row.
+    """
+    key = [row["prot1"], row["pos1"], row["prot2"], row["pos2"], row["prot1_acc"] or "", row["prot2_acc"] or ""]
+    return base64.urlsafe_b64encode(orjson.dumps(key)).decode()
+
+
+def decode_residue_pair_cursor(cursor):
+    """
+    Decode a cursor made by encode_residue_pair_cursor into the key tuple used in the keyset condition.
+    """
+    try:
+        prot1, pos1, prot2, pos2, prot1_acc, prot2_acc = orjson.loads(base64.urlsafe_b64decode(cursor))
+        return str(prot1), int(pos1), str(prot2), int(pos2), str(prot1_acc), str(prot2_acc)
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def build_residue_pairs(session, upload_ids):
+    """
+    (Re)build the residue pairs of the given uploads, the caller commits.
+
+    :param session: database session
+    :param upload_ids: list of upload ids
+    """
+    if not upload_ids:
+        return
+    for statement in RESIDUE_PAIR_BUILD_STATEMENTS:
+        session.execute(statement, {"upload_ids": list(upload_ids)})
+
+
+def delete_residue_pairs(session, upload_ids):
+    """
+    Remove the residue pairs of deleted uploads, the caller commits.
+
+    :param session: database session
+    :param upload_ids: list of upload ids
+    """
+    session.execute(text("DELETE FROM residuepair WHERE upload_id = ANY(:upload_ids)"),
+                    {"upload_ids": list(upload_ids)})
+    session.execute(text("DELETE FROM residuepairbuild WHERE upload_id = ANY(:upload_ids)"),
+                    {"upload_ids": list(upload_ids)})
+
+
+async def get_residue_pair_builds(upload_ids):
+    """
+    When the residue pairs of the uploads were built.
+
+    :param upload_ids: list of upload ids
+    :return: dict of upload id to built_at, uploads that haven't been built are left out
+    """
+    if not upload_ids:
+        return {}
+    check_sql = text("SELECT upload_id, built_at FROM residuepairbuild WHERE upload_id = ANY(:upload_ids)")
+    async with async_engine.connect() as conn:
+        return {row[0]: row[1] for row in await conn.execute(check_sql, {"upload_ids": list(upload_ids)})}
+
+
+async def ensure_residue_pairs(upload_ids, rebuild=False):
+    """
+    Build the residue pairs of any of the uploads that haven't been built yet, e.g. data
+    loaded before the residuepair table existed.
+
+    :param upload_ids: list of upload ids
+    :param rebuild: build all of them even if they were built before
+    """
+    if not upload_ids:
+        return
+    to_build = sorted(set(upload_ids)) if rebuild else \
+        sorted(set(upload_ids) - set(await get_residue_pair_builds(upload_ids)))
+    if not to_build:
+        return
+    check_sql = text("SELECT upload_id FROM residuepairbuild WHERE upload_id = ANY(:upload_ids)")
+    async with async_engine.begin() as conn:
+        await conn.execute(RESIDUE_PAIR_BUILD_STATEMENTS[0], {"upload_ids": to_build})
+        if not rebuild:
+            # someone else may have built them while we waited for the locks
+            built = {row[0] for row in await conn.execute(check_sql, {"upload_ids": to_build})}
+            to_build = [upload_id for upload_id in to_build if upload_id not in built]
+        if to_build:
+            app_logger.info(f"Building residue pairs for uploads {to_build}")
+            for statement in RESIDUE_PAIR_BUILD_STATEMENTS[1:]:
+                await conn.execute(statement, {"upload_ids": to_build})
+
+
+# upload id -> task building its residue pairs in this worker, see start_residue_pair_build
+residue_pair_builds = {}
+
+
+def start_residue_pair_build(upload_ids):
+    """
+    Build the residue pairs of the uploads in a background task, unless this worker is building them already.
+    Builds in other workers wait for each other on the per-upload locks, and then skip what has been built.
+
+    :param upload_ids: list of upload ids
+    """
+    pending = sorted({upload_id for upload_id in upload_ids if upload_id not in residue_pair_builds})
+    if not pending:
+        return
+    task = asyncio.create_task(build_residue_pairs_in_background(pending))
+    for upload_id in pending:
+        residue_pair_builds[upload_id] = task
+
+
+async def build_residue_pairs_in_background(upload_ids):
+    try:
+        await ensure_residue_pairs(upload_ids)
+    except Exception as error:
+        # the next request for the project starts the build again
+        app_logger.error(f"Building residue pairs for uploads {upload_ids} failed: {error}")
     finally:
-        if conn is not None:
-            conn.close()
-            print('Database connection closed.')
-    return Response(orjson.dumps(response), media_type='application/json')
+        for upload_id in upload_ids:
+            residue_pair_builds.pop(upload_id, None)
 
 
 #
@@ -1,18 +1,18 @@
+import asyncio
 import configparser
-import json
 import logging
 import logging.config
 import os
+import time
 from math import ceil
 from typing import List, Annotated, Union
 
-import redis
-import requests
 from fastapi import APIRouter, Depends, status, Query, Path
 from fastapi import HTTPException, Security
 from models.upload import Upload
-from sqlalchemy import text
+from sqlalchemy import Float, Integer, func, select, text
 from sqlalchemy.orm import Session, joinedload
+from starlette.concurrency import run_in_threadpool
 
 from models.analysiscollectionspectrumidentification import AnalysisCollectionSpectrumIdentification
 from models.dbsequence import DBSequence
@@ -25,14 +25,43 @@ from models.searchmodification import SearchModification
 from models.spectrum import Spectrum
 from models.spectrumidentification import SpectrumIdentification
 from models.spectrumidentificationprotocol import SpectrumIdentificationProtocol
-from app.routes.shared import get_api_key
-from db_config_parser import redis_config
+from app.cache import STATISTICS_TAG, cache_stats, cached, invalidate_cache, project_tag
+from app.config.database import engine, pool_stats, async_engine, async_pool_stats, SessionLocal
+from app.config.redis import redis_connection
+from app.config.schema import trigram_available
+from app.ingest import delete_staged_rows
+from app.routes.pdbdev import build_residue_pairs, delete_residue_pairs
+from app.routes.shared import get_api_key, get_latest_upload_ids, refresh_latest_uploads
+from app.jobs import create_job, get_job, parse_queue, update_job
+from app.metadata_fetcher import MetadataFetcher
+from app.singleflight import single_flight
+from app.upload_cache import publish_upload_change
+from db_config_parser import get_external_api_config
 from index import get_session
 from process_dataset import convert_pxd_accession_from_pride
 
 logger = logging.getLogger(__name__)
 pride_router = APIRouter()
 config = configparser.ConfigParser()
+background_tasks = set()
+# seconds the responses of the statistics and project endpoints are cached, writes invalidate them sooner
+STATISTICS_TTL = 24 * 60 * 60
+PROJECT_TTL = 60 * 60
+# whether pg_trgm is installed, None until it has been checked, see use_trigram_ranking
+trigram_installed = None
+
+
+def use_trigram_ranking():
+    """
+    True if search results can be ranked with word_similarity, checked once per worker.
+    Without pg_trgm the searches still match with LIKE, but the results are in id order.
+    """
+    global trigram_installed
+    if trigram_installed is None:
+        trigram_installed = trigram_available(engine)
+        if trigram_installed is False:
+            logger.warning("pg_trgm is not installed, search results are not ranked")
+    return bool(trigram_installed)
 
 
 @pride_router.get("/health", tags=["Admin"])
@@ -57,237 +86,178 @@ async def health(session: Session = Depends(get_session)):
     except Exception as error:
         logger.error(error)
         db_status = "Failed"
+    if redis_connection.client is None:
+        redis_status = "Disabled"
+    else:
+        redis_status = "OK" if await redis_connection.ping() else "Failed"
     return {'status': "OK",
-            'db_status': db_status}
+            'db_status': db_status,
+            'redis_status': redis_status}
+
+
+@pride_router.get("/pool-status", tags=["Admin"])
+def pool_status(api_key: str = Security(get_api_key)):
+    """
+    Connection pool usage and saturation counters
+    :param api_key: API KEY
+    :return: pool counters and current pool state
+    """
+    return {'sync': {'counters': pool_stats.as_dict(),
+                     'pool': engine.pool.status()},
+            'async': {'counters': async_pool_stats.as_dict(),
+                      'pool': async_engine.sync_engine.pool.status()}}
+
+
+@pride_router.get("/cache-status", tags=["Admin"])
+def cache_status(api_key: str = Security(get_api_key)):
+    """
+    Response cache hits, misses and errors per endpoint, and the calls coalesced by single-flight, of this worker
+    :param api_key: API KEY
+    :return: counters per endpoint and single-flight counters
+    """
+    return {'responses': cache_stats.as_dict(),
+            'single_flight': single_flight.as_dict()}
 
 
 @pride_router.post("/parse", tags=["Admin"])
 async def parse(px_accession: str, temp_dir: str | None = None, dont_delete: bool = False,
                 api_key: str = Security(get_api_key)):
     """
-    Parse a new project which contain MzIdentML file
+    Parse a new project which contain MzIdentML file.
+    The download and parse run as a background job in a separate process, poll /parse/{job_id} for its status.
     :param api_key: API KEY
     :param px_accession: ProteomXchange Project Accession
     :param temp_dir: If data needs to be saved in a temporary directory
     :param dont_delete: Boolean value to determine if the files needs to be deleted at the end
-    :return: None
+    :return: job id
     """
     if temp_dir:
         temp_dir = os.path.expanduser(temp_dir)
     else:
         temp_dir = os.path.expanduser('~/mzId_convertor_temp')
-    convert_pxd_accession_from_pride(px_accession, temp_dir, dont_delete)
-    # invalidate_cache()
-    logger.info("Invalidated Cache")
+    # the place is reserved before any await, so a burst of requests can't overfill the queue
+    if not parse_queue.reserve():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many parse jobs queued, try again later")
+    try:
+        job_id = await create_job("parse", {"px_accession": px_accession, "temp_dir": temp_dir,
+                                            "dont_delete": dont_delete}, progress={"stage": "queued"})
+    except BaseException:
+        parse_queue.release()
+        raise
+    task = asyncio.create_task(run_parse_job(job_id, px_accession, temp_dir, dont_delete))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return {"job_id": job_id}
+
+
+@pride_router.get("/parse/{job_id}", tags=["Admin"])
+async def parse_status(job_id: str, api_key: str = Security(get_api_key)):
+    """
+    Status of a parse job, its progress gives the stage it is at: queued, running, indexing or completed.
+    :param job_id: id returned by /parse
+    :param api_key: API KEY
+    :return: the job
+    """
+    job = await get_job(job_id)
+    if job is None or job["kind"] != "parse":
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+
+async def run_parse_job(job_id, px_accession, temp_dir, dont_delete):
+    """
+    Convert the project in the parse worker pool, then update its latest uploads and residue pairs.
+    The job's place in parse_queue has been reserved.
+    """
+    try:
+        await parse_queue.run(job_id, convert_pxd_accession_from_pride, px_accession, temp_dir, dont_delete)
+        await update_job(job_id, progress={"stage": "indexing"})
+        await run_in_threadpool(index_parsed_project, px_accession)
+        await publish_upload_change(px_accession)
+        await update_job(job_id, status="completed", progress={"stage": "completed"})
+        await invalidate_cache(project_tag(px_accession), STATISTICS_TAG)
+    except Exception as error:
+        logger.error(f"Parse job {job_id} for {px_accession} failed: {error}")
+        await update_job(job_id, status="failed", error=error)
+
+
+def index_parsed_project(px_accession):
+    """
+    Make a newly parsed project's uploads the latest ones and build their residue pairs.
+    :param px_accession: ProteomXchange Project Accession
+    """
+    with SessionLocal() as session:
+        refresh_latest_uploads(session, px_accession)
+        build_residue_pairs(session, get_latest_upload_ids(session, px_accession))
+        session.commit()
 
 
 @pride_router.post("/update-protein-metadata/{project_id}", tags=["Admin"])
 async def update_metadata_by_project(project_id: str, session: Session = Depends(get_session),
                                      api_key: str = Security(get_api_key)):
-    # Get total number of identifications (not spectra) passing Threshold including decoy identification
-    sql_number_of_identifications = text("""
-                        SELECT count(*)
-                        FROM spectrumidentification
-                        WHERE upload_id IN (
-                            SELECT u.id
-                            FROM upload u
-                            WHERE u.upload_time = (
-                                SELECT max(upload_time)
-                                FROM upload
-                                WHERE project_id = u.project_id AND identification_file_name = u.identification_file_name
-                            )
-                            AND u.project_id = :projectaccession
-                        )
-                        AND pass_threshold = True
-                    """)
-
-    # Get Total number of peptides identified passing Threshold including decoy identification(including non-crosslink)
-    sql_number_of_peptides = text("""
-                                SELECT COUNT(DISTINCT pep_id)
-                                FROM (
-                                    SELECT pep1_id AS pep_id
-                                    FROM spectrumidentification si
-                                    WHERE si.upload_id IN (
-                                            SELECT u.id
-                                            FROM upload u
-                                            where u.upload_time =
-                                                (select max(upload_time) from upload
-                                                where project_id = u.project_id
-                                                and identification_file_name = u.identification_file_name )
-                                                and u.project_id = :projectaccession
-                                    ) AND si.pass_threshold = TRUE
-
-                                    UNION
-
-                                    SELECT pep2_id AS pep_id
-                                    FROM spectrumidentification si
-                                    WHERE si.upload_id IN (
-                                            SELECT u.id
-                                            FROM upload u
-                                            where u.upload_time =
-                                                (select max(upload_time) from upload
-                                                where project_id = u.project_id
-                                                and identification_file_name = u.identification_file_name )
-                                                and u.project_id = :projectaccession
-                                    ) AND si.pass_threshold = TRUE
-                                ) AS result;    
-            """)
-
-    # Total number of crosslinked proteins identified passing Threshold excluding decoy identification
-    sql_number_of_proteins = text("""
-                            SELECT COUNT(*) 
-                            FROM (
-                                SELECT DISTINCT dbs.accession 
-                                FROM (
-                                    SELECT pe1.dbsequence_ref AS protein_id
-                                    FROM spectrumidentification si
-                                    INNER JOIN modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id
-                                    INNER JOIN peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id
-                                    INNER JOIN modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id
-                                    INNER JOIN peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id
-                                    INNER JOIN upload u ON u.id = si.upload_id
-                                    WHERE u.id IN (
-                                        SELECT u.id
-                                        FROM upload u
-                                        WHERE u.upload_time = (
-                                            SELECT MAX(upload_time)
-                                            FROM upload
-                                            WHERE project_id = u.project_id
-                                            AND identification_file_name = u.identification_file_name
-                                        ) AND u.project_id = :projectaccession
-                                    ) AND mp1.link_site1 > 0 AND mp2.link_site1 > 0 AND pe1.is_decoy = FALSE AND pe2.is_decoy = FALSE
-                                    AND si.pass_threshold = TRUE
-
-                                    UNION
-
-                                    SELECT pe2.dbsequence_ref AS protein_id
-                                    FROM spectrumidentification si
-                                    INNER JOIN modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id
-                                    INNER JOIN peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id
-                                    INNER JOIN modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id
-                                    INNER JOIN peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id
-                                    INNER JOIN upload u ON u.id = si.upload_id
-                                    WHERE u.id IN (
-                                        SELECT u.id
-                                        FROM upload u
-                                        WHERE u.upload_time = (
-                                            SELECT MAX(upload_time)
-                                            FROM upload
-                                            WHERE project_id = u.project_id
-                                            AND identification_file_name = u.identification_file_name
-                                        ) AND u.project_id = :projectaccession
-                                    ) AND mp1.link_site1 > 0 AND mp2.link_site1 > 0 AND pe1.is_decoy = FALSE AND pe2.is_decoy = FALSE
-                                    AND si.pass_threshold = TRUE
-                                ) AS protein_id 
-                                INNER JOIN dbsequence AS dbs ON protein_id = id
-                            ) AS accessions;
-
-            """)
-
-    # total number of peptides(crosslink and non crosslink) per protein
-    sql_peptides_per_protein = text("""
-        WITH result AS (
-        SELECT
-            pe1.dbsequence_ref AS dbref1,
-            pe1.peptide_ref AS pepref1,
-            pe2.dbsequence_ref AS dbref2,
-            pe2.peptide_ref AS pepref2
-        FROM
-            spectrumidentification si
-            INNER JOIN modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id
-            INNER JOIN peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id
-            INNER JOIN modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id
-            INNER JOIN peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id
-            INNER JOIN upload u ON u.id = si.upload_id
-        WHERE
-            u.id IN (
-                SELECT u.id
-                FROM upload u
-                WHERE u.upload_time = (
-                    SELECT MAX(upload_time)
-                    FROM upload
-                    WHERE project_id = u.project_id
-                    AND identification_file_name = u.identification_file_name
-                ) AND u.project_id = :projectaccession
-            )
-            AND pe1.is_decoy = FALSE
-            AND pe2.is_decoy = FALSE
-            AND si.pass_threshold = TRUE
-    )
-    SELECT
-        dbref,
-        COUNT(pepref) AS peptide_count
-    FROM (
-        SELECT dbref1 AS dbref, pepref1 AS pepref FROM result
-        UNION
-        SELECT dbref2 AS dbref, pepref2 AS pepref FROM result
-    ) AS inner_result
-    GROUP BY dbref;
-
-        """)
-
-    # Proteins and crosslink peptide counts
-    sql_crosslinks_per_protein = text("""
-     WITH result AS (
-        SELECT
-            pe1.dbsequence_ref AS dbref1,
-            pe1.peptide_ref AS pepref1,
-            pe2.dbsequence_ref AS dbref2,
-            pe2.peptide_ref AS pepref2
-        FROM
-            spectrumidentification si
-            INNER JOIN modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id
-            INNER JOIN peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id
-            INNER JOIN modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id
-            INNER JOIN peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id
-            INNER JOIN upload u ON u.id = si.upload_id
-        WHERE
-            u.id IN (
-                SELECT u.id
-                FROM upload u
-                WHERE u.upload_time = (
-                    SELECT MAX(upload_time)
-                    FROM upload
-                    WHERE project_id = u.project_id
-                    AND identification_file_name = u.identification_file_name
-                ) AND u.project_id = :projectaccession
+    # All counts of a project in one pass over its passing identifications:
+    # passing     - identifications passing threshold, including decoys
+    # evidence    - passing, non-decoy identifications with the protein evidence of both peptides
+    # per_protein - number of peptides (and of crosslinked peptides) and accession per protein dbref
+    # totals      - number of identifications, of peptides (including decoys and non-crosslinks)
+    #               and of crosslinked proteins
+    # per_protein is left joined to totals, so the totals are returned even for a project without proteins.
+    sql_project_statistics = text("""
+        WITH passing AS (
+            SELECT si.upload_id, si.pep1_id, si.pep2_id
+            FROM spectrumidentification si
+            WHERE si.upload_id IN (
+                SELECT upload_id FROM latestupload WHERE project_id = :projectaccession
             )
-            AND mp1.link_site1 > 0
-            AND mp2.link_site1 > 0
-            AND pe1.is_decoy = FALSE
-            AND pe2.is_decoy = FALSE
             AND si.pass_threshold = TRUE
-    )
-    SELECT
-        dbref,
-        COUNT(pepref) AS peptide_count
-    FROM (
-        SELECT DISTINCT *
-        FROM (
-            SELECT dbref1 AS dbref, pepref1 AS pepref FROM result
+        ),
+        evidence AS (
+            SELECT
+                p.upload_id,
+                pe1.dbsequence_ref AS dbref1,
+                pe1.peptide_ref AS pepref1,
+                pe2.dbsequence_ref AS dbref2,
+                pe2.peptide_ref AS pepref2,
+                (mp1.link_site1 > 0 AND mp2.link_site1 > 0) AS crosslinked
+            FROM
+                passing p
+                INNER JOIN modifiedpeptide mp1 ON p.pep1_id = mp1.id AND p.upload_id = mp1.upload_id
+                INNER JOIN peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id
+                INNER JOIN modifiedpeptide mp2 ON p.pep2_id = mp2.id AND p.upload_id = mp2.upload_id
+                INNER JOIN peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id
+            WHERE
+                pe1.is_decoy = FALSE
+                AND pe2.is_decoy = FALSE
+        ),
+        protein_peptide AS (
+            SELECT upload_id, dbref1 AS dbref, pepref1 AS pepref, crosslinked FROM evidence
             UNION
-            SELECT dbref2 AS dbref, pepref2 AS pepref FROM result
-        ) AS inner_inner_result
-    ) AS inner_result
-    GROUP BY dbref;
-
-           """)
-
-    # Protein dbref to protein accession mapping
-    sql_db_sequence_accession_mapping = text("""
-        SELECT id, accession
-        FROM dbsequence
-        WHERE upload_id IN (
-            SELECT u.id
-            FROM upload u
-            WHERE u.upload_time = (
-                SELECT MAX(upload_time)
-                FROM upload
-                WHERE project_id = u.project_id
-                AND identification_file_name = u.identification_file_name
-            )
-            AND u.project_id = :projectaccession
-        );
+            SELECT upload_id, dbref2 AS dbref, pepref2 AS pepref, crosslinked FROM evidence
+        ),
+        per_protein AS (
+            SELECT
+                pp.dbref,
+                COUNT(DISTINCT pp.pepref) AS peptide_count,
+                NULLIF(COUNT(DISTINCT pp.pepref) FILTER (WHERE pp.crosslinked), 0) AS crosslink_count,
+                MAX(dbs.accession) AS accession,
+                BOOL_OR(pp.crosslinked) AS crosslinked
+            FROM
+                protein_peptide pp
+                LEFT JOIN dbsequence dbs ON dbs.id = pp.dbref AND dbs.upload_id = pp.upload_id
+            GROUP BY pp.dbref
+        ),
+        totals AS (
+            SELECT
+                (SELECT COUNT(*) FROM passing) AS number_of_identifications,
+                (SELECT COUNT(DISTINCT v.pep_id)
+                 FROM passing p CROSS JOIN LATERAL (VALUES (p.pep1_id), (p.pep2_id)) AS v(pep_id)) AS number_of_peptides,
+                (SELECT COUNT(DISTINCT accession) FROM per_protein WHERE crosslinked) AS number_of_proteins
+        )
+        SELECT t.number_of_identifications, t.number_of_peptides, t.number_of_proteins,
+               pp.dbref, pp.peptide_count, pp.crosslink_count, pp.accession
+        FROM totals t
+        LEFT JOIN per_protein pp ON TRUE;
         """)
 
     project_details = ProjectDetail()
@@ -295,61 +265,64 @@ async def update_metadata_by_project(project_id: str, session: Session = Depends
 
     # get project details from PRIDE API
     logger.info("Updating project level metadata")
-    px_url = 'https://www.ebi.ac.uk/pride/ws/archive/v2/projects/' + project_id
+    external_api_config = get_external_api_config()
+    px_url = external_api_config["pride_url"] + project_id
     logger.debug('GET request to PRIDE API: ' + px_url)
-    pride_response = requests.get(px_url)
-    r = requests.get(px_url)
-    if r.status_code == 200:
-        logger.info('PRIDE API returned status code 200')
-        pride_json = pride_response.json()
-        if pride_json is not None:
-            if len(pride_json['references']) > 0:
-                project_details.pubmed_id = pride_json['references'][0]['pubmedId']
-            if len(pride_json['title']) > 0:
-                project_details.title = pride_json['title']
-            if len(pride_json['projectDescription']) > 0:
-                project_details.description = pride_json['projectDescription']
-            if len(pride_json['organisms']) > 0:
-                project_details.organism = pride_json['organisms'][0]['name']
+    try:
+        async with MetadataFetcher(external_api_config) as fetcher:
+            pride_json = await fetcher.get_json(px_url)
+    except Exception as error:
+        logger.error(px_url + " failed to get data from PRIDE:" + str(error))
+        pride_json = None
+    if pride_json is not None:
+        logger.info('PRIDE API returned project details')
+        if len(pride_json['references']) > 0:
+            project_details.pubmed_id = pride_json['references'][0]['pubmedId']
+        if len(pride_json['title']) > 0:
+            project_details.title = pride_json['title']
+        if len(pride_json['projectDescription']) > 0:
+            project_details.description = pride_json['projectDescription']
+        if len(pride_json['organisms']) > 0:
+            project_details.organism = pride_json['organisms'][0]['name']
 
     project_details.project_id = project_id
 
-    project_details.number_of_spectra = await get_number_of_counts(sql_number_of_identifications, sql_values,
-                                                                   session)
-    project_details.number_of_peptides = await get_number_of_counts(sql_number_of_peptides, sql_values, session)
-    project_details.number_of_proteins = await get_number_of_counts(sql_number_of_proteins, sql_values, session)
-
-    peptide_counts_by_protein = await get_counts_table(sql_peptides_per_protein, sql_values, session)
-    peptide_crosslinks_by_protein = await get_counts_table(sql_crosslinks_per_protein, sql_values, session)
-    db_sequence_accession_mapping = await get_counts_table(sql_db_sequence_accession_mapping, sql_values,
-                                                           session)
+    # the database work runs in the threadpool so a big project doesn't block the event loop,
+    # failures propagate so the project isn't saved with zero counts and checkpointed
+    statistics = await run_in_threadpool(get_project_statistics, sql_project_statistics, sql_values, session)
+    project_details.number_of_spectra = statistics['number_of_identifications']
+    project_details.number_of_peptides = statistics['number_of_peptides']
+    project_details.number_of_proteins = statistics['number_of_proteins']
 
     list_of_project_sub_details = []
 
-    # fill number of peptides
-    for protein in peptide_counts_by_protein:
+    # fill number of peptides, crosslinks and protein accessions
+    for protein in statistics['proteins']:
         project_sub_detail = ProjectSubDetail()
         project_sub_detail.project_detail = project_details
-        project_sub_detail.protein_db_ref = protein['key']
-        project_sub_detail.number_of_peptides = protein['value']
+        project_sub_detail.protein_db_ref = protein['dbref']
+        project_sub_detail.number_of_peptides = protein['peptide_count']
+        project_sub_detail.number_of_cross_links = protein['crosslink_count']
+        project_sub_detail.protein_accession = protein['accession']
         list_of_project_sub_details.append(project_sub_detail)
 
-    # fill number of crosslink
-    for crosslinks in peptide_crosslinks_by_protein:
-        for sub_details in list_of_project_sub_details:
-            if sub_details.protein_db_ref == crosslinks['key']:
-                sub_details.number_of_cross_links = crosslinks['value']
-
-    # fill protein accessions
-    for sub_details in list_of_project_sub_details:
-        for dbseq in db_sequence_accession_mapping:
-            if sub_details.protein_db_ref == dbseq['key']:
-                sub_details.protein_accession = dbseq['value']
-
     logger.info("Updating protein level metadata")
     await update_protein_metadata(list_of_project_sub_details)
 
     logger.info("Saving medatadata...")
+    await run_in_threadpool(save_project_metadata, project_id, project_details, session)
+    logger.info("Saving medatadata COMPLETED")
+    await invalidate_cache(project_tag(project_id), STATISTICS_TAG)
+    return None
+
+
+def save_project_metadata(project_id, project_details, session):
+    """
+    Replace the project's ProjectDetail and ProjectSubDetail records and checkpoint the refresh, in one transaction.
+    :param project_id: project accession
+    :param project_details: new ProjectDetail, with its ProjectSubDetails
+    :param session: session connection to the database
+    """
     conditions = {'project_id': project_id}
     existing_record = session.query(ProjectDetail).filter_by(**conditions).first()
 
@@ -358,23 +331,27 @@ async def update_metadata_by_project(project_id: str, session: Session = Depends
         # Delete ProjectDetail and associated ProjectSubDetail records based on project_detail_id
         session.query(ProjectSubDetail).filter_by(project_detail_id=existing_record.id).delete()
         session.query(ProjectDetail).filter_by(**conditions).delete()
-        session.commit()
 
     # add new record
     session.add(project_details)
+    record_metadata_refresh(project_id, session)
     session.commit()
-    logger.info("Saving medatadata COMPLETED")
-    return None
 
 
 @pride_router.post("/update-metadata", tags=["Admin"])
-async def update_metadata(session: Session = Depends(get_session), api_key: str = Security(get_api_key)):
+async def update_metadata(parallelism: int = Query(default=4, ge=1, le=32), force: bool = False,
+                          session: Session = Depends(get_session), api_key: str = Security(get_api_key)):
     """
     An endpoint to update the project details including title, description, PubmedID,
-    Number of proteins, peptides and spectra identifications
+    Number of proteins, peptides and spectra identifications.
+    Runs as a background job, poll /update-metadata/{job_id} for its progress.
+    Projects whose latest uploads haven't changed since their last refresh are skipped unless force is set,
+    so a job that is restarted after a failure carries on where the last one stopped.
+    :param parallelism: number of projects refreshed at the same time
+    :param force: refresh every project, changed or not
     :param api_key: API KEY
     :param session: session connection to the database
-    :return: None
+    :return: job id
     """
 
     sql_project_accession_list = text("""
@@ -384,12 +361,126 @@ async def update_metadata(session: Session = Depends(get_session), api_key: str
     try:
         sql_values = {}
         list_of_project_id = await get_accessions(sql_project_accession_list, sql_values, session)
-        for project_id in list_of_project_id:
-            await update_metadata_by_project(project_id, session, api_key)
         session.close()
     except Exception as error:
         logger.error(error)
         session.rollback()
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail="Could not list the projects to update")
+
+    job_id = await create_job("update-metadata", {"parallelism": parallelism, "force": force,
+                                                  "projects": len(list_of_project_id)})
+    task = asyncio.create_task(run_metadata_refresh(job_id, list_of_project_id, parallelism, force))
+    # keep a reference so the task isn't garbage collected before it finishes
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return {"job_id": job_id}
+
+
+@pride_router.get("/update-metadata/{job_id}", tags=["Admin"])
+async def update_metadata_status(job_id: str, api_key: str = Security(get_api_key)):
+    """
+    Status of a metadata update job: counts of refreshed, skipped and failed projects,
+    and once finished the time taken per project and the errors.
+    :param job_id: id returned by /update-metadata
+    :param api_key: API KEY
+    :return: the job
+    """
+    job = await get_job(job_id)
+    if job is None or job["kind"] != "update-metadata":
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+
+async def run_metadata_refresh(job_id, list_of_project_id, parallelism, force):
+    """
+    Refresh the metadata of the projects, at most parallelism at a time.
+    Each project gets its own session, so a failure only rolls back that project, and its database work
+    runs in the threadpool, so parallel projects overlap their queries as well as their external API calls.
+    :param job_id: job to report progress to
+    :param list_of_project_id: projects to refresh
+    :param parallelism: number of projects refreshed at the same time
+    :param force: refresh unchanged projects too
+    """
+    progress = {"total": len(list_of_project_id), "refreshed": 0, "skipped": 0, "failed": 0}
+    timings = {}
+    errors = {}
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def refresh(project_id):
+        async with semaphore:
+            with SessionLocal() as project_session:
+                try:
+                    if not force and not await run_in_threadpool(needs_metadata_refresh, project_id,
+                                                                     project_session):
+                        progress["skipped"] += 1
+                        return
+                    start = time.monotonic()
+                    await update_metadata_by_project(project_id, project_session, None)
+                    timings[project_id] = round(time.monotonic() - start, 3)
+                    progress["refreshed"] += 1
+                    logger.info(f"Updated metadata of {project_id} in {timings[project_id]}s")
+                except Exception as error:
+                    logger.error(f"Updating metadata of {project_id} failed: {error}")
+                    project_session.rollback()
+                    errors[project_id] = str(error)
+                    progress["failed"] += 1
+        await update_job(job_id, progress=progress)
+
+    await update_job(job_id, status="running", progress=progress)
+    try:
+        await asyncio.gather(*(refresh(project_id) for project_id in list_of_project_id))
+        await update_job(job_id, status="completed", progress=progress,
+                         result={"timings": timings, "errors": errors})
+    except Exception as error:
+        logger.error(f"Metadata update job {job_id} failed: {error}")
+        await update_job(job_id, status="failed", progress=progress,
+                         result={"timings": timings, "errors": errors}, error=error)
+
+
+def needs_metadata_refresh(project_id, session):
+    """
+    True if the project has no metadata yet or its latest uploads changed since the metadata was computed.
+    :param project_id: project accession
+    :param session: session connection to the database
+    """
+    sql = text("""
+        SELECT
+            EXISTS (SELECT 1 FROM projectdetails WHERE project_id = :project_id) AS has_details,
+            (SELECT upload_signature FROM metadatarefresh WHERE project_id = :project_id) AS refreshed_signature
+    """)
+    row = session.execute(sql, {"project_id": project_id}).mappings().first()
+    return not row["has_details"] or row["refreshed_signature"] != get_upload_signature(project_id, session)
+
+
+def get_upload_signature(project_id, session):
+    """
+    The project's latest uploads as text, changes whenever an upload is added, replaced or deleted.
+    :param project_id: project accession
+    :param session: session connection to the database
+    """
+    sql = text("""
+        SELECT string_agg(upload_id || '@' || coalesce(upload_time::text, ''), ',' ORDER BY upload_id)
+        FROM latestupload
+        WHERE project_id = :project_id
+    """)
+    return session.execute(sql, {"project_id": project_id}).scalar()
+
+
+def record_metadata_refresh(project_id, session):
+    """
+    Checkpoint that the project's metadata is up to date with its current latest uploads.
+    :param project_id: project accession
+    :param session: session connection to the database
+    """
+    sql = text("""
+        INSERT INTO metadatarefresh (project_id, upload_signature, refreshed_at)
+        VALUES (:project_id, :upload_signature, now())
+        ON CONFLICT (project_id) DO UPDATE
+        SET upload_signature = EXCLUDED.upload_signature, refreshed_at = EXCLUDED.refreshed_at
+    """)
+    session.execute(sql, {"project_id": project_id,
+                          "upload_signature": get_upload_signature(project_id, session)})
 
 
 @pride_router.put("/log/{level}", tags=["Admin"])
@@ -452,12 +543,18 @@ async def delete_dataset(project_id: str, session: Session = Depends(get_session
         logging.info("trying to delete records from PeptideEvidence")
         session.query(AnalysisCollectionSpectrumIdentification).filter(AnalysisCollectionSpectrumIdentification.upload_id.in_(upload_id_list)).delete()
         logging.info("trying to delete records from AnalysisCollection")
+        delete_staged_rows(session, upload_id_list)
+        logging.info("trying to delete staged records")
         session.query(Upload).filter_by(project_id=project_id).delete()
         logging.info("trying to delete records from Upload")
+        refresh_latest_uploads(session, project_id)
+        logging.info("trying to delete records from LatestUpload")
+        delete_residue_pairs(session, upload_id_list)
+        logging.info("trying to delete records from ResiduePair")
         session.commit()
         logger.info("*****Deleted dataset: " + project_id)
-        # invalidate_cache()
-        logger.info("Invalidated Cache")
+        await publish_upload_change(project_id)
+        await invalidate_cache(project_tag(project_id), STATISTICS_TAG)
     except Exception as error:
         logger.error(str(error))
         session.rollback()
@@ -499,45 +596,56 @@ async def project_search(q: Union[str | None] = Query(default="",
     :param session: connection to database
     """
     projects = None
-    where_condition = ""
+    total_elements = 0
 
+    # Each side of the UNION can use the trigram indexes of its own table,
+    # the best word similarity of a project's matching fields is its rank.
     if q and q != '*' and q != 'all':
-        where_condition += """ WHERE p.project_id LIKE '%' || :query || '%' OR
-          p.title LIKE '%' || :query || '%' OR
-          p.description LIKE '%' || :query || '%' OR
-          p.organism LIKE '%' || :query || '%' OR
-          ps.protein_accession = :query OR
-          ps.protein_name LIKE '%' || :query || '%' OR
-          ps.gene_name LIKE '%' || :query || '%'
-               """
-
-    project_search_sql = text(f"""
-                SELECT p.id FROM projectdetails p
-                JOIN public.projectsubdetails ps ON p.id = ps.project_detail_id
-                {where_condition}
-               ORDER BY id
-           """)
+        if use_trigram_ranking():
+            project_rank = """greatest(word_similarity(:query, p.project_id), word_similarity(:query, p.title),
+                                      word_similarity(:query, p.description), word_similarity(:query, p.organism))"""
+            protein_rank = "greatest(word_similarity(:query, ps.protein_name), word_similarity(:query, ps.gene_name))"
+        else:
+            project_rank = protein_rank = "0.0"
+        ranked_ids_sql = f"""
+            SELECT id, max(rank) AS rank FROM (
+                SELECT p.id, {project_rank} AS rank
+                FROM projectdetails p
+                WHERE p.project_id LIKE '%' || :query || '%' OR
+                      p.title LIKE '%' || :query || '%' OR
+                      p.description LIKE '%' || :query || '%' OR
+                      p.organism LIKE '%' || :query || '%'
+                UNION ALL
+                SELECT ps.project_detail_id, CASE WHEN ps.protein_accession = :query THEN 1
+                    ELSE {protein_rank} END
+                FROM projectsubdetails ps
+                WHERE ps.protein_accession = :query OR
+                      ps.protein_name LIKE '%' || :query || '%' OR
+                      ps.gene_name LIKE '%' || :query || '%'
+            ) AS hits
+            WHERE EXISTS (SELECT 1 FROM projectsubdetails ps WHERE ps.project_detail_id = hits.id)
+            GROUP BY id
+        """
+    else:
+        ranked_ids_sql = """
+            SELECT DISTINCT ps.project_detail_id AS id, 0.0 AS rank FROM projectsubdetails ps
+        """
+
+    ranked_ids = text(ranked_ids_sql).columns(id=Integer, rank=Float).subquery("ranked_ids")
+    project_search_stmt = select(ProjectDetail, func.count().over().label("total")) \
+        .join(ranked_ids, ProjectDetail.id == ranked_ids.c.id) \
+        .order_by(ranked_ids.c.rank.desc(), ProjectDetail.id) \
+        .offset((page - 1) * page_size) \
+        .limit(page_size)
 
     sql_values = {"query": q}
 
-    # project_search_sql = text("""
-    #     SELECT p.id FROM projectdetails p
-    # JOIN public.projectsubdetails ps ON p.id = ps.project_detail_id
-    # WHERE p.project_id = :query OR
-    #       p.title ILIKE '%' || :query || '%' OR
-    #       p.description ILIKE '%' || :query || '%' OR
-    #       p.organism ILIKE '%' || :query || '%' OR
-    #       ps.protein_accession = :query OR
-    #       ps.protein_name ILIKE '%' || :query || '%' OR
-    #       ps.gene_name ILIKE '%' || :query || '%'
-    #   """)
-    matchig_ids = set(session.execute(project_search_sql, sql_values).fetchall())
-    list_of_ids = [id for (id,) in matchig_ids]
     try:
-        offset = (page - 1) * page_size
-        projects = session.query(ProjectDetail).filter(ProjectDetail.id.in_(list_of_ids)).offset(offset).limit(
-            page_size).all()
-        total_elements = session.query(ProjectDetail).filter(ProjectDetail.id.in_(list_of_ids)).all().__len__()
+        # the page and the total number of matching projects in one round trip
+        rows = session.execute(project_search_stmt, sql_values).all()
+        projects = [row[0] for row in rows]
+        if rows:
+            total_elements = rows[0].total
     except Exception as e:
         # Handle the exception here
         logging.error(f"Error occurred: {str(e)}")
@@ -556,6 +664,7 @@ async def project_search(q: Union[str | None] = Query(default="",
 
 
 @pride_router.get("/projects/{project_id}", tags=["Projects"], response_model=None)
+@cached(ttl=PROJECT_TTL, tags=("project:{project_id}",))
 def project_detail_view(project_id: str, session: Session = Depends(get_session)) -> List[ProjectDetail]:
     """
     Retrieve project detail by px_accession.
@@ -601,17 +710,22 @@ async def protein_search(project_id: Annotated[str, Path(...,
     """
     try:
         where_condition = """project_detail_id IN (SELECT id FROM projectdetails WHERE project_id = :project_id)"""
+        order_by = "id"
 
         if q and q != '*' and q != 'all':
             where_condition += """ AND (protein_accession LIKE '%' || :query || '%' 
                      OR gene_name LIKE '%' || :query || '%' 
                      OR protein_name LIKE '%' || :query || '%')
             """
+            if use_trigram_ranking():
+                order_by = """greatest(word_similarity(:query, protein_accession), word_similarity(:query, gene_name),
+                                       word_similarity(:query, protein_name)) DESC, id"""
 
+        # count(*) OVER () gives the total number of matches along with the page
         sql = text(f"""
-            SELECT * FROM projectsubdetails 
+            SELECT *, count(*) OVER () AS total_elements FROM projectsubdetails 
             WHERE {where_condition}
-            ORDER BY id
+            ORDER BY {order_by}
             LIMIT :limit OFFSET :offset
         """)
 
@@ -623,22 +737,10 @@ async def protein_search(project_id: Annotated[str, Path(...,
             "offset": (page - 1) * page_size
         }
 
-        sql_total_count = text(f"""
-                  SELECT id FROM projectsubdetails 
-                  WHERE {where_condition}
-              """)
-
-        # Set the SQL values
-        sql_values_total_count = {
-            "project_id": project_id,
-            "query": q
-        }
-
         # Execute the SQL query
         result = session.execute(sql, sql_values)
-        result_total = session.execute(sql_total_count, sql_values_total_count)
-        total_elements = result_total.all().__len__()
         proteins = result.fetchall()
+        total_elements = proteins[0].total_elements if proteins else 0
 
         # Convert rows to a list of ProjectSubDetail objects
         proteins_list = []
@@ -679,6 +781,7 @@ async def protein_search(project_id: Annotated[str, Path(...,
 
 
 @pride_router.get("/statistics-count", tags=["Statistics"])
+@cached(ttl=STATISTICS_TTL, tags=(STATISTICS_TAG,))
 async def statistics_count(session: Session = Depends(get_session)):
     try:
         sql_statistics_count = text("""
@@ -698,6 +801,7 @@ async def statistics_count(session: Session = Depends(get_session)):
 
 
 @pride_router.get("/projects-per-species", tags=["Statistics"])
+@cached(ttl=STATISTICS_TTL, tags=(STATISTICS_TAG,))
 async def project_per_species(session: Session = Depends(get_session)):
     """
     Number of projects per species
@@ -718,197 +822,153 @@ async def project_per_species(session: Session = Depends(get_session)):
 
 
 @pride_router.get("/peptide-per-protein", tags=["Statistics"])
-async def peptide_per_protein(session: Session = Depends(get_session),
-                              redis_config_param=Depends(redis_config)):
+@cached(ttl=STATISTICS_TTL, tags=(STATISTICS_TAG,))
+async def peptide_per_protein():
     """
     Get the number of peptides per protein frequency
-    :param session: session connection to the database
-    :param redis_config_param: Redis in-memory database configurations
     :return:  Number of peptides per protein frequency as a dictionary
     """
+    values = None
     try:
-        key = redis_config_param['peptide_per_protein']
-        redis_client = redis.Redis(host=redis_config_param['host'],
-                                   port=redis_config_param['port'],
-                                   password=redis_config_param['password'],
-                                   decode_responses=False)
-        if redis_client is not None and redis_client.exists(key):
-            # If data exists in Redis, retrieve it
-            values = redis_client.get(key)
-            return json.loads(values)
-        else:
-            # If data doesn't exist in Redis, fetch it from the database
-            sql_peptides_per_protein = text("""
-                            WITH frequencytable AS (
-                        WITH result AS (
-                            SELECT
-                                pe1.dbsequence_ref AS dbref1,
-                                pe1.peptide_ref AS pepref1,
-                                pe2.dbsequence_ref AS dbref2,
-                                pe2.peptide_ref AS pepref2
-                            FROM
-                                spectrumidentification si
-                                INNER JOIN modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id
-                                INNER JOIN peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id
-                                INNER JOIN modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id
-                                INNER JOIN peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id
-                                INNER JOIN upload u ON u.id = si.upload_id
-                            WHERE
-                                u.id IN (
-                                    SELECT
-                                        u.id
-                                    FROM
-                                        upload u
-                                    WHERE
-                                        u.upload_time = (
-                                            SELECT
-                                                MAX(upload_time)
-                                            FROM
-                                                upload
-                                            WHERE
-                                                project_id = u.project_id
-                                                AND identification_file_name = u.identification_file_name
-                                        )
-                                )
-                                AND pe1.is_decoy = FALSE
-                                AND pe2.is_decoy = FALSE
-                                AND si.pass_threshold = TRUE
-                        )
+        sql_peptides_per_protein = text("""
+                        WITH frequencytable AS (
+                    WITH result AS (
                         SELECT
-                            dbref,
-                            COUNT(pepref) AS peptide_count
+                            pe1.dbsequence_ref AS dbref1,
+                            pe1.peptide_ref AS pepref1,
+                            pe2.dbsequence_ref AS dbref2,
+                            pe2.peptide_ref AS pepref2
                         FROM
-                            (
-                                SELECT
-                                    dbref1 AS dbref,
-                                    pepref1 AS pepref
-                                FROM
-                                    result
-                                UNION
-                                SELECT
-                                    dbref2 AS dbref,
-                                    pepref2 AS pepref
-                                FROM
-                                    result
-                            ) AS inner_result
-                        GROUP BY
-                            dbref
+                            spectrumidentification si
+                            INNER JOIN modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id
+                            INNER JOIN peptideevidence pe1 ON mp1.id = pe1.peptide_ref AND mp1.upload_id = pe1.upload_id
+                            INNER JOIN modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id
+                            INNER JOIN peptideevidence pe2 ON mp2.id = pe2.peptide_ref AND mp2.upload_id = pe2.upload_id
+                            INNER JOIN upload u ON u.id = si.upload_id
+                        WHERE
+                            u.id IN (
+                                SELECT upload_id FROM latestupload
+                            )
+                            AND pe1.is_decoy = FALSE
+                            AND pe2.is_decoy = FALSE
+                            AND si.pass_threshold = TRUE
                     )
                     SELECT
-                        frequencytable.peptide_count,
-                        COUNT(*)
+                        dbref,
+                        COUNT(pepref) AS peptide_count
                     FROM
-                        frequencytable
+                        (
+                            SELECT
+                                dbref1 AS dbref,
+                                pepref1 AS pepref
+                            FROM
+                                result
+                            UNION
+                            SELECT
+                                dbref2 AS dbref,
+                                pepref2 AS pepref
+                            FROM
+                                result
+                        ) AS inner_result
                     GROUP BY
-                        frequencytable.peptide_count
-                    ORDER BY
-                        frequencytable.peptide_count;
-
-                    """)
-            values = await peptide_per_protein_counts(sql_peptides_per_protein, None, session)
-
-            # Store the data in Redis for future use
-            if values:
-                redis_client.set(key, json.dumps(values))
-                return values
-            else:
-                return None
+                        dbref
+                )
+                SELECT
+                    frequencytable.peptide_count,
+                    COUNT(*)
+                FROM
+                    frequencytable
+                GROUP BY
+                    frequencytable.peptide_count
+                ORDER BY
+                    frequencytable.peptide_count;
+
+                """)
+        # concurrent requests share one run of the query, in the threadpool with its own session
+        values = await single_flight.do(("peptide_per_protein",), run_in_threadpool, peptide_per_protein_counts,
+                                        sql_peptides_per_protein, None)
+        if not values:
+            return None
     except Exception as error:
         logger.error(error)
     return values
 
 
-def invalidate_cache(redis_config_param=Depends(redis_config)):
-    redis_client = redis.Redis(host=redis_config_param['host'],
-                               port=redis_config_param['port'],
-                               password=redis_config_param['password'],
-                               decode_responses=False)
-    key = redis_config_param['peptide_per_protein']
-    redis_client.delete(key)
-    return None
-
-
 async def update_protein_metadata(list_of_project_sub_details):
-    # 1. metadata from Uniprot
-    logger.info("Updating protein level metadata from Uniprot API...")
-    uniprot_records = await find_uniprot_data(list_of_project_sub_details)
-    list_of_project_sub_details = await extract_uniprot_data(list_of_project_sub_details, uniprot_records)
-    logger.info("Updating protein level metadata from Uniprot API COMPLETED")
-
-    # 2. metadata from PDBe
-    logger.info("Updating protein level metadata from PDBe API...")
-    base_in_URL = "https://www.ebi.ac.uk/pdbe/api/mappings/best_structures/"
-    list_of_project_sub_details = await find_data_availability(list_of_project_sub_details, base_in_URL, "PDBe")
-    logger.info("Updating protein level metadata from PDBe API COMPLETED")
-
-    # 3. metadata from AlphaFold
-    logger.info("Updating protein level metadata from AlphaFold API...")
-    base_in_URL = "https://alphafold.ebi.ac.uk/api/prediction/"
-    list_of_project_sub_details = await find_data_availability(list_of_project_sub_details, base_in_URL, "AlphaFold")
-    logger.info("Updating protein level metadata from AlphaFold API COMPLETED")
+    external_api_config = get_external_api_config()
+    async with MetadataFetcher(external_api_config) as fetcher:
+        # 1. metadata from Uniprot
+        logger.info("Updating protein level metadata from Uniprot API...")
+        uniprot_records = await find_uniprot_data(list_of_project_sub_details, fetcher)
+        list_of_project_sub_details = await extract_uniprot_data(list_of_project_sub_details, uniprot_records)
+        logger.info("Updating protein level metadata from Uniprot API COMPLETED")
+
+        # 2. metadata from PDBe and 3. metadata from AlphaFold, independent of each other
+        logger.info("Updating protein level metadata from PDBe and AlphaFold API...")
+        await asyncio.gather(
+            find_data_availability(list_of_project_sub_details, external_api_config["pdbe_url"], "PDBe", fetcher),
+            find_data_availability(list_of_project_sub_details, external_api_config["alphafold_url"], "AlphaFold",
+                                   fetcher))
+        logger.info("Updating protein level metadata from PDBe and AlphaFold API COMPLETED")
     logger.info("Updating protein level metadata COMPLETED 100%")
     return list_of_project_sub_details
 
 
-async def find_uniprot_data(list_of_project_sub_details):
-    i = 1
-    batch_size = 4
+async def find_uniprot_data(list_of_project_sub_details, fetcher):
+    batch_size = fetcher.config["uniprot_batch_size"]
     logging.info("Uniprot Batch size: " + str(batch_size))
-    base_in_URL = "https://rest.uniprot.org/uniprotkb/search?query=accession:"
-    fields_in_URL = "&fields=protein_name,gene_primary&size=50"
-    seperator = "%20OR%20"
-    accessions = []
+    base_in_URL = fetcher.config["uniprot_url"]
+    accessions = [sub_details.protein_accession for sub_details in list_of_project_sub_details]
+    batches = [accessions[i:i + batch_size] for i in range(0, len(accessions), batch_size)]
+
+    async def fetch_batch(batch):
+        params = {
+            "query": " OR ".join("accession:" + accession for accession in batch),
+            "fields": "protein_name,gene_primary",
+            "size": len(batch),
+        }
+        try:
+            logging.info(f"Calling Uniprot API for {len(batch)} accessions")
+            uniprot_response = await fetcher.get_json(base_in_URL, params=params)
+            if uniprot_response is not None:
+                logging.info("Number of results found for the query: " + str(len(uniprot_response["results"])))
+                return uniprot_response["results"]
+        except Exception as error:
+            logger.error(base_in_URL + " failed to get data from Uniprot:" + str(error))
+        return []
+
     uniprot_records = []
-    for sub_details in list_of_project_sub_details:
-        accessions.append(sub_details.protein_accession)
-        # batch size or last one in the list
-        if i % batch_size == 0 or i == len(list_of_project_sub_details):
-            complete_URL = ""
-            try:
-                # extra check not to submit plenty of accessions
-                if len(accessions) <= batch_size:
-                    accessions_in_URL = seperator.join(accessions)
-                    complete_URL = base_in_URL + accessions_in_URL + fields_in_URL
-                    logging.info("Calling Uniprot API: " + complete_URL)
-                    uniprot_response = requests.get(complete_URL).json()
-                    if uniprot_response is not None:
-                        logging.info("Number of results found for the query: " + str(len(uniprot_response["results"])))
-                        for result in uniprot_response["results"]:
-                            uniprot_records.append(result)
-                else:
-                    raise Exception("Number of accessions are greater than the batch size!")
-            except Exception as error:
-                logger.error(str(error))
-                logger.error(complete_URL + " failed to get data from Uniprot:" + str(error))
-            finally:
-                accessions = []
-        i += 1
+    for results in await asyncio.gather(*(fetch_batch(batch) for batch in batches)):
+        uniprot_records.extend(results)
     return uniprot_records
 
 
 async def extract_uniprot_data(list_of_project_sub_details, uniprot_records):
+    uniprot_records_by_accession = {}
+    for uniprot_result in uniprot_records:
+        uniprot_records_by_accession.setdefault(uniprot_result.get("primaryAccession"), []).append(uniprot_result)
+
     for sub_details in list_of_project_sub_details:
-        for uniprot_result in uniprot_records:
+        for uniprot_result in uniprot_records_by_accession.get(sub_details.protein_accession, []):
             try:
-                if sub_details.protein_accession == uniprot_result["primaryAccession"]:
-                    if not uniprot_result["entryType"] == "Inactive":
-                        if uniprot_result["proteinDescription"]["recommendedName"] is not None:
-                            sub_details.protein_name = \
-                                uniprot_result["proteinDescription"]["recommendedName"]["fullName"]["value"]
-                        elif uniprot_result["proteinDescription"]["submissionNames"] is not None \
-                                and len(uniprot_result["proteinDescription"]["submissionNames"]) > 0:
-                            sub_details.protein_name = \
-                                uniprot_result["proteinDescription"]["submissionNames"][0]["fullName"]["value"]
-                        logger.debug(uniprot_result["primaryAccession"] + " protein name: " + sub_details.protein_name)
-                        if uniprot_result["genes"] is None or len(uniprot_result["genes"]) == 0:
-                            logger.error("\t" + sub_details.protein_accession + " has no genes section")
-                        elif len(uniprot_result["genes"]) > 0:
-                            sub_details.gene_name = uniprot_result["genes"][0]["geneName"]["value"]
-                            logger.debug(uniprot_result["primaryAccession"] + " gene name   : " + sub_details.gene_name)
-                        else:
-                            raise Exception("Error in matching genes section of uniprot response")
+                if not uniprot_result["entryType"] == "Inactive":
+                    if uniprot_result["proteinDescription"]["recommendedName"] is not None:
+                        sub_details.protein_name = \
+                            uniprot_result["proteinDescription"]["recommendedName"]["fullName"]["value"]
+                    elif uniprot_result["proteinDescription"]["submissionNames"] is not None \
+                            and len(uniprot_result["proteinDescription"]["submissionNames"]) > 0:
+                        sub_details.protein_name = \
+                            uniprot_result["proteinDescription"]["submissionNames"][0]["fullName"]["value"]
+                    logger.debug(uniprot_result["primaryAccession"] + " protein name: " + sub_details.protein_name)
+                    if uniprot_result["genes"] is None or len(uniprot_result["genes"]) == 0:
+                        logger.error("\t" + sub_details.protein_accession + " has no genes section")
+                    elif len(uniprot_result["genes"]) > 0:
+                        sub_details.gene_name = uniprot_result["genes"][0]["geneName"]["value"]
+                        logger.debug(uniprot_result["primaryAccession"] + " gene name   : " + sub_details.gene_name)
                     else:
-                        logger.warn(uniprot_result["primaryAccession"] + "is Inactive")
+                        raise Exception("Error in matching genes section of uniprot response")
+                else:
+                    logger.warn(uniprot_result["primaryAccession"] + "is Inactive")
             except Exception as error:
                 logger.error(str(error))
                 logger.error(
@@ -916,41 +976,44 @@ async def extract_uniprot_data(list_of_project_sub_details, uniprot_records):
     return list_of_project_sub_details
 
 
-async def find_data_availability(list_of_project_sub_details, base_in_URL, resourse):
-    for sub_details in list_of_project_sub_details:
+async def find_data_availability(list_of_project_sub_details, base_in_URL, resourse, fetcher):
+    async def fetch(sub_details):
+        complete_URL = base_in_URL + sub_details.protein_accession
         try:
-            accession_in_URL = sub_details.protein_accession
-            complete_URL = base_in_URL + accession_in_URL
             logging.debug("Calling API: " + complete_URL)
-            response = requests.get(complete_URL).json()
+            response = await fetcher.get_json(complete_URL)
             if resourse == "PDBe":
                 sub_details.in_pdbe_kb = response is not None and len(response) > 0
             elif resourse == "AlphaFold":
                 sub_details.in_alpha_fold_db = response is not None and len(response) > 0
         except Exception as error:
-            logger.error(str(error))
-            logger.error(complete_URL + " failed to get data from Uniprot:" + str(error))
+            logger.error(complete_URL + " failed to get data from " + resourse + ":" + str(error))
+
+    await asyncio.gather(*(fetch(sub_details) for sub_details in list_of_project_sub_details))
     return list_of_project_sub_details
 
 
-async def get_number_of_counts(sql, sql_values, session):
+def get_project_statistics(sql, sql_values, session):
     """
-    Get total number of counts (protein, peptide, spectra Identification) for a given project
-    :param sql: sql statements for counts
-    :param sql_values: Values for SQl(i.e Project accession or protein accession)
+    Run the single-pass project statistics query, errors are raised rather than returned as zero counts
+    :param sql: SQL returning the project totals on every row plus one row per protein
+    :param sql_values: SQl Values (i.e. Project accession)
     :param session: database session
-    :return: total number of counts
+    :return: dictionary with the totals and the list of per protein counts
     """
-    number_of_counts = 0
-    try:
-        result = session.execute(sql, sql_values)
-        number_of_counts = result.scalar()
-    except Exception as error:
-        logger.error(error)
-    finally:
-        session.close()
-        logger.debug('Database session is closed.')
-    return number_of_counts
+    statistics = {'number_of_identifications': 0, 'number_of_peptides': 0, 'number_of_proteins': 0,
+                  'proteins': []}
+    result = session.execute(sql, sql_values).mappings().all()
+    if result:
+        statistics['number_of_identifications'] = result[0]['number_of_identifications']
+        statistics['number_of_peptides'] = result[0]['number_of_peptides']
+        statistics['number_of_proteins'] = result[0]['number_of_proteins']
+    statistics['proteins'] = [
+        {'dbref': row['dbref'], 'peptide_count': row['peptide_count'],
+         'crosslink_count': row['crosslink_count'], 'accession': row['accession']}
+        for row in result if row['dbref'] is not None
+    ]
+    return statistics
 
 
 async def get_accessions(sql, sql_values, session):
@@ -973,27 +1036,6 @@ async def get_accessions(sql, sql_values, session):
     return list_of_accessions
 
 
-async def get_counts_table(sql, sql_values, session):
-    """
-    Get table of data in the database according to the SQL
-    :param sql_values: SQl Values
-    :param sql: SQL to get project accessions
-    :param session: database session
-    :return: List of key value pairs
-    """
-    try:
-        with session:
-            result = session.execute(sql, sql_values)
-            result_list = [
-                {'key': row[0], 'value': row[1]} for row in result if len(row) >= 2
-            ]
-    except Exception as error:
-        logger.error(f"Error type: {type(error)}, Error message: {str(error)}")
-    finally:
-        logger.debug('Database session is closed.')
-    return result_list
-
-
 async def project_per_species_counts(sql, sql_values, session):
     """
     Get table of data in the database according to the SQL
@@ -1015,25 +1057,19 @@ async def project_per_species_counts(sql, sql_values, session):
     return result_list
 
 
-async def peptide_per_protein_counts(sql, sql_values, session):
+def peptide_per_protein_counts(sql, sql_values):
     """
-    Get table of data in the database according to the SQL
+    Get table of data in the database according to the SQL.
+    Opens its own session, a single flight outlives the request that started it.
     :param sql_values: SQl Values
     :param sql: SQL to get project accessions
-    :param session: database session
     :return: List of key value pairs
     """
-    try:
-        with session:
-            result = session.execute(sql, sql_values)
-            result_list = [
-                {'protein_frequency': row[0], 'peptide_count': row[1]} for row in result if len(row) >= 2
-            ]
-    except Exception as error:
-        logger.error(f"Error type: {type(error)}, Error message: {str(error)}")
-    finally:
-        logger.debug('Database session is closed.')
-    return result_list
+    with SessionLocal() as session:
+        result = session.execute(sql, sql_values)
+        return [
+            {'protein_frequency': row[0], 'peptide_count': row[1]} for row in result if len(row) >= 2
+        ]
 
 
 async def get_statistics_count(sql, session):
@@ -1,16 +1,22 @@
 import re
-import os
 import logging.config
-import psycopg2
-from configparser import ConfigParser
+from contextlib import asynccontextmanager
+
+import psycopg
 from fastapi import APIRouter, Depends, status
 from fastapi import HTTPException, Security
 from fastapi.security import APIKeyHeader
+from psycopg.rows import dict_row
+from sqlalchemy import exc, text
+
+from app.config.database import engine, pool_stats, async_engine, async_pool_stats
+from app.upload_cache import latest_uploads
 from db_config_parser import security_API_key
 
 logger = logging.getLogger(__name__)
 
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
+NOT_CACHED = object()
 
 
 async def get_most_recent_upload_ids(pxid, file=None):
@@ -21,83 +27,124 @@ async def get_most_recent_upload_ids(pxid, file=None):
     :param pxid: identifier of a project,
         for ProteomeXchange projects this is the PXD****** accession
     :param file: name of the file
-    :return: upload ids
+    :return: list of upload ids
+    """
+    uploads = await get_most_recent_uploads(pxid, file)
+    if uploads is None:
+        return None
+    return [upload["id"] for upload in uploads]
+
+
+async def get_most_recent_uploads(pxid, file=None):
+    """
+    Get the id and upload time of the most recent uploads for a project/file.
+
+    :param pxid: identifier of a project,
+        for ProteomeXchange projects this is the PXD****** accession
+    :param file: name of the file
+    :return: list of dicts with id and upload_time
     """
+    # answered from this worker's cache until the uploads of the project change, see app/upload_cache.py
+    uploads = latest_uploads.get((pxid, file), NOT_CACHED)
+    if uploads is not NOT_CACHED:
+        return uploads
 
-    conn = None
-    upload_ids = None
+    generation = latest_uploads.generation
+    uploads = None
+    try:
+        async with get_db_cursor() as cur:
+            if file:
+                filename_clean = re.sub(r'[^0-9a-zA-Z-]+', '-', file)
+                query = """SELECT upload_id AS id, upload_time FROM latestupload 
+                        WHERE project_id = %s AND identification_file_name_clean = %s 
+                        ORDER BY upload_time DESC LIMIT 1;"""
+                # logger.debug(sql)
+                await cur.execute(query, [pxid, filename_clean])
+                row = await cur.fetchone()
+                # None if no data found
+                uploads = [row] if row is not None else None
+            else:
+                query = """SELECT upload_id AS id, upload_time FROM latestupload WHERE project_id = %s;"""
+                # logger.debug(sql)
+                await cur.execute(query, [pxid])
+                uploads = await cur.fetchall()
+        latest_uploads.put((pxid, file), uploads, generation)
+
+    except (Exception, psycopg.DatabaseError) as e:
+        logger.error(e)
+
+    return uploads
+
+
+def refresh_latest_uploads(session, project_id):
+    """
+    Recompute the latestupload rows of a project from the upload table, leaving out unpublished staged uploads.
+    Call after uploads of the project were added, deleted or published, the caller commits.
+    The trigger on upload does the same at commit, this makes the change visible within the transaction
+    and covers a publish, which doesn't change the upload table.
+
+    :param session: database session
+    :param project_id: identifier of a project
+    """
+    # serialise refreshes of the same project, concurrent uploads would otherwise insert the same rows twice
+    session.execute(text("SELECT pg_advisory_xact_lock(hashtext('latestupload'), hashtext(:project_id))"),
+                    {"project_id": project_id})
+    session.execute(text("DELETE FROM latestupload WHERE project_id = :project_id"),
+                    {"project_id": project_id})
+    session.execute(text("""INSERT INTO latestupload (project_id, identification_file_name,
+                                identification_file_name_clean, upload_id, upload_time)
+                            SELECT DISTINCT ON (identification_file_name)
+                                project_id, identification_file_name, identification_file_name_clean, id, upload_time
+                            FROM upload
+                            WHERE project_id = :project_id
+                                AND id NOT IN (SELECT upload_id FROM stagedupload)
+                            ORDER BY identification_file_name, upload_time DESC, id DESC"""),
+                    {"project_id": project_id})
+
+
+def get_latest_upload_ids(session, project_id):
+    """
+    Synchronous counterpart of get_most_recent_upload_ids for code holding an ORM session.
+
+    :param session: database session
+    :param project_id: identifier of a project
+    :return: list of upload ids
+    """
+    result = session.execute(text("SELECT upload_id FROM latestupload WHERE project_id = :project_id"),
+                             {"project_id": project_id})
+    return [row[0] for row in result]
+
+
+@asynccontextmanager
+async def get_db_cursor(name=None):
+    """
+    Borrow a connection from the shared async pool and open a cursor returning dict rows.
+    The connection goes back to the pool when the context exits.
+
+    :param name: if given, a named (server-side) cursor is opened so rows are
+        streamed from the server instead of being fetched all at once
+    """
+    try:
+        async with async_engine.connect() as conn:
+            raw_connection = await conn.get_raw_connection()
+            async with raw_connection.driver_connection.cursor(name=name or "", row_factory=dict_row) as cur:
+                yield cur
+    except exc.TimeoutError:
+        async_pool_stats.record_timeout()
+        raise
+
+
+def get_db_connection():
+    """
+    Borrow a psycopg2 connection from the shared pool, blocking while the pool is exhausted,
+    so async code calls it with run_in_threadpool.
+    Calling close() on it returns it to the pool rather than closing it.
+    """
     try:
-        # connect to the PostgreSQL server
-        # logger.info('Connecting to the PostgreSQL database...')
-        conn = await get_db_connection()
-        cur = conn.cursor()
-        if file:
-            filename_clean = re.sub(r'[^0-9a-zA-Z-]+', '-', file)
-            query = """SELECT id FROM upload 
-                    WHERE project_id = %s AND identification_file_name_clean = %s 
-                    ORDER BY upload_time DESC LIMIT 1;"""
-            # logger.debug(sql)
-            cur.execute(query, [pxid, filename_clean])
-
-            upload_ids = [cur.fetchone()[0]]
-            if upload_ids is None:
-                return None  # jsonify({"error": "No data found"}), 404
-            # logger.info("finished")
-            # close the communication with the PostgreSQL
-            cur.close()
-        else:
-            query = """SELECT u.id
-                        FROM upload u
-                        where u.upload_time = 
-                            (select max(upload_time) from upload 
-                            where project_id = u.project_id 
-                            and identification_file_name = u.identification_file_name )
-                        and u.project_id = %s;"""
-            # logger.debug(sql)
-            cur.execute(query, [pxid])
-            upload_ids = cur.fetchall()
-            if upload_ids is None:
-                return None  # jsonify({"error": "No data found"}), 404
-            # logger.info("finished")
-            # close the communication with the PostgreSQL
-            cur.close()
-
-    except (Exception, psycopg2.DatabaseError) as e:
-        print(e)
-    finally:
-        if conn is not None:
-            conn.close()
-            print('Database connection closed.')
-
-    return upload_ids
-
-
-async def get_db_connection():
-    config = os.environ.get('DB_CONFIG', 'database.ini')
-
-    # https://www.postgresqltutorial.com/postgresql-python/connect/
-    async def parse_database_info(filename, section='postgresql'):
-        # create a parser
-        parser = ConfigParser()
-        # read config file
-        parser.read(filename)
-
-        # get section, default to postgresql
-        db = {}
-        if parser.has_section(section):
-            params = parser.items(section)
-            for param in params:
-                db[param[0]] = param[1]
-        else:
-            raise Exception('Section {0} not found in the {1} file'.format(section, filename))
-
-        return db
-
-    # read connection information
-    db_info = await parse_database_info(config)
-    # logger.debug('Getting DB connection...')
-    conn = psycopg2.connect(**db_info)
-    return conn
+        return engine.raw_connection()
+    except exc.TimeoutError:
+        pool_stats.record_timeout()
+        raise
 
 
 def get_api_key(key: str = Security(api_key_header)) -> str:
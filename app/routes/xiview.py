@@ -1,16 +1,25 @@
+import asyncio
+import base64
 import logging.config
 import struct
+from enum import Enum
+from typing import List
 
-import psycopg2
-from fastapi import APIRouter, Depends, Request, Response
+import psycopg
+from fastapi import APIRouter, Body, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 import orjson
-from psycopg2 import sql
-from psycopg2.extras import RealDictCursor
-from sqlalchemy.orm import session, Session
-
-from models.upload import Upload
-from app.routes.shared import get_db_connection, get_most_recent_upload_ids
-from index import get_session
+from pydantic import BaseModel
+
+from app.cache import cached
+from app.config.database import async_max_size
+from app.columnar import accepts_msgpack, encode_data_object
+from app.spectra import MEDIA_TYPE as SPECTRA_MEDIA_TYPE, pack_frame, peak_array
+from app.etag import etag_matches, not_modified, uploads_etag
+from app.routes.pdbdev import get_residue_pair_builds
+from app.routes.shared import get_db_cursor, get_most_recent_uploads
+from app.singleflight import single_flight
+from app.upload_cache import project_files
 from db_config_parser import get_xiview_base_url
 
 xiview_data_router = APIRouter()
@@ -28,9 +37,119 @@ class EndpointFilter(logging.Filter):
 logger = logging.getLogger(__name__)
 logging.getLogger("uvicorn.access").addFilter(EndpointFilter())
 
+# number of rows fetched from a server-side cursor per round trip when streaming
+STREAM_BATCH_SIZE = 2000
+# number of (upload id, peptide id) pairs looked up per peptide or protein query,
+# keeps the size of the parameters and of each query's work flat however big the project is
+LOOKUP_BATCH_SIZE = 5000
+# maximum number of spectra requested in one get_peaklists call
+PEAKLIST_BATCH_LIMIT = 1000
+# seconds responses are cached, uploads and deletes of the project invalidate them sooner
+XIVIEW_DATA_TTL = 60 * 60
+# get_data_object holds up to three pooled connections per load, all loads together hold at most half the async pool
+# so that a burst of big projects can't starve the other endpoints
+data_object_connections = asyncio.Semaphore(max(1, async_max_size // 2))
+
+MATCHES_QUERY = """SELECT si.id AS id, si.pep1_id AS pi1, si.pep2_id AS pi2,
+                si.scores AS sc,
+                cast (si.upload_id as text) AS si,
+                si.calc_mz AS c_mz,
+                si.charge_state AS pc_c,
+                si.exp_mz AS pc_mz,
+                si.spectrum_id AS sp,
+                si.spectra_data_ref AS sd_ref,
+                si.pass_threshold AS pass,
+                si.rank AS r,
+                si.sil_id AS sil                
+            FROM match si 
+            INNER JOIN modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id 
+            INNER JOIN modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id
+            WHERE si.upload_id = ANY(%s) 
+            AND si.pass_threshold = TRUE 
+            AND mp1.link_site1 > -1
+            AND mp2.link_site1 > -1;"""
+
+# (upload_id, peptide id) of every peptide referenced by a match returned by MATCHES_QUERY,
+# lets peptides and proteins be selected by a join instead of collecting the ids in Python
+MATCH_PEPTIDES_CTE = """match_peptide AS (
+                SELECT si.upload_id, si.pep1_id AS pep_id
+                FROM match si
+                INNER JOIN modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id
+                INNER JOIN modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id
+                WHERE si.upload_id = ANY(%(ids)s)
+                AND si.pass_threshold = TRUE
+                AND mp1.link_site1 > -1
+                AND mp2.link_site1 > -1
+                UNION
+                SELECT si.upload_id, si.pep2_id AS pep_id
+                FROM match si
+                INNER JOIN modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id
+                INNER JOIN modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id
+                WHERE si.upload_id = ANY(%(ids)s)
+                AND si.pass_threshold = TRUE
+                AND mp1.link_site1 > -1
+                AND mp2.link_site1 > -1
+            )"""
+
+# peptides and proteins of the (upload id, peptide id) pairs given as two arrays, see get_peptides/get_proteins
+#  todo - rename link sites in json, it's myhster
+PEPTIDES_QUERY = """SELECT mp.id, cast(mp.upload_id as text) AS u_id,
+                mp.base_sequence AS base_seq,
+                array_agg(pp.dbsequence_ref) AS prt,
+                array_agg(pp.pep_start) AS pos,
+                array_agg(pp.is_decoy) AS is_decoy,
+                mp.link_site1 AS site1,
+                mp.link_site2 AS site2,
+                mp.mod_accessions as mod_accs,
+                mp.mod_positions as mod_pos,
+                mp.mod_monoiso_mass_deltas as mod_masses,
+                mp.crosslinker_modmass as cl_modmass
+            FROM unnest(%s::int[], %s::int[]) AS k(upload_id, pep_id)
+            JOIN modifiedpeptide AS mp ON mp.upload_id = k.upload_id AND mp.id = k.pep_id
+            JOIN peptideevidence AS pp ON mp.id = pp.peptide_ref AND mp.upload_id = pp.upload_id
+            GROUP BY mp.id, mp.upload_id, mp.base_sequence;"""
+
+PROTEINS_QUERY = """SELECT dbs.id, dbs.name, dbs.accession, dbs.sequence,
+                cast(dbs.upload_id as text) AS search_id, dbs.description
+            FROM dbsequence dbs
+            WHERE (dbs.upload_id, dbs.id) IN (
+                SELECT pp.upload_id, pp.dbsequence_ref
+                FROM unnest(%s::int[], %s::int[]) AS k(upload_id, pep_id)
+                JOIN peptideevidence AS pp ON pp.upload_id = k.upload_id AND pp.peptide_ref = k.pep_id
+            );"""
+
+STREAM_PEPTIDES_QUERY = """WITH """ + MATCH_PEPTIDES_CTE + """
+            SELECT mp.id, cast(mp.upload_id as text) AS u_id,
+                mp.base_sequence AS base_seq,
+                array_agg(pp.dbsequence_ref) AS prt,
+                array_agg(pp.pep_start) AS pos,
+                array_agg(pp.is_decoy) AS is_decoy,
+                mp.link_site1 AS site1,
+                mp.link_site2 AS site2,
+                mp.mod_accessions as mod_accs,
+                mp.mod_positions as mod_pos,
+                mp.mod_monoiso_mass_deltas as mod_masses,
+                mp.crosslinker_modmass as cl_modmass
+            FROM modifiedpeptide AS mp
+            JOIN match_peptide m ON mp.id = m.pep_id AND mp.upload_id = m.upload_id
+            JOIN peptideevidence AS pp ON mp.id = pp.peptide_ref AND mp.upload_id = pp.upload_id
+            GROUP BY mp.id, mp.upload_id, mp.base_sequence;"""
+
+STREAM_PROTEINS_QUERY = """WITH """ + MATCH_PEPTIDES_CTE + """,
+            match_protein AS (
+                SELECT DISTINCT pp.upload_id, pp.dbsequence_ref
+                FROM peptideevidence pp
+                JOIN match_peptide m ON pp.peptide_ref = m.pep_id AND pp.upload_id = m.upload_id
+            )
+            SELECT dbs.id, dbs.name, dbs.accession, dbs.sequence,
+                cast(dbs.upload_id as text) AS search_id, dbs.description
+            FROM dbsequence dbs
+            JOIN match_protein m ON dbs.id = m.dbsequence_ref AND dbs.upload_id = m.upload_id;"""
+
 
 @xiview_data_router.get('/get_xiview_data', tags=["xiVIEW"])
-async def get_xiview_data(project, file=None):
+@cached(ttl=XIVIEW_DATA_TTL, tags=("project:{project}",), vary=("accept",))
+async def get_xiview_data(request: Request, project, file=None, stream: bool = False):
     """
     Get the data for the network visualisation.
     URLs have the following structure:
@@ -38,94 +157,239 @@ async def get_xiview_data(project, file=None):
     Users may provide only projects, meaning we need to have an aggregated  view.
     https: // www.ebi.ac.uk / pride / archive / xiview / network.html?project=PXD020453
 
+    If the Accept header asks for application/msgpack the response is MessagePack instead of JSON,
+    with matches, peptides and proteins as column batches and numeric columns as typed arrays.
+
+    Once the data of the uploads is complete the response has an ETag derived from the upload ids and times
+    and their residue pair builds, a request with a matching If-None-Match gets a 304 without the data being loaded.
+
+    :param stream: if true the sections are sent as a chunked response while they are read
+        from the database, so memory use doesn't grow with the size of the project (JSON only)
     :return: json with the data
     """
-    most_recent_upload_ids = await get_most_recent_upload_ids(project, file)
+    most_recent_uploads = await get_most_recent_uploads(project, file)
+    most_recent_upload_ids = [upload["id"] for upload in most_recent_uploads] \
+        if most_recent_uploads is not None else None
+    use_msgpack = accepts_msgpack(request.headers.get("accept"))
+    streamed = stream and not use_msgpack
+    builds = await get_residue_pair_builds(most_recent_upload_ids)
+    etag = uploads_etag(most_recent_uploads, builds, project, "msgpack" if use_msgpack else "json", streamed)
+    headers = {"Vary": "Accept"}
+    if etag is not None:
+        headers["ETag"] = etag
+    else:
+        # the uploads couldn't be read or are still loading, neither clients nor the response cache keep this
+        headers["Cache-Control"] = "no-store"
+    if etag_matches(request, etag):
+        return not_modified(etag, headers["Vary"])
+    if streamed:
+        return StreamingResponse(stream_data_object(most_recent_upload_ids, project),
+                                 media_type='application/json', headers=headers)
     try:
-        data_object = await get_data_object(most_recent_upload_ids, project)
-    except psycopg2.DatabaseError as e:
+        # identical concurrent requests share one load and serialisation
+        key = ("xiview_data", tuple(most_recent_upload_ids or ()), project, use_msgpack)
+        body = await single_flight.do(key, get_encoded_data_object, most_recent_upload_ids, project, use_msgpack)
+    except psycopg.DatabaseError as e:
         logger.error(e)
-        print(e)
-        return {"error": "Database error"}, 500
+        raise HTTPException(status_code=500, detail="Database error")
+
+    return Response(body, media_type='application/msgpack' if use_msgpack else 'application/json', headers=headers)
+
 
-    return Response(orjson.dumps(data_object), media_type='application/json')
+async def get_encoded_data_object(ids, pxid, use_msgpack):
+    """
+    get_data_object serialised as MessagePack or JSON.
+    """
+    data_object = await get_data_object(ids, pxid)
+    if use_msgpack:
+        return encode_data_object(data_object)
+    return orjson.dumps(data_object)
 
 
 @xiview_data_router.get('/get_peaklist', tags=["xiVIEW"])
 async def get_peaklist(id, sd_ref, upload_id):
-    conn = None
     data = {}
-    error = None
     try:
-        conn = await get_db_connection()
-        cur = conn.cursor()
-        query = "SELECT intensity, mz FROM spectrum WHERE id = %s AND spectra_data_ref = %s AND upload_id = %s"
-        cur.execute(query, [id, sd_ref, upload_id])
-        resultset = cur.fetchall()[0]
-        data["intensity"] = struct.unpack('%sd' % (len(resultset[0]) // 8), resultset[0])
-        data["mz"] = struct.unpack('%sd' % (len(resultset[1]) // 8), resultset[1])
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as e:
+        async with get_db_cursor() as cur:
+            query = "SELECT intensity, mz FROM spectrum WHERE id = %s AND spectra_data_ref = %s AND upload_id = %s"
+            await cur.execute(query, [id, sd_ref, upload_id])
+            resultset = (await cur.fetchall())[0]
+            data["intensity"] = struct.unpack('%sd' % (len(resultset["intensity"]) // 8), resultset["intensity"])
+            data["mz"] = struct.unpack('%sd' % (len(resultset["mz"]) // 8), resultset["mz"])
+    except (Exception, psycopg.DatabaseError) as e:
         logger.exception(e)
-        error = e
-    finally:
-        if conn is not None:
-            conn.close()
-            # logger.debug('Database connection closed.')
-        if error is not None:
-            raise error
-        return data
+        raise e
+    return data
+
+
+class PeaklistKey(BaseModel):
+    id: str
+    sd_ref: str
+    upload_id: int
+
+
+class PeaklistEncoding(str, Enum):
+    binary = "binary"
+    base64 = "base64"
+
+
+@xiview_data_router.post('/get_peaklists', tags=["xiVIEW"])
+async def get_peaklists(keys: List[PeaklistKey] = Body(..., embed=True),
+                        encoding: PeaklistEncoding = Query(PeaklistEncoding.binary,
+                                                           description="binary frames or JSON with base64 buffers")):
+    """
+    Get many peaklists with a single query.
+
+    binary: a sequence of frames, each a little-endian uint32 header length, a JSON header
+    (id, sd_ref, upload_id, mz_length, intensity_length) and then the raw float64 mz and intensity buffers.
+    base64: JSON list of the same headers with the buffers as base64 strings in "mz" and "intensity".
+    Spectra that are not found are left out.
+
+    :param keys: list of (id, sd_ref, upload_id) of the spectra
+    :param encoding: binary or base64
+    """
+    if len(keys) > PEAKLIST_BATCH_LIMIT:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"At most {PEAKLIST_BATCH_LIMIT} peaklists per request")
+    query = """SELECT s.id, s.spectra_data_ref AS sd_ref, s.upload_id, s.mz, s.intensity
+            FROM unnest(%s::text[], %s::text[], %s::int[]) WITH ORDINALITY AS k(id, sd_ref, upload_id, n)
+            JOIN spectrum s ON s.id = k.id AND s.spectra_data_ref = k.sd_ref AND s.upload_id = k.upload_id
+            ORDER BY k.n;"""
+    try:
+        async with get_db_cursor() as cur:
+            await cur.execute(query, [[k.id for k in keys], [k.sd_ref for k in keys], [k.upload_id for k in keys]])
+            rows = await cur.fetchall()
+    except (Exception, psycopg.DatabaseError) as e:
+        logger.exception(e)
+        raise e
+
+    if encoding == PeaklistEncoding.base64:
+        peaklists = [{"id": row["id"], "sd_ref": row["sd_ref"], "upload_id": row["upload_id"],
+                      "mz_length": len(peak_array(row["mz"])),
+                      "intensity_length": len(peak_array(row["intensity"])),
+                      "mz": base64.b64encode(row["mz"]).decode(),
+                      "intensity": base64.b64encode(row["intensity"]).decode()} for row in rows]
+        return Response(orjson.dumps(peaklists), media_type='application/json')
+
+    frames = [pack_frame({"id": row["id"], "sd_ref": row["sd_ref"], "upload_id": row["upload_id"]},
+                         row["mz"], row["intensity"]) for row in rows]
+    return Response(b"".join(frames), media_type=SPECTRA_MEDIA_TYPE)
 
 
 @xiview_data_router.get('/visualisations/{project_id}', tags=["xiVIEW"])
-def visualisations(project_id: str, request: Request, session: Session = Depends(get_session)):
+async def visualisations(project_id: str):
+    """
+    xiVIEW links of the identification files of a project.
+    Called very often, so the file names of a project are kept in memory until its uploads change.
+    """
     xiview_base_url = get_xiview_base_url()
-    project_detail = session.query(Upload) \
-        .filter(Upload.project_id == project_id) \
-        .all()
-    datasets = []
-    processed_filenames = set()
-    for record in project_detail:
-        filename = record.identification_file_name
-        if filename not in processed_filenames:
-            datafile = {
-                "filename": filename,
-                "visualisation": "cross-linking",
-                "link": (xiview_base_url + "?project=" + project_id + "&file=" +
-                         str(filename))
-            }
-            datasets.append(datafile)
-            processed_filenames.add(filename)
-
-    return datasets
+    filenames = project_files.get(project_id)
+    if filenames is None:
+        generation = project_files.generation
+        filenames = await get_project_filenames(project_id)
+        project_files.put(project_id, filenames, generation)
+    return [{
+        "filename": filename,
+        "visualisation": "cross-linking",
+        "link": (xiview_base_url + "?project=" + project_id + "&file=" +
+                 str(filename))
+    } for filename in filenames]
+
+
+async def get_project_filenames(project_id):
+    """
+    Distinct identification file names of the (published) uploads of a project, in the order they were uploaded.
+    """
+    async with get_db_cursor() as cur:
+        await cur.execute("""SELECT identification_file_name FROM upload
+                WHERE project_id = %s AND id NOT IN (SELECT upload_id FROM stagedupload)
+                GROUP BY identification_file_name
+                ORDER BY min(id);""", [project_id])
+        return tuple(row["identification_file_name"] for row in await cur.fetchall())
 
 
 async def get_data_object(ids, pxid):
-    """ Connect to the PostgreSQL database server """
-    conn = None
-    data = {}
-    error = None
+    """
+    Load everything xiVIEW needs.
+    The sections run concurrently, each on a connection of its own: project info, metadata,
+    and matches, after which peptides and proteins are selected by the peptide ids of the matches.
+    """
     try:
-        conn = await get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        data["project"] = await get_pride_api_info(cur, pxid)
-        data["meta"] = await get_results_metadata(cur, ids)
-        data["matches"] = await get_matches(cur, ids)
-        data["peptides"] = await get_peptides(cur, data["matches"])
-        data["proteins"] = await get_proteins(cur, data["peptides"])
+        project, meta, (matches, peptides, proteins) = await asyncio.gather(
+            run_with_cursor(get_pride_api_info, pxid),
+            run_with_cursor(get_results_metadata, ids),
+            get_match_sections(ids),
+        )
         logger.info("finished")
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as e:
-        error = e
+    except (Exception, psycopg.DatabaseError) as e:
+        logger.exception(e)
+        raise e
+    return {"project": project, "meta": meta, "matches": matches, "peptides": peptides, "proteins": proteins}
+
+
+async def run_with_cursor(fn, *args):
+    """ Borrow a pooled connection, within data_object_connections, and run fn(cur, *args) on a cursor of it """
+    async with data_object_connections:
+        async with get_db_cursor() as cur:
+            return await fn(cur, *args)
+
+
+async def get_match_sections(ids):
+    """
+    Matches, then their peptides and the proteins of those peptides, the two of them concurrently.
+    Proteins are joined to the peptides in the database rather than collected from the peptide rows,
+    so they don't wait for the peptides.
+    """
+    matches = await run_with_cursor(get_matches, ids)
+    peptide_keys = get_peptide_keys(matches)
+    peptides, proteins = await asyncio.gather(
+        run_with_cursor(get_peptides, peptide_keys),
+        run_with_cursor(get_proteins, peptide_keys),
+    )
+    return matches, peptides, proteins
+
+
+async def stream_data_object(ids, pxid):
+    """
+    Same JSON as get_data_object, generated section by section.
+    matches, peptides and proteins are read through server-side cursors in batches of STREAM_BATCH_SIZE.
+    """
+    async with get_db_cursor() as cur:
+        project = await get_pride_api_info(cur, pxid)
+        meta = await get_results_metadata(cur, ids)
+    yield b'{"project":' + orjson.dumps(project) + b',"meta":' + orjson.dumps(meta)
+
+    sections = (
+        ("matches", MATCHES_QUERY, [ids]),
+        ("peptides", STREAM_PEPTIDES_QUERY, {"ids": ids}),
+        ("proteins", STREAM_PROTEINS_QUERY, {"ids": ids}),
+    )
+    for section, query, params in sections:
+        yield b',"' + section.encode() + b'":['
+        async for chunk in stream_rows(section, query, params):
+            yield chunk
+        yield b']'
+    yield b'}'
+
+
+async def stream_rows(name, query, params):
+    """
+    Run query on a named (server-side) cursor and yield the rows as comma separated JSON chunks.
+    """
+    try:
+        async with get_db_cursor(name="xiview_" + name) as cur:
+            await cur.execute(query, params)
+            separator = b""
+            while True:
+                rows = await cur.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+                yield separator + b",".join(orjson.dumps(row) for row in rows)
+                separator = b","
+    except (Exception, psycopg.DatabaseError) as e:
+        # the response has already started, so abort it rather than send truncated but valid JSON
         logger.exception(e)
         raise e
-    finally:
-        if conn is not None:
-            conn.close()
-            logger.debug('Database connection closed.')
-        if error is not None:
-            raise error
-        return data
 
 
 async def get_pride_api_info(cur, pxid):
@@ -136,8 +400,8 @@ async def get_pride_api_info(cur, pxid):
                 p.description
                 FROM projectdetails p
                 WHERE p.project_id = (%s);"""
-    cur.execute(query, [pxid])
-    return cur.fetchall()
+    await cur.execute(query, [pxid])
+    return await cur.fetchall()
 
 
 async def get_results_metadata(cur, ids):
@@ -157,8 +421,8 @@ async def get_results_metadata(cur, ids):
                 u.upload_warnings AS warnings
             FROM upload u
             WHERE u.id = ANY(%s);"""
-    cur.execute(query, [ids])
-    metadata["mzidentml_files"] = cur.fetchall()
+    await cur.execute(query, [ids])
+    metadata["mzidentml_files"] = await cur.fetchall()
 
     # get AnalysisCollection SpectrumIdentification(s) for each id
     query = """SELECT ac.upload_id,
@@ -168,8 +432,8 @@ async def get_results_metadata(cur, ids):
                 ac.search_database_refs
             FROM analysiscollectionspectrumidentification ac
             WHERE ac.upload_id = ANY(%s);"""
-    cur.execute(query, [ids])
-    metadata["analysis_collections"] = cur.fetchall()
+    await cur.execute(query, [ids])
+    metadata["analysis_collections"] = await cur.fetchall()
 
     # get SpectrumIdentificationProtocol(s) for each id
     query = """SELECT sip.id AS id,
@@ -181,23 +445,23 @@ async def get_results_metadata(cur, ids):
                 sip.threshold
             FROM spectrumidentificationprotocol sip
             WHERE sip.upload_id = ANY(%s);"""
-    cur.execute(query, [ids])
-    metadata["spectrum_identification_protocols"] = cur.fetchall()
+    await cur.execute(query, [ids])
+    metadata["spectrum_identification_protocols"] = await cur.fetchall()
 
     # enzymes
     query = """SELECT *
             FROM enzyme e
             WHERE e.upload_id = ANY(%s);"""
-    cur.execute(query, [ids])
-    metadata["enzymes"] = cur.fetchall()
+    await cur.execute(query, [ids])
+    metadata["enzymes"] = await cur.fetchall()
 
     # search modifications
     try:
         query = """SELECT *
                 FROM searchmodification sm
                 WHERE sm.upload_id = ANY(%s);"""
-        cur.execute(query, [ids])
-        metadata["search_modifications"] = cur.fetchall()
+        await cur.execute(query, [ids])
+        metadata["search_modifications"] = await cur.fetchall()
     except Exception as e:
         print(e)
 
@@ -205,106 +469,45 @@ async def get_results_metadata(cur, ids):
 
 
 async def get_matches(cur, ids):
-    query = """SELECT si.id AS id, si.pep1_id AS pi1, si.pep2_id AS pi2,
-                si.scores AS sc,
-                cast (si.upload_id as text) AS si,
-                si.calc_mz AS c_mz,
-                si.charge_state AS pc_c,
-                si.exp_mz AS pc_mz,
-                si.spectrum_id AS sp,
-                si.spectra_data_ref AS sd_ref,
-                si.pass_threshold AS pass,
-                si.rank AS r,
-                si.sil_id AS sil                
-            FROM match si 
-            INNER JOIN modifiedpeptide mp1 ON si.pep1_id = mp1.id AND si.upload_id = mp1.upload_id 
-            INNER JOIN modifiedpeptide mp2 ON si.pep2_id = mp2.id AND si.upload_id = mp2.upload_id
-            WHERE si.upload_id = ANY(%s) 
-            AND si.pass_threshold = TRUE 
-            AND mp1.link_site1 > -1
-            AND mp2.link_site1 > -1;"""
+    await cur.execute(MATCHES_QUERY, [ids])
+    return await cur.fetchall()
 
-    cur.execute(query, [ids])
-    return cur.fetchall()
 
-
-async def get_peptides(cur, match_rows):
-    search_peptide_ids = {}
+def get_peptide_keys(match_rows):
+    """
+    (upload id, peptide id) of every modified peptide referenced by the matches.
+    """
+    peptide_keys = set()
     for match_row in match_rows:
-        if match_row['si'] in search_peptide_ids:
-            peptide_ids = search_peptide_ids[match_row['si']]
-        else:
-            peptide_ids = set()
-            search_peptide_ids[match_row['si']] = peptide_ids
-        peptide_ids.add(match_row['pi1'])
+        upload_id = int(match_row['si'])
+        peptide_keys.add((upload_id, match_row['pi1']))
         if match_row['pi2'] is not None:
-            peptide_ids.add(match_row['pi2'])
-
-    subclauses = []
-    for k, v in search_peptide_ids.items():
-        pep_id_literals = []
-        for pep_id in v:
-            pep_id_literals.append(sql.Literal(pep_id))
-        joined_pep_ids = sql.SQL(',').join(pep_id_literals)
-        subclause = sql.SQL("(mp.upload_id = {} AND id IN ({}))").format(
-            sql.Literal(k),
-            joined_pep_ids
-        )
-        subclauses.append(subclause)
-    peptide_clause = sql.SQL(" OR ").join(subclauses)
+            peptide_keys.add((upload_id, match_row['pi2']))
+    return sorted(peptide_keys)
 
-    #  todo - rename link sites in json, it's myhster
-    query = sql.SQL("""SELECT mp.id, cast(mp.upload_id as text) AS u_id,
-                mp.base_sequence AS base_seq,
-                array_agg(pp.dbsequence_ref) AS prt,
-                array_agg(pp.pep_start) AS pos,
-                array_agg(pp.is_decoy) AS is_decoy,
-                mp.link_site1 AS site1,
-                mp.link_site2 AS site2,
-                mp.mod_accessions as mod_accs,
-                mp.mod_positions as mod_pos,
-                mp.mod_monoiso_mass_deltas as mod_masses,
-                mp.crosslinker_modmass as cl_modmass                     
-                    FROM modifiedpeptide AS mp
-                    JOIN peptideevidence AS pp
-                    ON mp.id = pp.peptide_ref AND mp.upload_id = pp.upload_id
-                WHERE {}
-                GROUP BY mp.id, mp.upload_id, mp.base_sequence;""").format(
-        peptide_clause
-    )
-    # logger.debug(query.as_string(cur))
-    cur.execute(query)
-    return cur.fetchall()
-
-
-async def get_proteins(cur, peptide_rows):
-    search_protein_ids = {}
-    for peptide_row in peptide_rows:
-        if peptide_row['u_id'] in search_protein_ids:
-            protein_ids = search_protein_ids[peptide_row['u_id']]
-        else:
-            protein_ids = set()
-            search_protein_ids[peptide_row['u_id']] = protein_ids
-        for prot in peptide_row['prt']:
-            protein_ids.add(prot)
-
-    subclauses = []
-    for k, v in search_protein_ids.items():
-        literals = []
-        for prot_id in v:
-            literals.append(sql.Literal(prot_id))
-        joined_literals = sql.SQL(",").join(literals)
-        subclause = sql.SQL("(upload_id = {} AND id IN ({}))").format(
-            sql.Literal(k),
-            joined_literals
-        )
-        subclauses.append(subclause)
 
-    protein_clause = sql.SQL(" OR ").join(subclauses)
-    query = sql.SQL("""SELECT id, name, accession, sequence,
-                     cast(upload_id as text) AS search_id, description FROM dbsequence WHERE ({});""").format(
-        protein_clause
-    )
-    # logger.debug(query.as_string(cur))
-    cur.execute(query)
-    return cur.fetchall()
+def key_batches(peptide_keys):
+    """
+    Split the peptide keys into batches of at most LOOKUP_BATCH_SIZE, as the two array parameters of a query.
+    """
+    for start in range(0, len(peptide_keys), LOOKUP_BATCH_SIZE):
+        batch = peptide_keys[start:start + LOOKUP_BATCH_SIZE]
+        yield [[upload_id for upload_id, _ in batch], [pep_id for _, pep_id in batch]]
+
+
+async def get_peptides(cur, peptide_keys):
+    rows = []
+    for params in key_batches(peptide_keys):
+        await cur.execute(PEPTIDES_QUERY, params)
+        rows.extend(await cur.fetchall())
+    return rows
+
+
+async def get_proteins(cur, peptide_keys):
+    # a protein can be matched by peptides of different batches
+    rows = {}
+    for params in key_batches(peptide_keys):
+        await cur.execute(PROTEINS_QUERY, params)
+        for row in await cur.fetchall():
+            rows.setdefault((row['search_id'], row['id']), row)
+    return list(rows.values())
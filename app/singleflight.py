@@ -0,0 +1,47 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical work: while a call for a key is in flight, further calls with the same key
+    wait for it and get its result (or its exception) instead of starting their own.
+    Nothing is kept once the call finishes, caching is left to the callers.
+    A waiter that is cancelled, e.g. because its client went away, doesn't cancel the shared call.
+    """
+    def __init__(self):
+        self._calls = {}
+        self.started = 0
+        self.joined = 0
+
+    async def do(self, key, fn, *args):
+        """
+        :param key: hashable key, equal keys must give equal results
+        :param fn: coroutine function computing the result
+        :param args: arguments of fn
+        :return: result of fn(*args), computed once for concurrent callers
+        """
+        task = self._calls.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(fn(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled() and task.exception() is not None:
+            # retrieved here as well so a failure nobody waited for isn't reported as never retrieved
+            logger.debug(f"Single-flight call {key} failed: {task.exception()}")
+
+    def as_dict(self):
+        return {"in_flight": len(self._calls), "started": self.started, "joined": self.joined}
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,91 @@
+import struct
+
+import numpy as np
+import orjson
+
+# a frame is a little-endian uint32 header length, a JSON header, then the raw float64 mz and intensity buffers.
+# mz_length and intensity_length in the header give the number of float64 values in each buffer.
+FRAME_HEADER_LENGTH = struct.Struct("<I")
+PEAK_DTYPE = np.dtype("<f8")
+MEDIA_TYPE = "application/vnd.xiview.spectra"
+
+
+def peak_array(buffer):
+    """
+    View a stored bytea peak buffer as float64 without copying it.
+    """
+    return np.frombuffer(buffer, dtype=PEAK_DTYPE)
+
+
+def pack_frame(header, mz, intensity):
+    """
+    Build one frame from a header dict and the raw mz and intensity buffers.
+    """
+    header = dict(header,
+                  mz_length=len(peak_array(mz)),
+                  intensity_length=len(peak_array(intensity)))
+    header_bytes = orjson.dumps(header)
+    return b"".join((FRAME_HEADER_LENGTH.pack(len(header_bytes)), header_bytes, mz, intensity))
+
+
+def parse_frame_header(header_bytes):
+    """
+    Decode a frame's JSON header, raises ValueError unless it is an object
+    with non-negative integer mz_length and intensity_length.
+    """
+    header = orjson.loads(header_bytes)
+    if not isinstance(header, dict):
+        raise ValueError("Frame header is not a JSON object")
+    for key in ("mz_length", "intensity_length"):
+        value = header.get(key)
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ValueError(f"Frame header needs a non-negative integer {key}")
+    return header
+
+
+class FrameReader:
+    """
+    Split a byte stream into frames as it arrives.
+    feed() takes the next chunk and returns the (header, mz, intensity) of every frame it completed,
+    and raises ValueError if a frame header is invalid.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._header = None
+        self._header_end = 0
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        frames = []
+        offset = 0
+        while True:
+            if self._header is None:
+                if len(self._buffer) - offset < FRAME_HEADER_LENGTH.size:
+                    break
+                (header_length,) = FRAME_HEADER_LENGTH.unpack_from(self._buffer, offset)
+                header_end = offset + FRAME_HEADER_LENGTH.size + header_length
+                if len(self._buffer) < header_end:
+                    break
+                self._header = parse_frame_header(self._buffer[offset + FRAME_HEADER_LENGTH.size:header_end])
+                self._header_end = header_end
+            mz_end = self._header_end + self._header["mz_length"] * PEAK_DTYPE.itemsize
+            frame_end = mz_end + self._header["intensity_length"] * PEAK_DTYPE.itemsize
+            if len(self._buffer) < frame_end:
+                break
+            frames.append((self._header, bytes(self._buffer[self._header_end:mz_end]),
+                           bytes(self._buffer[mz_end:frame_end])))
+            self._header = None
+            offset = frame_end
+        if offset:
+            # drop the consumed frames once per chunk rather than once per frame
+            del self._buffer[:offset]
+            if self._header is not None:
+                self._header_end -= offset
+        return frames
+
+    def close(self):
+        """
+        Raise ValueError if the stream ended in the middle of a frame.
+        """
+        if self._buffer:
+            raise ValueError("Stream ended in the middle of a frame")
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import anyio.from_thread
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+# the latest uploads of a project change a few times a year, the ttl only bounds staleness if a message is lost
+LATEST_UPLOAD_TTL = 10 * 60
+LATEST_UPLOAD_CACHE_SIZE = 4096
+CHANNEL_NAME = "xiview-api:upload-changes"
+
+
+class TTLCache:
+    """
+    LRU map whose entries also expire ttl seconds after they were put.
+    generation counts the drops and clears. A value read from the database is put with the generation
+    taken before the read, and is left out if entries were dropped meanwhile, as it may predate the change.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def drop(self, predicate):
+        self.generation += 1
+        for key in [key for key in self._entries if predicate(key)]:
+            del self._entries[key]
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+
+# (project id, file or None) -> latest uploads, see get_most_recent_uploads
+latest_uploads = TTLCache(LATEST_UPLOAD_CACHE_SIZE, LATEST_UPLOAD_TTL)
+# project id -> identification file names, see visualisations
+project_files = TTLCache(LATEST_UPLOAD_CACHE_SIZE, LATEST_UPLOAD_TTL)
+
+
+def drop_project(project_id):
+    latest_uploads.drop(lambda key: key[0] == project_id)
+    project_files.drop(lambda key: key == project_id)
+
+
+class LocalChannel:
+    """
+    In-memory stand-in for the Redis channel, delivering every message to the subscribers of this process.
+    Used when Redis isn't available, and in tests.
+    """
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    async def start(self):
+        pass
+
+    async def publish(self, message):
+        for callback in self.subscribers:
+            callback(message)
+
+    async def close(self):
+        pass
+
+
+class RedisChannel:
+    """
+    Redis pub/sub channel reaching every worker of every instance.
+    The listener has its own connection without a read timeout. It reconnects after an error,
+    and since messages sent meanwhile are lost, the subscribers are then called with None.
+    """
+    def __init__(self, config, name=CHANNEL_NAME):
+        self.name = name
+        self.subscribers = []
+        self.client = redis.Redis(host=config["host"], port=config["port"], password=config["password"],
+                                  socket_connect_timeout=config["connect_timeout"],
+                                  health_check_interval=config["health_check_interval"])
+        self._task = None
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            try:
+                async with self.client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(self.name)
+                    async for message in pubsub.listen():
+                        self._deliver(message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.warning(f"Listening to {self.name} failed, reconnecting: {error}")
+                self._deliver(None)
+                await asyncio.sleep(1)
+
+    def _deliver(self, message):
+        for callback in self.subscribers:
+            try:
+                callback(message)
+            except Exception as error:
+                logger.error(f"Handling message {message} of {self.name} failed: {error}")
+
+    async def publish(self, message):
+        await self.client.publish(self.name, message)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.client.aclose()
+
+
+def on_upload_change(project_id):
+    # None means messages may have been missed
+    if project_id is None:
+        latest_uploads.clear()
+        project_files.clear()
+    else:
+        drop_project(project_id)
+
+
+upload_changes = LocalChannel()
+upload_changes.subscribe(on_upload_change)
+
+
+async def open_upload_changes(redis_config):
+    """
+    Switch to the Redis channel, called at startup when Redis is available.
+    """
+    global upload_changes
+    channel = RedisChannel(redis_config)
+    channel.subscribe(on_upload_change)
+    await channel.start()
+    upload_changes = channel
+
+
+async def close_upload_changes():
+    await upload_changes.close()
+
+
+async def publish_upload_change(project_id):
+    """
+    Drop the project's cached latest uploads and files in this worker and tell the other workers to do the same.
+    Call after the latestupload rows of the project changed.
+    """
+    drop_project(project_id)
+    try:
+        await upload_changes.publish(project_id)
+    except Exception as error:
+        logger.error(f"Publishing the upload change of {project_id} failed: {error}")
+
+
+def publish_upload_change_from_thread(project_id):
+    """
+    publish_upload_change for the sync endpoints, which FastAPI runs in a worker thread.
+    """
+    anyio.from_thread.run(publish_upload_change, project_id)
@@ -1,4 +1,5 @@
-from configparser import ConfigParser
+from configparser import ConfigParser, NoSectionError
+from functools import lru_cache
 import os
 
 
@@ -44,8 +45,88 @@ def redis_config():
     return redis_info
 
 
+@lru_cache(maxsize=None)
 def get_xiview_base_url():
     config = os.environ.get('DB_CONFIG', 'database.ini')
     security_info = parse_info(config, 'security')
     xiviewbaseurl = security_info.get("xiviewbaseurl")
     return xiviewbaseurl
+
+
+def parse_optional_info(section):
+    """
+    Settings of an optional section of the ini file, empty if the section is missing
+    so that the callers use their defaults. Malformed files still raise.
+    """
+    config = os.environ.get('DB_CONFIG', 'database.ini')
+    parser = ConfigParser()
+    parser.read(config)
+    try:
+        return dict(parser.items(section))
+    except NoSectionError:
+        return {}
+
+
+def get_pool_config():
+    """
+    Connection pool settings shared by every database access path, from the optional [pool] section.
+    min_size and max_size are per worker process, split between its sync and async engines.
+    """
+    pool_info = parse_optional_info('pool')
+    return {
+        "min_size": int(pool_info.get("min_size", 5)),
+        "max_size": int(pool_info.get("max_size", 20)),
+        "recycle": int(pool_info.get("recycle", 1800)),
+        "timeout": float(pool_info.get("timeout", 30)),
+    }
+
+
+def get_external_api_config():
+    """
+    Settings of the fetcher calling PRIDE, UniProt, PDBe and AlphaFold.
+    Base urls can be pointed at a local stub server for testing.
+    """
+    api_info = parse_optional_info('external_api')
+    return {
+        "pride_url": api_info.get("pride_url", "https://www.ebi.ac.uk/pride/ws/archive/v2/projects/"),
+        "uniprot_url": api_info.get("uniprot_url", "https://rest.uniprot.org/uniprotkb/search"),
+        "pdbe_url": api_info.get("pdbe_url", "https://www.ebi.ac.uk/pdbe/api/mappings/best_structures/"),
+        "alphafold_url": api_info.get("alphafold_url", "https://alphafold.ebi.ac.uk/api/prediction/"),
+        "concurrency": int(api_info.get("concurrency", 10)),
+        "rate_limit": float(api_info.get("rate_limit", 20)),
+        "retries": int(api_info.get("retries", 3)),
+        "backoff": float(api_info.get("backoff", 0.5)),
+        "timeout": float(api_info.get("timeout", 30)),
+        "uniprot_batch_size": int(api_info.get("uniprot_batch_size", 100)),
+    }
+
+
+def get_jobs_config():
+    """
+    Settings of the background parse jobs: number of parses running at the same time,
+    and number waiting for a free worker before /parse refuses new ones.
+    """
+    jobs_info = parse_optional_info('jobs')
+    return {
+        "parse_workers": int(jobs_info.get("parse_workers", 1)),
+        "parse_queue_size": int(jobs_info.get("parse_queue_size", 10)),
+    }
+
+
+def get_redis_pool_config():
+    """
+    Settings of the shared Redis connection pool: size, timeouts in seconds, the interval of the
+    connection health checks and how long Redis is skipped after it failed.
+    Falls back to defaults for the settings missing from the [redis] section.
+    """
+    redis_info = redis_config()
+    return {
+        "host": redis_info.get("host"),
+        "port": int(redis_info.get("port") or 6379),
+        "password": redis_info.get("password") or None,
+        "max_connections": int(redis_info.get("max_connections", 50)),
+        "socket_timeout": float(redis_info.get("socket_timeout", 0.5)),
+        "connect_timeout": float(redis_info.get("connect_timeout", 0.5)),
+        "health_check_interval": int(redis_info.get("health_check_interval", 30)),
+        "retry_after": float(redis_info.get("retry_after", 30)),
+    }
@@ -0,0 +1,73 @@
+import os
+import sys
+import tempfile
+
+# the app builds its engines from the config when imported, they only connect when used
+TEST_CONFIG = """[postgresql]
+host=localhost
+database=xiview_test
+user=xiview
+password=xiview
+port=5432
+
+[security]
+apikey=test
+xiviewbaseurl=http://localhost/xiview
+
+[redis]
+host=localhost
+port=6379
+password=
+"""
+
+if "DB_CONFIG" not in os.environ:
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".ini", delete=False)
+    config_file.write(TEST_CONFIG)
+    config_file.close()
+    os.environ["DB_CONFIG"] = config_file.name
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+import contextlib
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def database_url():
+    """
+    URL of an empty schema of the database in TEST_DATABASE_URL, dropped afterwards.
+    Tests using it are skipped when TEST_DATABASE_URL isn't set.
+    """
+    url = os.environ.get("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    import psycopg
+
+    schema = "test_" + uuid.uuid4().hex[:12]
+    with psycopg.connect(url, autocommit=True) as conn:
+        conn.execute(f"CREATE SCHEMA {schema}")
+    separator = "&" if "?" in url else "?"
+    try:
+        yield f"{url}{separator}options=-csearch_path%3D{schema}"
+    finally:
+        with psycopg.connect(url, autocommit=True) as conn:
+            conn.execute(f"DROP SCHEMA {schema} CASCADE")
+
+
+@pytest.fixture
+def db_cursor_factory(database_url):
+    """
+    Stand-in for app.routes.shared.get_db_cursor on the test schema.
+    """
+    import psycopg
+    from psycopg.rows import dict_row
+
+    @contextlib.asynccontextmanager
+    async def get_db_cursor(name=None):
+        async with await psycopg.AsyncConnection.connect(database_url) as conn:
+            async with conn.cursor(name=name or "", row_factory=dict_row) as cur:
+                yield cur
+    return get_db_cursor
@@ -0,0 +1,129 @@
+import asyncio
+
+from fastapi import Response
+
+from app.cache import cached, invalidate_cache
+from app.config.redis import redis_connection
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def incr(self, key):
+        self.calls.append((self.client.incr, key))
+
+    def expire(self, key, ttl):
+        self.calls.append((self.client.expire, key, ttl))
+
+    async def execute(self):
+        return [await call(*args) for call, *args in self.calls]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    async def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    async def incr(self, key):
+        self.values[key] = str(int(self.values.get(key, 0)) + 1).encode()
+        return int(self.values[key])
+
+    async def expire(self, key, ttl):
+        pass
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+def use_fake_redis(monkeypatch):
+    client = FakeRedis()
+    monkeypatch.setattr(redis_connection, "client", client)
+    monkeypatch.setattr(redis_connection, "config", {"retry_after": 5})
+    return client
+
+
+def test_invalidation_hides_cached_responses(monkeypatch):
+    use_fake_redis(monkeypatch)
+    calls = []
+
+    @cached(ttl=60, tags=("project:{project_id}",))
+    async def endpoint(project_id):
+        calls.append(project_id)
+        return {"calls": len(calls)}
+
+    async def run():
+        first = await endpoint(project_id="PXD1")
+        await endpoint(project_id="PXD1")
+        await invalidate_cache("project:PXD1")
+        await endpoint(project_id="PXD1")
+        return first
+
+    assert asyncio.run(run()) == {"calls": 1}
+    assert calls == ["PXD1", "PXD1"]
+
+
+def test_response_computed_before_invalidation_is_not_served(monkeypatch):
+    use_fake_redis(monkeypatch)
+    calls = []
+
+    @cached(ttl=60, tags=("project:{project_id}",))
+    async def endpoint(project_id):
+        calls.append(project_id)
+        if len(calls) == 1:
+            # the data changes while the first response is computed
+            await invalidate_cache("project:PXD1")
+        return {"calls": len(calls)}
+
+    async def run():
+        await endpoint(project_id="PXD1")
+        return await endpoint(project_id="PXD1")
+
+    assert asyncio.run(run()) == {"calls": 2}
+
+
+def test_big_responses_are_not_cached(monkeypatch):
+    client = use_fake_redis(monkeypatch)
+
+    @cached(ttl=60, max_size=10)
+    async def endpoint():
+        return Response(b"x" * 11)
+
+    asyncio.run(endpoint())
+    assert client.values == {}
+
+
+def test_single_timeout_does_not_skip_redis(monkeypatch):
+    use_fake_redis(monkeypatch)
+    monkeypatch.setattr(redis_connection, "_unavailable_until", 0.0)
+    monkeypatch.setattr(redis_connection, "_timeouts", 0)
+    redis_connection.record_failure(TimeoutError("slow"))
+    assert redis_connection.get() is not None
+    redis_connection.record_failure(ConnectionError("down"))
+    assert redis_connection.get() is None
+
+
+def test_no_store_responses_are_not_cached(monkeypatch):
+    client = use_fake_redis(monkeypatch)
+
+    @cached(ttl=60)
+    async def endpoint():
+        return Response(b"{}", headers={"Cache-Control": "no-store"})
+
+    asyncio.run(endpoint())
+    assert client.values == {}
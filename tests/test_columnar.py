@@ -0,0 +1,56 @@
+import msgpack
+import numpy as np
+
+from app.columnar import accepts_msgpack, encode_data_object, to_columns, typed_array
+
+
+def test_accepts_msgpack():
+    assert accepts_msgpack("application/msgpack")
+    assert accepts_msgpack("application/json;q=0.5, application/x-msgpack")
+    assert not accepts_msgpack(None)
+    assert not accepts_msgpack("application/json")
+    assert not accepts_msgpack("*/*")
+
+
+def test_accepts_msgpack_quality():
+    assert not accepts_msgpack("application/msgpack;q=0")
+    assert not accepts_msgpack("application/msgpack; q=0.0, application/json")
+    assert not accepts_msgpack("application/msgpack;q=0.5, application/json")
+    assert accepts_msgpack("application/msgpack;q=0.9, application/json;q=0.1")
+    assert not accepts_msgpack("application/msgpack;q=high")
+
+
+def test_typed_array_ints():
+    packed = typed_array([1, 2, 3])
+    assert packed["dtype"] == "<i4"
+    assert np.frombuffer(packed["data"], dtype="<i4").tolist() == [1, 2, 3]
+    assert typed_array([1, 2 ** 40])["dtype"] == "<i8"
+
+
+def test_typed_array_missing_values():
+    # ints with missing values stay lists
+    assert typed_array([1, None, 3]) is None
+    assert typed_array([True, None]) is None
+    packed = typed_array([1.5, None, 2])
+    assert packed["dtype"] == "<f8"
+    values = np.frombuffer(packed["data"], dtype="<f8")
+    assert values[0] == 1.5 and np.isnan(values[1]) and values[2] == 2
+    assert typed_array([None, None]) is None
+    assert typed_array(["a", 1]) is None
+    assert typed_array([]) is None
+
+
+def test_to_columns():
+    batch = to_columns([{"id": 1, "seq": "PEP", "pos": None}, {"id": 2, "seq": "TIDE", "pos": 4}])
+    assert batch["length"] == 2
+    assert batch["columns"]["id"]["dtype"] == "<i4"
+    assert batch["columns"]["seq"] == ["PEP", "TIDE"]
+    assert batch["columns"]["pos"] == [None, 4]
+    assert to_columns([]) == {"length": 0, "columns": {}}
+
+
+def test_encode_data_object():
+    data_object = {"project": [], "meta": {}, "matches": [{"id": 1}], "peptides": [], "proteins": []}
+    decoded = msgpack.unpackb(encode_data_object(data_object))
+    assert decoded["matches"]["length"] == 1
+    assert np.frombuffer(decoded["matches"]["columns"]["id"]["data"], dtype="<i4").tolist() == [1]
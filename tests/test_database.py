@@ -0,0 +1,7 @@
+from app.config.database import split_pool_size
+
+
+def test_pool_budget_is_split_between_engines():
+    assert split_pool_size(20) == (10, 10)
+    assert split_pool_size(5) == (2, 3)
+    assert split_pool_size(1) == (1, 1)
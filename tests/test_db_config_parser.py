@@ -0,0 +1,40 @@
+import configparser
+
+import pytest
+
+from db_config_parser import get_jobs_config, get_pool_config, get_redis_pool_config
+
+
+def write_config(tmp_path, monkeypatch, text):
+    path = tmp_path / "database.ini"
+    path.write_text(text)
+    monkeypatch.setenv("DB_CONFIG", str(path))
+
+
+def test_missing_section_uses_defaults(tmp_path, monkeypatch):
+    write_config(tmp_path, monkeypatch, "[postgresql]\nhost=localhost\n")
+    assert get_pool_config()["max_size"] == 20
+    assert get_jobs_config() == {"parse_workers": 1, "parse_queue_size": 10}
+
+
+def test_section_overrides_defaults(tmp_path, monkeypatch):
+    write_config(tmp_path, monkeypatch, "[pool]\nmax_size=7\n")
+    assert get_pool_config()["max_size"] == 7
+    assert get_pool_config()["min_size"] == 5
+
+
+def test_malformed_value_raises(tmp_path, monkeypatch):
+    write_config(tmp_path, monkeypatch, "[pool]\nmax_size=lots\n")
+    with pytest.raises(ValueError):
+        get_pool_config()
+
+
+def test_malformed_file_raises(tmp_path, monkeypatch):
+    write_config(tmp_path, monkeypatch, "max_size=7\n")
+    with pytest.raises(configparser.Error):
+        get_pool_config()
+
+
+def test_redis_port_defaults(tmp_path, monkeypatch):
+    write_config(tmp_path, monkeypatch, "[redis]\nhost=localhost\nport=\n")
+    assert get_redis_pool_config()["port"] == 6379
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from starlette.requests import Request
+
+from app.etag import etag_matches, not_modified, uploads_etag
+
+UPLOADS = [{"id": 2, "upload_time": datetime(2024, 1, 2)}, {"id": 1, "upload_time": datetime(2024, 1, 1)}]
+BUILDS = {1: datetime(2024, 1, 1, 1), 2: datetime(2024, 1, 2, 1)}
+
+
+def request_with(if_none_match):
+    return Request({"type": "http", "headers": [(b"if-none-match", if_none_match.encode())]})
+
+
+def test_etag_is_stable_and_ignores_upload_order():
+    assert uploads_etag(UPLOADS, BUILDS, "json") == uploads_etag(UPLOADS[::-1], BUILDS, "json")
+    assert uploads_etag(UPLOADS, BUILDS, "json") != uploads_etag(UPLOADS, BUILDS, "msgpack")
+
+
+def test_rebuild_changes_etag():
+    rebuilt = {**BUILDS, 2: datetime(2024, 1, 3)}
+    assert uploads_etag(UPLOADS, BUILDS) != uploads_etag(UPLOADS, rebuilt)
+
+
+def test_no_etag_while_an_upload_is_incomplete():
+    assert uploads_etag(UPLOADS, {1: BUILDS[1]}) is None
+    assert not etag_matches(request_with("*"), None)
+
+
+def test_etag_matches_if_none_match_list():
+    etag = uploads_etag(UPLOADS, BUILDS)
+    assert etag_matches(request_with(f'"other", W/{etag}'), etag)
+    assert not etag_matches(request_with('"other"'), etag)
+
+
+def test_no_etag_when_uploads_could_not_be_read():
+    assert uploads_etag(None, {}) is None
+
+
+def test_not_modified_keeps_vary():
+    assert not_modified('"x"', "Accept").headers["vary"] == "Accept"
+    assert "vary" not in not_modified('"x"').headers
@@ -0,0 +1,28 @@
+import asyncio
+
+from app import jobs
+from app.jobs import ProcessJobQueue
+
+
+def test_reserve_stops_at_capacity():
+    queue = ProcessJobQueue(max_workers=1, max_queued=1)
+    assert queue.reserve()
+    assert queue.reserve()
+    assert not queue.reserve()
+    assert queue.full()
+    queue.release()
+    assert queue.reserve()
+
+
+def test_run_releases_its_place(monkeypatch):
+    async def update_job(job_id, **kwargs):
+        pass
+    monkeypatch.setattr(jobs, "update_job", update_job)
+    queue = ProcessJobQueue(max_workers=1, max_queued=0)
+    assert queue.reserve()
+    try:
+        assert asyncio.run(queue.run("job", abs, -3)) == 3
+    finally:
+        queue.shutdown()
+    assert queue.pending == 0
+    assert queue.reserve()
@@ -0,0 +1,60 @@
+import psycopg
+
+from app.config.schema import API_TABLES, BACKFILL_SQL, LATEST_UPLOAD_TRIGGER
+
+UPLOAD_TABLE = """CREATE TABLE upload (id SERIAL PRIMARY KEY, project_id TEXT NOT NULL,
+    identification_file_name TEXT, identification_file_name_clean TEXT, upload_time TIMESTAMP DEFAULT now())"""
+
+
+def create_tables(conn):
+    conn.execute(UPLOAD_TABLE)
+    for statement in API_TABLES + LATEST_UPLOAD_TRIGGER:
+        conn.execute(statement)
+
+
+def latest(conn, project_id):
+    return conn.execute("SELECT identification_file_name, upload_id FROM latestupload WHERE project_id = %s "
+                        "ORDER BY identification_file_name", [project_id]).fetchall()
+
+
+def add_upload(conn, project_id, file_name):
+    return conn.execute("INSERT INTO upload (project_id, identification_file_name) VALUES (%s, %s) RETURNING id",
+                        [project_id, file_name]).fetchone()[0]
+
+
+def test_uploads_written_straight_to_the_database_become_latest(database_url):
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        create_tables(conn)
+        first = add_upload(conn, "PXD1", "a.mzid")
+        other = add_upload(conn, "PXD1", "b.mzid")
+        assert latest(conn, "PXD1") == [("a.mzid", first), ("b.mzid", other)]
+        replacement = add_upload(conn, "PXD1", "a.mzid")
+        assert latest(conn, "PXD1") == [("a.mzid", replacement), ("b.mzid", other)]
+        conn.execute("DELETE FROM upload WHERE id = %s", [replacement])
+        assert latest(conn, "PXD1") == [("a.mzid", first), ("b.mzid", other)]
+
+
+def test_staged_upload_stays_hidden(database_url):
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        create_tables(conn)
+        published = add_upload(conn, "PXD1", "a.mzid")
+        with conn.transaction():
+            staged = add_upload(conn, "PXD1", "a.mzid")
+            conn.execute("INSERT INTO stagedupload (upload_id, staged_at) VALUES (%s, now())", [staged])
+        assert latest(conn, "PXD1") == [("a.mzid", published)]
+
+
+def test_backfill_fills_projects_without_rows(database_url):
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        conn.execute(UPLOAD_TABLE)
+        for statement in API_TABLES:
+            conn.execute(statement)
+        first = add_upload(conn, "PXD1", "a.mzid")
+        staged = add_upload(conn, "PXD2", "a.mzid")
+        conn.execute("INSERT INTO stagedupload (upload_id, staged_at) VALUES (%s, now())", [staged])
+        conn.execute("INSERT INTO latestupload (project_id, identification_file_name, upload_id) "
+                     "VALUES ('PXD3', 'c.mzid', 99)")
+        for statement in BACKFILL_SQL:
+            conn.execute(statement)
+        assert latest(conn, "PXD1") == [("a.mzid", first)]
+        assert latest(conn, "PXD2") == []
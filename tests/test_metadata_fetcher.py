@@ -0,0 +1,93 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.metadata_fetcher import HostLimits, MetadataFetcher
+
+CONFIG = {"concurrency": 1, "rate_limit": 0, "retries": 2, "backoff": 0, "timeout": 5}
+
+
+def stub_server(responses):
+    """
+    MockTransport answering each request with the next (status, json) of responses.
+    """
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        status_code, body = responses.pop(0)
+        return httpx.Response(status_code, json=body)
+
+    return httpx.MockTransport(handler), requests
+
+
+async def fetch(transport, url, limits=None):
+    async with MetadataFetcher(CONFIG, transport=transport, limits=limits or HostLimits()) as fetcher:
+        return await fetcher.get_json(url)
+
+
+def test_get_json():
+    transport, requests = stub_server([(200, {"title": "x"})])
+    assert asyncio.run(fetch(transport, "https://pride.test/projects/PXD1")) == {"title": "x"}
+    assert len(requests) == 1
+
+
+def test_not_found_is_none():
+    transport, _ = stub_server([(404, {})])
+    assert asyncio.run(fetch(transport, "https://pride.test/projects/PXD1")) is None
+
+
+def test_retries_server_errors():
+    transport, requests = stub_server([(503, {}), (429, {}), (200, [1])])
+    assert asyncio.run(fetch(transport, "https://pride.test/projects/PXD1")) == [1]
+    assert len(requests) == 3
+
+
+def test_gives_up_after_retries():
+    transport, requests = stub_server([(500, {})] * 3)
+    with pytest.raises(Exception):
+        asyncio.run(fetch(transport, "https://pride.test/projects/PXD1"))
+    assert len(requests) == 3
+
+
+def test_limits_are_shared_per_host():
+    in_flight = {"pride.test": 0, "uniprot.test": 0}
+    peak = dict(in_flight)
+
+    async def handler(request):
+        host = request.url.host
+        in_flight[host] += 1
+        peak[host] = max(peak[host], in_flight[host])
+        await asyncio.sleep(0.01)
+        in_flight[host] -= 1
+        return httpx.Response(200, json={})
+
+    async def run():
+        limits = HostLimits()
+        transport = httpx.MockTransport(handler)
+        # several fetchers, as in a metadata refresh of several projects at once
+        await asyncio.gather(*(fetch(transport, f"https://{host}/{i}", limits)
+                               for i in range(4) for host in in_flight))
+
+    asyncio.run(run())
+    assert peak == {"pride.test": 1, "uniprot.test": 1}
+
+
+def test_backoff_releases_the_host_slot():
+    transport, requests = stub_server([(503, {}), (200, "second"), (200, "first")])
+    finished = []
+
+    async def get(fetcher, path):
+        finished.append((path, await fetcher.get_json(f"https://pride.test/{path}")))
+
+    async def run():
+        config = dict(CONFIG, backoff=0.2)
+        async with MetadataFetcher(config, transport=transport, limits=HostLimits()) as fetcher:
+            first = asyncio.create_task(get(fetcher, "first"))
+            await asyncio.sleep(0.05)
+            await asyncio.wait_for(get(fetcher, "second"), timeout=0.1)
+            await first
+
+    asyncio.run(run())
+    assert finished == [("second", "second"), ("first", "first")]
@@ -0,0 +1,40 @@
+import asyncio
+
+from app.routes import pdbdev
+
+
+def test_start_residue_pair_build_runs_once_per_upload(monkeypatch):
+    calls = []
+    release = asyncio.Event()
+
+    async def fake_ensure(upload_ids, rebuild=False):
+        calls.append(list(upload_ids))
+        await release.wait()
+
+    monkeypatch.setattr(pdbdev, "ensure_residue_pairs", fake_ensure)
+
+    async def run():
+        pdbdev.start_residue_pair_build([2, 1])
+        pdbdev.start_residue_pair_build([1, 2, 3])
+        await asyncio.sleep(0)
+        assert set(pdbdev.residue_pair_builds) == {1, 2, 3}
+        release.set()
+        await asyncio.gather(*set(pdbdev.residue_pair_builds.values()))
+
+    asyncio.run(run())
+    assert calls == [[1, 2], [3]]
+    assert pdbdev.residue_pair_builds == {}
+
+
+def test_failed_build_can_be_started_again(monkeypatch):
+    async def failing(upload_ids, rebuild=False):
+        raise RuntimeError("database went away")
+
+    monkeypatch.setattr(pdbdev, "ensure_residue_pairs", failing)
+
+    async def run():
+        pdbdev.start_residue_pair_build([7])
+        await asyncio.gather(*set(pdbdev.residue_pair_builds.values()))
+
+    asyncio.run(run())
+    assert pdbdev.residue_pair_builds == {}
@@ -0,0 +1,53 @@
+import asyncio
+
+import orjson
+import psycopg
+
+from app.config.schema import API_TABLES
+from app.routes import pdbdev
+
+# one key with passing and non-passing matches, and two with one kind each
+RESIDUE_PAIRS = [
+    (1, "P1", 10, "P2", 20, True, [1]),
+    (1, "P1", 10, "P2", 20, False, [2]),
+    (1, "P1", 11, "P2", 21, False, [3]),
+    (1, "P1", 12, "P2", 22, True, [4]),
+]
+
+
+def load(database_url):
+    with psycopg.connect(database_url) as conn:
+        for statement in API_TABLES:
+            conn.execute(statement)
+        conn.execute("CREATE TABLE upload (id INTEGER PRIMARY KEY, identification_file_name TEXT)")
+        conn.execute("INSERT INTO upload VALUES (1, 'a.mzid')")
+        conn.cursor().executemany("""INSERT INTO residuepair (upload_id, prot1, pos1, prot2, pos2, passing, match_ids)
+                                     VALUES (%s, %s, %s, %s, %s, %s, %s)""", RESIDUE_PAIRS)
+
+
+def get_page(page_size, page=1, after=None, passing_threshold="all"):
+    body = asyncio.run(pdbdev.get_residue_pairs_page([1], (object(),), passing_threshold, page, page_size, after))
+    return orjson.loads(body)
+
+
+def test_key_with_passing_and_non_passing_matches_fills_the_page(database_url, db_cursor_factory, monkeypatch):
+    monkeypatch.setattr(pdbdev, "get_db_cursor", db_cursor_factory)
+    load(database_url)
+
+    page = get_page(page_size=3)
+    assert [row["pos1"] for row in page["data"]] == [10, 11, 12]
+    assert sorted(page["data"][0]["match_ids"]) == [1, 2]
+    assert page["page"]["total_elements"] == 3
+    assert page["page"]["next_cursor"] is not None
+
+
+def test_pages_neither_stop_early_nor_skip_pairs(database_url, db_cursor_factory, monkeypatch):
+    monkeypatch.setattr(pdbdev, "get_db_cursor", db_cursor_factory)
+    load(database_url)
+
+    first = get_page(page_size=2)
+    by_offset = get_page(page_size=2, page=2)
+    by_cursor = get_page(page_size=2, after=pdbdev.decode_residue_pair_cursor(first["page"]["next_cursor"]))
+    assert [row["pos1"] for row in first["data"]] == [10, 11]
+    assert [row["pos1"] for row in by_offset["data"]] == [12]
+    assert by_cursor["data"] == by_offset["data"]
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from app.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_run():
+    flight = SingleFlight()
+    calls = []
+
+    async def work(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    async def run():
+        return await asyncio.gather(*(flight.do("key", work, 21) for _ in range(5)))
+
+    assert asyncio.run(run()) == [42] * 5
+    assert calls == [21]
+    assert flight.as_dict() == {"in_flight": 0, "started": 1, "joined": 4}
+
+
+def test_failure_reaches_every_waiter_and_is_not_kept():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run():
+        results = await asyncio.gather(flight.do("key", fail), flight.do("key", fail), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        return await flight.do("key", asyncio.sleep, 0, "again")
+
+    assert asyncio.run(run()) == "again"
+    assert flight.started == 2
+
+
+def test_cancelled_waiter_does_not_cancel_the_call():
+    flight = SingleFlight()
+
+    async def run():
+        done = asyncio.Event()
+
+        async def work():
+            await done.wait()
+            return "result"
+
+        first = asyncio.ensure_future(flight.do("key", work))
+        second = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        done.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "result"
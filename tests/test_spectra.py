@@ -0,0 +1,58 @@
+import struct
+
+import numpy as np
+import pytest
+
+from app.spectra import FRAME_HEADER_LENGTH, FrameReader, pack_frame, peak_array
+
+
+def make_frame(spectrum_id, n):
+    mz = np.arange(n, dtype="<f8").tobytes()
+    intensity = np.full(n, 2.0, dtype="<f8").tobytes()
+    return pack_frame({"id": spectrum_id}, mz, intensity), mz, intensity
+
+
+def raw_frame(header_bytes):
+    return FRAME_HEADER_LENGTH.pack(len(header_bytes)) + header_bytes
+
+
+def test_pack_frame_header():
+    frame, mz, intensity = make_frame("s1", 3)
+    (header_length,) = FRAME_HEADER_LENGTH.unpack_from(frame)
+    assert b'"mz_length":3' in frame[4:4 + header_length]
+    assert frame.endswith(mz + intensity)
+    assert peak_array(mz).tolist() == [0.0, 1.0, 2.0]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 64, 10000])
+def test_frame_reader_any_chunking(chunk_size):
+    frames = [make_frame(f"s{i}", i) for i in range(5)]
+    stream = b"".join(frame for frame, _, _ in frames)
+    reader = FrameReader()
+    read = []
+    for start in range(0, len(stream), chunk_size):
+        read.extend(reader.feed(stream[start:start + chunk_size]))
+    reader.close()
+    assert [header["id"] for header, _, _ in read] == [f"s{i}" for i in range(5)]
+    assert [(mz, intensity) for _, mz, intensity in read] == [(mz, intensity) for _, mz, intensity in frames]
+
+
+def test_frame_reader_truncated():
+    frame, _, _ = make_frame("s1", 4)
+    reader = FrameReader()
+    assert reader.feed(frame[:-1]) == []
+    with pytest.raises(ValueError):
+        reader.close()
+
+
+@pytest.mark.parametrize("header", [
+    b'{"id": "s1"}',
+    b'{"id": "s1", "mz_length": 1}',
+    b'{"mz_length": "1", "intensity_length": 1}',
+    b'{"mz_length": -1, "intensity_length": 1}',
+    b'[1, 2]',
+    b'not json',
+])
+def test_frame_reader_invalid_header(header):
+    with pytest.raises(ValueError):
+        FrameReader().feed(raw_frame(header) + struct.pack("<d", 1.0))
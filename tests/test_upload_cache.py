@@ -0,0 +1,53 @@
+import asyncio
+
+from app import upload_cache
+from app.upload_cache import LocalChannel, TTLCache
+
+
+def test_entries_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(upload_cache.time, "monotonic", lambda: now[0])
+    cache = TTLCache(max_size=10, ttl=5)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    now[0] += 6
+    assert cache.get("a") is None
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+
+
+def test_put_started_before_a_drop_is_ignored():
+    cache = TTLCache(max_size=10, ttl=60)
+    generation = cache.generation
+    cache.drop(lambda key: key[0] == "PXD1")
+    cache.put(("PXD1", None), ["stale"], generation)
+    assert cache.get(("PXD1", None)) is None
+    cache.put(("PXD1", None), ["current"], cache.generation)
+    assert cache.get(("PXD1", None)) == ["current"]
+
+
+def test_local_channel_delivers_to_subscribers():
+    channel = LocalChannel()
+    received = []
+    channel.subscribe(received.append)
+    channel.subscribe(lambda message: received.append(message.lower()))
+    asyncio.run(channel.publish("PXD1"))
+    assert received == ["PXD1", "pxd1"]
+
+
+def test_upload_change_drops_project():
+    upload_cache.latest_uploads.put(("PXD1", None), [1])
+    upload_cache.latest_uploads.put(("PXD2", None), [2])
+    upload_cache.on_upload_change("PXD1")
+    assert upload_cache.latest_uploads.get(("PXD1", None)) is None
+    assert upload_cache.latest_uploads.get(("PXD2", None)) == [2]
+    upload_cache.on_upload_change(None)
+    assert upload_cache.latest_uploads.get(("PXD2", None)) is None
@@ -0,0 +1,78 @@
+import asyncio
+import contextlib
+
+from app.routes import xiview
+
+
+class FakeCursor:
+    """
+    Answers each query with the rows that rows_for returns for its parameters, and records the calls.
+    """
+    def __init__(self, rows_for):
+        self.rows_for = rows_for
+        self.executed = []
+        self._rows = []
+
+    async def execute(self, query, params):
+        self.executed.append((query, params))
+        self._rows = self.rows_for(query, params)
+
+    async def fetchall(self):
+        return self._rows
+
+
+def test_key_batches_split_keys_into_parallel_arrays(monkeypatch):
+    monkeypatch.setattr(xiview, "LOOKUP_BATCH_SIZE", 2)
+    keys = [(1, "p1"), (1, "p2"), (2, "p1")]
+    assert list(xiview.key_batches(keys)) == [[[1, 1], ["p1", "p2"]], [[2], ["p1"]]]
+
+
+def test_peptide_keys_are_unique_and_sorted():
+    matches = [{"si": "2", "pi1": "b", "pi2": None}, {"si": "1", "pi1": "a", "pi2": "b"},
+               {"si": "1", "pi1": "b", "pi2": "a"}]
+    assert xiview.get_peptide_keys(matches) == [(1, "a"), (1, "b"), (2, "b")]
+
+
+def test_get_peptides_queries_every_batch(monkeypatch):
+    monkeypatch.setattr(xiview, "LOOKUP_BATCH_SIZE", 2)
+    cur = FakeCursor(lambda query, params: [{"id": pep_id, "u_id": str(upload_id)}
+                                            for upload_id, pep_id in zip(*params)])
+    keys = [(1, "p1"), (1, "p2"), (2, "p1"), (2, "p3"), (3, "p1")]
+    rows = asyncio.run(xiview.get_peptides(cur, keys))
+    assert len(cur.executed) == 3
+    assert [(int(row["u_id"]), row["id"]) for row in rows] == keys
+
+
+def test_get_proteins_drops_proteins_repeated_across_batches(monkeypatch):
+    monkeypatch.setattr(xiview, "LOOKUP_BATCH_SIZE", 1)
+    # every peptide of upload 1 maps to protein P1, the one of upload 2 to a protein also called P1
+    cur = FakeCursor(lambda query, params: [{"id": "P1", "search_id": str(params[0][0])}])
+    rows = asyncio.run(xiview.get_proteins(cur, [(1, "p1"), (1, "p2"), (2, "p1")]))
+    assert len(cur.executed) == 3
+    assert sorted((row["search_id"], row["id"]) for row in rows) == [("1", "P1"), ("2", "P1")]
+
+
+def test_match_sections_use_the_peptide_keys_of_the_matches(monkeypatch):
+    monkeypatch.setattr(xiview, "LOOKUP_BATCH_SIZE", 2)
+    matches = [{"id": 1, "si": "1", "pi1": "a", "pi2": "b"}, {"id": 2, "si": "2", "pi1": "a", "pi2": None}]
+
+    def rows_for(query, params):
+        if query == xiview.MATCHES_QUERY:
+            return matches
+        if query == xiview.PEPTIDES_QUERY:
+            return [{"id": pep_id, "u_id": str(upload_id)} for upload_id, pep_id in zip(*params)]
+        return [{"id": "P1", "search_id": str(upload_id)} for upload_id in params[0]]
+
+    cursors = []
+
+    @contextlib.asynccontextmanager
+    async def fake_get_db_cursor(name=None):
+        cursors.append(FakeCursor(rows_for))
+        yield cursors[-1]
+
+    monkeypatch.setattr(xiview, "get_db_cursor", fake_get_db_cursor)
+    got_matches, peptides, proteins = asyncio.run(xiview.get_match_sections([1, 2]))
+    assert got_matches == matches
+    assert sorted((row["u_id"], row["id"]) for row in peptides) == [("1", "a"), ("1", "b"), ("2", "a")]
+    assert sorted((row["search_id"], row["id"]) for row in proteins) == [("1", "P1"), ("2", "P1")]
+    assert len(cursors) == 3